@@ -0,0 +1,143 @@
+"""
+バッチ処理 (ヘッドレス CLI)
+
+フォルダ (または画像パスを1行ずつ書いたマニフェスト .txt) の画像をまとめて処理します。
+モデルは1度だけロードして全画像で使い回し、結果は画像ごとのフォルダ (<out>/<画像名>/) に書き出すため、
+outputs/ を消し合うことなく複数プロセス・複数マシンで同時に実行できます。
+
+    python app/batch_worker.py photos/ --out results/ --use_moge
+    python app/batch_worker.py list.txt --out results/ --shard 0/4    # 4 分割したうちの 0 番目を担当
+    python app/batch_worker.py photos/ --out results/ --retry_failed  # 失敗した画像だけやり直す
+
+進捗は <out>/progress_<i>of<n>.jsonl に1画像1行で追記され、再実行すると (どのシャードで処理したものでも)
+完了済みの画像は飛ばします。途中で落ちた画像は出力フォルダごと作り直されます。
+その他の引数 (--detector_name, --use_moge, --inference_type など) は predict_worker.py と同じものをそのまま渡せます。
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import predict_worker as pw
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+def list_inputs(source, recursive=False):
+    """(絶対パス, source からの相対パス) のリストを返す。source はフォルダかマニフェスト (1行1パス, # はコメント)"""
+    if os.path.isdir(source):
+        items = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for f in sorted(files):
+                if f.lower().endswith(IMAGE_EXTS) or pw.is_video(f):
+                    p = os.path.join(root, f); items.append((os.path.abspath(p), os.path.relpath(p, source)))
+            if not recursive: break
+        return items
+    base = os.path.dirname(os.path.abspath(source))
+    items = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            p = line if os.path.isabs(line) else os.path.join(base, line)
+            items.append((os.path.abspath(p), line))
+    return items
+
+def parse_shard(spec):
+    """"i/n" -> (i, n)"""
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"--shard must be i/n (e.g. 0/4), got {spec!r}")
+    if n < 1 or not 0 <= i < n: raise argparse.ArgumentTypeError(f"--shard {spec}: need 0 <= i < n")
+    return i, n
+
+def in_shard(rel, shard):
+    """相対パスのハッシュで担当を決める (画像が増えても既存の割り当ては変わらない)"""
+    i, n = shard
+    return int(hashlib.sha1(rel.replace(os.sep, "/").encode("utf-8")).hexdigest(), 16) % n == i
+
+def output_name(rel):
+    """画像ごとの出力フォルダ名 (サブフォルダは __ でつなぎ、拡張子違いの同名画像も区別する)"""
+    stem, ext = os.path.splitext(rel.replace("\\", "/"))
+    return stem.replace("/", "__") + ("_" + ext[1:].lower() if ext else "")
+
+def load_progress(out_dir):
+    """全シャードの進捗ファイルを読み、画像 (相対パス) ごとの最新の記録を返す"""
+    latest = {}
+    for f in sorted(os.listdir(out_dir)) if os.path.isdir(out_dir) else []:
+        if not (f.startswith("progress_") and f.endswith(".jsonl")): continue
+        with open(os.path.join(out_dir, f), "r", encoding="utf-8") as fp:
+            for line in fp:
+                try: rec = json.loads(line)
+                except ValueError: continue # 書き込み途中で落ちた行
+                prev = latest.get(rec.get("image"))
+                if prev is None or rec.get("time", 0) >= prev.get("time", 0): latest[rec.get("image")] = rec
+    return latest
+
+def append_progress(path, rec):
+    line = json.dumps(rec, ensure_ascii=False) + "\n"
+    # 前回が書き込み途中で落ちて改行で終わっていなければ、壊れた行と混ざらないよう改行を補う
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n": line = "\n" + line
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush(); os.fsync(f.fileno())
+
+def build_batch_parser():
+    parser = argparse.ArgumentParser(description="Batch 3D recovery over a folder or manifest of images", epilog="Other options are passed to predict_worker.py.")
+    parser.add_argument("source", help="画像フォルダ、または画像パスを1行ずつ書いたマニフェスト")
+    parser.add_argument("--out", required=True, help="出力先 (画像ごとにサブフォルダを作る)")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1), help="i/n: n 分割したうち i 番目の画像だけを処理する")
+    parser.add_argument("--recursive", action="store_true", help="フォルダをサブフォルダまで探す")
+    parser.add_argument("--retry_failed", action="store_true", help="前回失敗した画像も処理し直す")
+    parser.add_argument("--previews", action="store_true", help="ID 付きプレビュー画像も書き出す (既定では省略)")
+    return parser
+
+def main(argv=None):
+    args, rest = build_batch_parser().parse_known_args(argv)
+    if not args.previews and "--no_previews" not in rest: rest = rest + ["--no_previews"]
+    worker_parser = pw.build_arg_parser()
+    worker_parser.parse_args(["_"] + rest) # 引数の誤りは処理を始める前に知らせる
+
+    items = [(p, rel) for p, rel in list_inputs(args.source, args.recursive) if in_shard(rel, args.shard)]
+    os.makedirs(args.out, exist_ok=True)
+    done = load_progress(args.out)
+    skip_status = {"done"} if args.retry_failed else {"done", "failed"}
+    todo = [(p, rel) for p, rel in items if done.get(rel, {}).get("status") not in skip_status]
+    i, n = args.shard
+    progress_path = os.path.join(args.out, f"progress_{i}of{n}.jsonl")
+    print(f"--- [Batch] shard {i}/{n}: {len(items)} images, {len(items) - len(todo)} already processed, {len(todo)} to go ---")
+    if not todo: return 0
+
+    device = "cuda" if pw.torch.cuda.is_available() else "cpu"
+    # 全画像でモデルを使い回す (ステップごとの解放をしない)。画像は毎回違うので SAM3 の埋め込みキャッシュは使わない
+    models = pw.ModelRegistry(device, resident=True, sam3_cache_mb=0)
+    n_ok = n_failed = 0; t_batch = time.time()
+    for k, (path, rel) in enumerate(todo):
+        out_dir = os.path.join(args.out, output_name(rel))
+        print(f"=== [{k + 1}/{len(todo)}] {rel} -> {out_dir} ===")
+        t0 = time.time(); error = None
+        try:
+            code = pw.run(worker_parser.parse_args([path] + rest), models=models, output_dir=out_dir)
+        except KeyboardInterrupt:
+            print("⏹️ Batch interrupted. Re-run the same command to resume.")
+            return 130
+        except Exception as e:
+            code, error = 1, str(e)
+            print(f"❌ ERROR: {e}")
+        status = "done" if code == 0 else "failed"
+        append_progress(progress_path, {"image": rel, "status": status, "code": code, "error": error, "output": out_dir, "seconds": round(time.time() - t0, 3), "time": time.time()})
+        if code == 0: n_ok += 1
+        else: n_failed += 1
+        pw.clear_memory()
+
+    print(f"✅ Batch finished: {n_ok} done, {n_failed} failed in {time.time() - t_batch:.1f}s (progress: {progress_path})")
+    return 0 if n_failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
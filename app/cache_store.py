@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+# ==========================================
+# 🗃️ 中間結果のディスクキャッシュ (検出結果など)
+# ==========================================
+# outputs/ はジョブごとに消去されるため、キャッシュはその外 (app/cache/<name>/) に置く。
+# 1エントリ = 1つの .npz (配列) で、古いものから max_entries / max_bytes を超えた分を削除する (LRU)。
+CACHE_ROOT = os.environ.get("SAM3D_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+
+def content_key(*parts):
+    """配列・文字列・数値・dict を順に混ぜたハッシュ (キャッシュキー)"""
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(str((p.shape, p.dtype.str)).encode()); h.update(np.ascontiguousarray(p).data)
+        elif isinstance(p, (bytes, bytearray)):
+            h.update(p)
+        else:
+            h.update(json.dumps(p, sort_keys=True, default=str).encode())
+        h.update(b"|")
+    return h.hexdigest()[:24]
+
+class ArrayCache:
+    def __init__(self, name, max_entries=64, max_bytes=None, compress=False, root=CACHE_ROOT):
+        self.name = name
+        self.dir = os.path.join(root, name)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.dir, f"{key}.npz")
+
+    def get(self, key):
+        """{name: array} を返す。無ければ (壊れていれば) None"""
+        p = self._path(key)
+        if not os.path.exists(p): return None
+        try:
+            with np.load(p, allow_pickle=False) as z:
+                data = {k: z[k] for k in z.files}
+            os.utime(p) # LRU: 参照されたエントリを新しくする
+            return data
+        except Exception:
+            try: os.remove(p)
+            except OSError: pass
+            return None
+
+    def put(self, key, arrays):
+        os.makedirs(self.dir, exist_ok=True)
+        p = self._path(key); tmp = f"{p}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f: (np.savez_compressed if self.compress else np.savez)(f, **arrays)
+        os.replace(tmp, p)
+        self.prune()
+        return p
+
+    def prune(self):
+        with self._lock:
+            try:
+                entries = [os.path.join(self.dir, f) for f in os.listdir(self.dir) if f.endswith(".npz")]
+            except OSError:
+                return
+            stats = []
+            for p in entries:
+                try: st = os.stat(p)
+                except OSError: continue
+                stats.append((st.st_mtime, st.st_size, p))
+            stats.sort(reverse=True) # 新しい順
+            total = 0
+            for i, (_, size, p) in enumerate(stats):
+                total += size
+                if i >= self.max_entries or (self.max_bytes and total > self.max_bytes and i > 0):
+                    try: os.remove(p)
+                    except OSError: pass
+
+    def clear(self):
+        if os.path.isdir(self.dir):
+            for f in os.listdir(self.dir):
+                try: os.remove(os.path.join(self.dir, f))
+                except OSError: pass
+
+# ==========================================
+# 🖼️ 知覚ハッシュによる「ほぼ同じ画像」の索引
+# ==========================================
+# 再保存・再圧縮しただけの写真は画素が変わるので content_key のキャッシュには当たらない。
+# 縮小グレースケール画像の dHash (64bit) を過去の入力と比べ、ハミング距離が tolerance 以下で
+# 同じ解像度のものがあれば、その画像のキーを使って検出・深度・推論のキャッシュを引き当てる。
+# 連写や少しだけポーズが違う写真も dHash では近くなるため、再利用する前に縮小画像 (THUMB_SIZE 四方) の
+# 画素の平均絶対差が NEAR_DUP_MAX_DIFF 以下であることも確かめる (thumbnail / thumbnail_diff)。
+THUMB_SIZE = 64
+NEAR_DUP_MAX_DIFF = float(os.environ.get("SAM3D_NEAR_DUP_MAX_DIFF", "2.0")) # 0-255 の輝度差の平均
+
+def dhash(img_bgr, size=8):
+    """差分ハッシュ: (size+1)x size に縮小したグレースケール画像で、横に隣り合う画素の大小を並べた size*size bit"""
+    import cv2
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY) if img_bgr.ndim == 3 else img_bgr
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return int.from_bytes(np.packbits((small[:, 1:] > small[:, :-1]).ravel()).tobytes(), "big")
+
+def thumbnail(img_bgr, size=THUMB_SIZE):
+    """画素レベルの確認用の縮小グレースケール画像 (uint8, size x size)"""
+    import cv2
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY) if img_bgr.ndim == 3 else img_bgr
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+
+def thumbnail_diff(a, b):
+    return float(np.abs(a.astype(np.int16) - b.astype(np.int16)).mean())
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class PerceptualIndex:
+    def __init__(self, name="phash", max_entries=4096, root=CACHE_ROOT):
+        self.path = os.path.join(root, f"{name}.json")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f: return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def lookup(self, h, shape, tolerance):
+        """
+        ハミング距離が tolerance 以下のうち最も近いエントリを (entry, distance, same_shape) で返す (無ければ None)。
+        同じ解像度のものを優先する (解像度が違うと bbox やマスクの座標がずれるため、自動では再利用しない)。
+        """
+        best = None
+        for e in self._read():
+            d = hamming(h, int(e["hash"], 16))
+            if d > tolerance: continue
+            same = list(e["shape"]) == list(shape[:2])
+            rank = (not same, d)
+            if best is None or rank < best[0]: best = (rank, e, d, same)
+        return None if best is None else best[1:]
+
+    def add(self, h, key, shape, source=None):
+        with self._lock:
+            entries = [e for e in self._read() if e["key"] != key]
+            entries.append({"hash": f"{h:016x}", "key": key, "shape": [int(x) for x in shape[:2]], "source": source})
+            entries = entries[-self.max_entries:]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f: json.dump(entries, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import uuid
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Determine paths
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(SCRIPT_DIR)
+LIB_DIR = os.path.join(SCRIPT_DIR, "lib")
+SERVER_SCRIPT = os.path.join(LIB_DIR, "blender_export_server.py")
+SPOOL_DIR = os.environ.get("SAM3D_BLENDER_SPOOL", os.path.join(PARENT_DIR, "blender_spool"))
+BLENDER_EXE = os.environ.get("BLENDER_EXE", "blender")
+HEARTBEAT_TIMEOUT = 5.0 # between manifests / tasks; a single long task may exceed it (see _run_manifest)
+# Rough peak memory of one background Blender doing an FBX/BVH export (used to cap parallel workers)
+BLENDER_WORKER_MB = int(os.environ.get("SAM3D_BLENDER_WORKER_MB", "1500"))
+
+# -----------------------------------------------------------------------------
+# Client for the persistent Blender export server (lib/blender_export_server.py)
+# -----------------------------------------------------------------------------
+def server_available(spool_dir=SPOOL_DIR):
+    """True if a server is watching spool_dir (its heartbeat is fresh)."""
+    try:
+        with open(os.path.join(spool_dir, "server.heartbeat"), 'r') as f:
+            beat = json.load(f)
+        return time.time() - beat["time"] < HEARTBEAT_TIMEOUT
+    except Exception:
+        return False
+
+def _server_busy(spool_dir=SPOOL_DIR):
+    """True while the server is running some manifest (any <job>.running in the spool)."""
+    try:
+        return any(f.endswith(".running") for f in os.listdir(spool_dir))
+    except OSError:
+        return False
+
+def start_server(spool_dir=SPOOL_DIR):
+    """Launches a background Blender that keeps consuming manifests from spool_dir."""
+    os.makedirs(spool_dir, exist_ok=True)
+    return subprocess.Popen([BLENDER_EXE, "--background", "--factory-startup", "--python", SERVER_SCRIPT, "--", spool_dir])
+
+def _write_json_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f: json.dump(data, f)
+    os.replace(tmp, path)
+
+def available_memory_mb():
+    """Available system memory in MB (psutil, else /proc/meminfo), or None where it cannot be read."""
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available // (1024 * 1024))
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"): return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def max_workers(requested=0):
+    """
+    Number of Blender processes to run at once.
+
+    Args:
+        requested: Desired worker count (0 = one per CPU core).
+
+    Returns:
+        requested capped by the CPU count and by available memory / BLENDER_WORKER_MB (at least 1).
+    """
+    cpus = os.cpu_count() or 1
+    n = cpus if requested <= 0 else min(requested, cpus)
+    mem = available_memory_mb()
+    if mem is not None: n = min(n, mem // BLENDER_WORKER_MB)
+    return max(1, n)
+
+def task_groups(tasks):
+    """
+    Splits tasks into groups connected by their "after" dependencies (e.g. one person's FBX and
+    the two BVHs converted from it). Groups are independent and can run in different Blenders;
+    each group keeps the original task order so dependencies still run first.
+    """
+    parent = {t["id"]: t["id"] for t in tasks}
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]; x = parent[x]
+        return x
+    for t in tasks:
+        for dep in t.get("after", []):
+            if dep in parent: parent[find(t["id"])] = find(dep)
+    groups = {}
+    for t in tasks: groups.setdefault(find(t["id"]), []).append(t)
+    return list(groups.values())
+
+def run_tasks(tasks, spool_dir=SPOOL_DIR, timeout=1800, workers=1):
+    """
+    Runs a list of export tasks and returns the result dict
+    ({"job_id", "seconds", "workers", "tasks": [{"id", "op", "output", "status", "error", "seconds", "worker"}]}).
+
+    With workers == 1 everything runs in a single warm Blender: the persistent server if it is
+    running, otherwise one Blender launched for the whole manifest (instead of one per task).
+    With workers > 1 (or 0 = auto) the independent task groups are spread over up to
+    max_workers(workers) one-shot Blenders running in parallel.
+    """
+    t0 = time.time()
+    groups = task_groups(tasks)
+    n = 1 if workers == 1 else min(max_workers(workers), len(groups))
+    if n <= 1:
+        result = _run_manifest(tasks, spool_dir, timeout)
+        for res in result.get("tasks", []): res.setdefault("worker", 0)
+    else:
+        # Largest groups first onto the least loaded worker, then restore the original task order per worker
+        order = {t["id"]: i for i, t in enumerate(tasks)}
+        shares = [[] for _ in range(n)]
+        for g in sorted(groups, key=len, reverse=True):
+            min(shares, key=len).extend(g)
+        shares = [sorted(share, key=lambda t: order[t["id"]]) for share in shares if share]
+        def work(i):
+            result = _run_one_shot({"job_id": f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}_w{i}", "tasks": shares[i]}, spool_dir)
+            for res in result.get("tasks", []): res["worker"] = i
+            return result
+        with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+            results = list(pool.map(work, range(len(shares))))
+        by_id = {res["id"]: res for r in results for res in r.get("tasks", [])}
+        result = {"job_id": results[0]["job_id"].rsplit("_w", 1)[0], "tasks": [by_id[t["id"]] for t in tasks if t["id"] in by_id]}
+    result["seconds"] = time.time() - t0
+    result["workers"] = n
+    return result
+
+def _run_manifest(tasks, spool_dir, timeout):
+    job_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+    manifest = {"job_id": job_id, "tasks": tasks}
+
+    if server_available(spool_dir):
+        manifest_path = os.path.join(spool_dir, f"{job_id}.json")
+        result_path = os.path.join(spool_dir, f"{job_id}.result.json")
+        running_path = os.path.join(spool_dir, f"{job_id}.running")
+        _write_json_atomic(manifest_path, manifest)
+        t0 = time.time()
+        while not os.path.exists(result_path):
+            # Once the server has claimed the manifest (<job>.running) it is busy writing our outputs:
+            # never re-run them in a second Blender, only wait for the result (up to timeout).
+            if os.path.exists(running_path):
+                if time.time() - t0 > timeout:
+                    print("⚠ Blender export server timed out on this job.")
+                    failed = [dict(id=t.get("id"), op=t.get("op"), output=t.get("output"), status="failed", error=f"export server timed out after {timeout}s", seconds=0.0) for t in tasks]
+                    return {"job_id": job_id, "tasks": failed}
+            # Still queued: the server may be busy with another client's manifest (a running job anywhere
+            # in the spool counts as alive). Fall back only if it is gone or the wait exceeds timeout.
+            elif time.time() - t0 > timeout or not (server_available(spool_dir) or _server_busy(spool_dir)):
+                try:
+                    os.remove(manifest_path)
+                except FileNotFoundError:
+                    continue # claimed by the server just now
+                print("⚠ Blender export server did not answer. Falling back to one-shot Blender.")
+                return _run_one_shot(manifest, spool_dir)
+            time.sleep(0.1)
+        with open(result_path, 'r') as f: result = json.load(f)
+        os.remove(result_path)
+        return result
+
+    return _run_one_shot(manifest, spool_dir)
+
+def _run_one_shot(manifest, spool_dir):
+    os.makedirs(spool_dir, exist_ok=True)
+    manifest_path = os.path.join(spool_dir, f"oneshot_{manifest['job_id']}.manifest")
+    result_path = os.path.join(spool_dir, f"oneshot_{manifest['job_id']}.result")
+    _write_json_atomic(manifest_path, manifest)
+    try:
+        error = "blender did not produce a result"
+        try:
+            subprocess.run([BLENDER_EXE, "--background", "--factory-startup", "--python", SERVER_SCRIPT, "--", "--manifest", manifest_path, result_path], capture_output=False)
+        except FileNotFoundError:
+            error = f"blender executable not found: {BLENDER_EXE}"
+        if os.path.exists(result_path):
+            with open(result_path, 'r') as f: return json.load(f)
+        failed = [dict(id=t.get("id"), op=t.get("op"), output=t.get("output"), status="failed", error=error, seconds=0.0) for t in manifest["tasks"]]
+        return {"job_id": manifest["job_id"], "tasks": failed}
+    finally:
+        for p in (manifest_path, result_path):
+            if os.path.exists(p): os.remove(p)
+
+if __name__ == "__main__":
+    # python blender_export.py --serve : run the export server in the foreground
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        sys.exit(start_server().wait())
+    print(f"server_available: {server_available()} (spool: {SPOOL_DIR})")
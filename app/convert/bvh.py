@@ -200,10 +200,11 @@ def save_joint(f, data, t, i, save_order, order='zyx', save_positions=False):
             end_site = False
     
     if end_site:
+        end = data['end_offsets'][i] if data.get('end_offsets') is not None else (0.0, 0.0, 0.0)
         f.write("%sEnd Site\n" % t)
         f.write("%s{\n" % t)
         t += '\t'
-        f.write("%sOFFSET %f %f %f\n" % (t, 0.0, 0.0, 0.0))
+        f.write("%sOFFSET %f %f %f\n" % (t, end[0], end[1], end[2]))
         t = t[:-1]
         f.write("%s}\n" % t)
 
@@ -219,6 +220,7 @@ def save(filename, data, save_positions=False):
     Args:
         filename (str): The output will save on the bvh file.
         data (dict): The data to save.(rotations, positions, offsets, parents, names, order, frametime)
+            Optional key end_offsets (np.ndarray)(jnum, 3): End Site offsets of leaf joints.
         save_positions (bool): Whether to save all of joint positions on MOTION. (False is recommended.)
     """
     
@@ -0,0 +1,97 @@
+import json
+import struct
+
+import numpy as np
+
+from convert import mesh_io
+
+# -----------------------------------------------------------------------------
+# Binary glTF 2.0 (GLB) writer
+# -----------------------------------------------------------------------------
+# One node/mesh per person. Meshes that share the same face array (every MHR body does)
+# also share a single index accessor, so the buffer holds the topology only once.
+
+GLB_MAGIC = 0x46546C67 # "glTF"
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+FLOAT = 5126
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+TRIANGLES = 4
+
+def _pad(data, fill=b'\x00'):
+    return data + fill * (-len(data) % 4)
+
+class _Builder:
+    def __init__(self):
+        self.bin = bytearray()
+        self.views = []
+        self.accessors = []
+
+    def add(self, array, component, type_, target, minmax=False):
+        offset = len(self.bin)
+        data = np.ascontiguousarray(array).tobytes()
+        self.bin += _pad(data)
+        self.views.append({"buffer": 0, "byteOffset": offset, "byteLength": len(data), "target": target})
+        acc = {"bufferView": len(self.views) - 1, "componentType": component, "count": int(len(array) if array.ndim > 1 else array.size), "type": type_}
+        if minmax:
+            acc["min"] = array.min(axis=0).tolist()
+            acc["max"] = array.max(axis=0).tolist()
+        self.accessors.append(acc)
+        return len(self.accessors) - 1
+
+def write_glb(filename, meshes, normals=True, mhr_space=True):
+    """ Save several triangle meshes as one binary glTF scene.
+
+    Args:
+        filename (str): Output path.
+        meshes (list): [(name, vertices (vnum, 3), faces (fnum, 3) or topology.Topology), ...]
+        normals (bool): Also write per-vertex normals.
+        mhr_space (bool): Vertices are MHR camera space and are converted to Y-up.
+    """
+    b = _Builder()
+    shared = [] # [(faces, accessor)]
+    gl_meshes, nodes = [], []
+
+    for name, vertices, faces in meshes:
+        v = mesh_io.mhr_to_y_up(vertices) if mhr_space else np.asarray(vertices, dtype=np.float64)
+        if len(v) == 0: continue
+
+        f, normals_fn = mesh_io.resolve_faces(faces, len(v))
+        idx = None
+        for f_ref, acc in shared:
+            if f_ref is faces or (np.shape(f_ref) == np.shape(faces) and np.array_equal(f_ref, faces)):
+                idx = acc; break
+        if idx is None:
+            dtype, comp = (np.uint16, UNSIGNED_SHORT) if len(v) < 65536 else (np.uint32, UNSIGNED_INT)
+            idx = b.add(f.astype(dtype).ravel(), comp, "SCALAR", ELEMENT_ARRAY_BUFFER)
+            shared.append((faces, idx))
+
+        attributes = {"POSITION": b.add(v.astype(np.float32), FLOAT, "VEC3", ARRAY_BUFFER, minmax=True)}
+        if normals:
+            attributes["NORMAL"] = b.add(normals_fn(v).astype(np.float32), FLOAT, "VEC3", ARRAY_BUFFER)
+
+        gl_meshes.append({"name": f"{name}_Mesh", "primitives": [{"attributes": attributes, "indices": idx, "mode": TRIANGLES}]})
+        nodes.append({"name": name, "mesh": len(gl_meshes) - 1})
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "SAM 3D Pose Analyzer"},
+        "scene": 0,
+        "scenes": [{"nodes": list(range(len(nodes)))}],
+        "nodes": nodes,
+        "meshes": gl_meshes,
+        "accessors": b.accessors,
+        "bufferViews": b.views,
+        "buffers": [{"byteLength": len(b.bin)}],
+    }
+    json_chunk = _pad(json.dumps(gltf, separators=(',', ':')).encode('utf-8'), b' ')
+    bin_chunk = bytes(b.bin)
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+
+    with open(filename, 'wb') as fp:
+        fp.write(struct.pack('<III', GLB_MAGIC, 2, total))
+        fp.write(struct.pack('<II', len(json_chunk), CHUNK_JSON)); fp.write(json_chunk)
+        fp.write(struct.pack('<II', len(bin_chunk), CHUNK_BIN)); fp.write(bin_chunk)
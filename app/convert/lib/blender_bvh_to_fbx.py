@@ -0,0 +1,48 @@
+import bpy
+import os
+import sys
+
+def convert_bvh_to_fbx(bvh_path, export_path):
+    """
+    Imports an animated BVH (standard Y-up variant written by convert/mhr_bvh.py)
+    and exports it as an FBX with the baked animation.
+    """
+    print(f"Converting animated BVH to FBX...")
+    print(f"Source: {bvh_path}")
+    print(f"Target: {export_path}")
+
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    if not os.path.exists(bvh_path):
+        print(f"Error: {bvh_path} not found.")
+        return
+
+    bpy.ops.import_anim.bvh(filepath=bvh_path, axis_forward='-Z', axis_up='Y', update_scene_fps=True, update_scene_duration=True)
+
+    rig = next((obj for obj in bpy.data.objects if obj.type == 'ARMATURE'), None)
+    if not rig:
+        print("Error: No Armature found in BVH.")
+        return
+
+    bpy.ops.object.select_all(action='DESELECT')
+    rig.select_set(True)
+    bpy.context.view_layer.objects.active = rig
+
+    bpy.ops.export_scene.fbx(
+        filepath=export_path,
+        use_selection=True,
+        add_leaf_bones=False,
+        axis_forward='-Z',
+        axis_up='Y',
+        bake_anim=True,
+        bake_anim_use_all_actions=False,
+        bake_anim_use_nla_strips=False,
+        bake_anim_simplify_factor=0.0
+    )
+    print(f"FBX Success: {export_path}")
+
+if __name__ == "__main__":
+    args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if len(args) < 2:
+        print("Usage: blender --background --python script.py -- input.bvh output.fbx")
+        sys.exit(1)
+    convert_bvh_to_fbx(args[0], args[1])
@@ -0,0 +1,160 @@
+import bpy
+import os
+import sys
+import json
+import time
+import glob
+import traceback
+
+# The lib scripts are imported as modules so that every export runs inside this one warm interpreter.
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+if LIB_DIR not in sys.path:
+    sys.path.insert(0, LIB_DIR)
+
+import blender_humanoid_builder_v2
+import blender_bvh_crysta
+import blender_bvh_to_fbx
+import blender_obj_export
+import blender_scene_combiner
+import mhr_payload
+
+HEARTBEAT_FILE = "server.heartbeat"
+POLL_INTERVAL = 0.2
+
+# ------------------------------------------------------------------------
+# TASKS
+# ------------------------------------------------------------------------
+def task_fbx(task):
+    data = mhr_payload.load(task["input"])
+    blender_humanoid_builder_v2.create_and_export_fbx_final(data, task["output"])
+
+def task_bvh(task):
+    blender_bvh_crysta.convert_fbx_to_bvh_crysta(task["input"], task["output"], task.get("mode", "std"))
+
+def task_bvh_fbx(task):
+    blender_bvh_to_fbx.convert_bvh_to_fbx(task["input"], task["output"])
+
+def task_obj(task):
+    blender_obj_export.export_static_obj(task["input"], task["output"])
+
+def task_glb(task):
+    blender_scene_combiner.combine_and_export_glb(task["inputs"], task["output"])
+
+TASKS = {
+    "fbx": task_fbx,
+    "bvh": task_bvh,
+    "bvh_fbx": task_bvh_fbx,
+    "obj": task_obj,
+    "glb": task_glb,
+}
+
+def run_manifest(manifest, on_task=None):
+    """
+    Runs the tasks of a manifest in order and returns a result dict.
+    Manifest: {"job_id": str, "tasks": [{"id", "op", "input"/"inputs", "output", "after": [ids]}, ...]}
+    A task is skipped if one of its "after" dependencies did not succeed.
+    on_task(task) is called before each task (the server uses it to keep its heartbeat fresh).
+    """
+    results = []
+    succeeded = set()
+    for task in manifest.get("tasks", []):
+        if on_task: on_task(task)
+        t0 = time.time()
+        res = {"id": task.get("id"), "op": task.get("op"), "output": task.get("output")}
+        missing = [d for d in task.get("after", []) if d not in succeeded]
+        if missing:
+            res.update(status="skipped", error=f"dependency failed: {missing}")
+        elif task.get("op") not in TASKS:
+            res.update(status="failed", error=f"unknown op: {task.get('op')}")
+        else:
+            try:
+                TASKS[task["op"]](task)
+                ok = os.path.exists(task["output"])
+                res.update(status="ok" if ok else "failed", error=None if ok else "output not written")
+            except BaseException as e:
+                # builder scripts may call sys.exit() on bad input; keep the server alive
+                traceback.print_exc()
+                res.update(status="failed", error=f"{type(e).__name__}: {e}")
+        res["seconds"] = round(time.time() - t0, 3)
+        if res["status"] == "ok": succeeded.add(task.get("id"))
+        results.append(res)
+        print(f"[{res['status'].upper()}] {res['op']} -> {res['output']} ({res['seconds']}s)")
+    return {"job_id": manifest.get("job_id"), "tasks": results}
+
+def write_json_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f: json.dump(data, f)
+    os.replace(tmp, path)
+
+# ------------------------------------------------------------------------
+# SPOOL SERVER
+# ------------------------------------------------------------------------
+def serve(spool_dir):
+    """
+    Watches spool_dir for <job>.json manifests, runs them and writes <job>.result.json.
+    A heartbeat file lets clients detect whether the server is alive. It is refreshed between
+    manifests and before every task, and names the job being run ("busy") so that clients keep
+    waiting instead of re-running the same outputs in a one-shot Blender.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    print(f"Blender export server watching: {spool_dir}")
+    heartbeat = os.path.join(spool_dir, HEARTBEAT_FILE)
+
+    def beat(busy=None):
+        write_json_atomic(heartbeat, {"pid": os.getpid(), "time": time.time(), "busy": busy})
+
+    # Manifests left running by a previous server that died: answer them so their clients stop waiting
+    for running_path in glob.glob(os.path.join(spool_dir, "*.running")):
+        result_path = running_path[:-len(".running")] + ".result.json"
+        error = "export server restarted while running this manifest"
+        try:
+            with open(running_path, 'r') as f: manifest = json.load(f)
+        except Exception:
+            manifest = {}
+        failed = [{"id": t.get("id"), "op": t.get("op"), "output": t.get("output"), "status": "failed", "error": error, "seconds": 0.0} for t in manifest.get("tasks", [])]
+        write_json_atomic(result_path, {"job_id": manifest.get("job_id"), "tasks": failed, "error": error})
+        os.remove(running_path)
+
+    last_beat = 0
+    while True:
+        if time.time() - last_beat > 1.0:
+            beat()
+            last_beat = time.time()
+
+        pending = sorted(p for p in glob.glob(os.path.join(spool_dir, "*.json")) if not p.endswith(".result.json"))
+        if not pending:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        for manifest_path in pending:
+            running_path = manifest_path[:-len(".json")] + ".running"
+            try:
+                os.replace(manifest_path, running_path)
+            except OSError:
+                continue
+            result_path = manifest_path[:-len(".json")] + ".result.json"
+            try:
+                with open(running_path, 'r') as f: manifest = json.load(f)
+                job = os.path.basename(running_path)[:-len(".running")]
+                beat(job)
+                result = run_manifest(manifest, on_task=lambda task: beat(job))
+            except Exception as e:
+                traceback.print_exc()
+                result = {"job_id": None, "tasks": [], "error": str(e)}
+            write_json_atomic(result_path, result)
+            os.remove(running_path)
+            beat()
+            last_beat = time.time()
+
+if __name__ == "__main__":
+    # blender --background --python blender_export_server.py -- <spool_dir>
+    # blender --background --python blender_export_server.py -- --manifest <manifest.json> <result.json>  (one-shot)
+    args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if len(args) >= 3 and args[0] == "--manifest":
+        with open(args[1], 'r') as f: manifest = json.load(f)
+        write_json_atomic(args[2], run_manifest(manifest))
+    elif len(args) >= 1:
+        serve(args[0])
+    else:
+        print("Usage: blender --background --python blender_export_server.py -- <spool_dir>")
+        sys.exit(1)
@@ -19,6 +19,18 @@ except ImportError:
         raise
 from mathutils import Vector
 
+def add_triangles(mesh_data, faces):
+    """Appends (F, 3) triangles to a mesh straight from the index array (no per-face Python lists)."""
+    tris = np.ascontiguousarray(faces, dtype=np.int32).reshape(-1)
+    n = len(tris) // 3
+    mesh_data.loops.add(len(tris))
+    mesh_data.polygons.add(n)
+    mesh_data.loops.foreach_set("vertex_index", tris)
+    mesh_data.polygons.foreach_set("loop_start", np.arange(0, len(tris), 3, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # loop_total is derived from loop_start (read-only) since Blender 4.0
+        mesh_data.polygons.foreach_set("loop_total", np.full(n, 3, dtype=np.int32))
+
 def create_and_export_fbx_final(data, export_path):
     print(f"Starting Blender Humanoid Builder V2... Output: {export_path}")
     
@@ -33,7 +45,7 @@ def create_and_export_fbx_final(data, export_path):
 
     j_u = data.get("joints_mhr70", [])
     # Fallback if joints_mhr70 is inside 'pred_keypoints_3d'
-    if not j_u and "pred_keypoints_3d" in data:
+    if len(j_u) == 0 and "pred_keypoints_3d" in data:
         j_u = data["pred_keypoints_3d"]
         
     verts = data.get("vertices", data.get("pred_vertices", []))
@@ -55,16 +67,22 @@ def create_and_export_fbx_final(data, export_path):
         # Convert Verts
         mesh_verts = [fix_c(v) for v in verts]
         
-        # Validate Faces relative to Verts count
-        num_verts = len(mesh_verts)
-        valid_faces = []
-        if len(faces) > 0:
-            for f in faces:
-                if max(f) < num_verts:
-                    valid_faces.append(f)
-        
-        mesh_data.from_pydata(mesh_verts, [], valid_faces)
-        mesh_data.update()
+        if "faces" in data.get("refs", ()):
+            # Faces from the shared topology cache were filtered against this vertex count
+            # when the cache was built: hand them to Blender as-is.
+            mesh_data.from_pydata(mesh_verts, [], [])
+            add_triangles(mesh_data, faces)
+            mesh_data.update(calc_edges=True)
+        else:
+            # Validate Faces relative to Verts count
+            num_verts = len(mesh_verts)
+            valid_faces = []
+            if len(faces) > 0:
+                # numpy payload (mhr_payload) or JSON lists
+                f_arr = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+                valid_faces = f_arr[f_arr.max(axis=1) < num_verts].tolist()
+            mesh_data.from_pydata(mesh_verts, [], valid_faces)
+            mesh_data.update()
         
         # Auto Weights later or manual weights?
         # blender_app.py uses 'weights' from data if available.
@@ -255,7 +273,7 @@ def create_and_export_fbx_final(data, export_path):
     print(f"FBX Success: {export_path}")
 
 if __name__ == "__main__":
-    # Args: -- input_json output_fbx
+    # Args: -- input_payload output_fbx  (.mhrb or legacy .json)
     # We expect raw arguments or standard sys.argv
     # Let's robustly find args
     args = []
@@ -269,5 +287,7 @@ if __name__ == "__main__":
     rp_path = args[0]
     out_path = args[1]
     
-    with open(rp_path,'r') as f: data = json.load(f)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mhr_payload
+    data = mhr_payload.load(rp_path)
     create_and_export_fbx_final(data, out_path)
@@ -0,0 +1,35 @@
+import bpy
+import os
+import sys
+try:
+    import numpy as np
+except ImportError:
+    for p in ["/usr/local/lib/python3.10/dist-packages", "/usr/local/lib/python3.11/dist-packages", "/usr/local/lib/python3.12/dist-packages", "/usr/lib/python3/dist-packages"]:
+        if os.path.exists(p) and p not in sys.path:
+            sys.path.append(p)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mhr_payload
+
+def export_static_obj(json_path, export_path):
+    # Blender 3.0.x (Colab) and 3.2+ (latest) are both supported
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    d = mhr_payload.load(json_path)
+    m = bpy.data.meshes.new('Mesh')
+    o = bpy.data.objects.new('Mesh', m)
+    bpy.context.collection.objects.link(o)
+    # MHR (x, y, z) -> Blender (x, z, -y)
+    m.from_pydata([(v[0], v[2], -v[1]) for v in d['vertices']], [], [list(f) for f in d['faces']])
+    bpy.context.view_layer.objects.active = o
+    o.select_set(True)
+    try:
+        bpy.ops.wm.obj_export(filepath=export_path, export_selected_objects=True)
+    except (AttributeError, RuntimeError):
+        bpy.ops.export_scene.obj(filepath=export_path, use_selection=True)
+    print(f"OBJ exported: {export_path}")
+
+if __name__ == "__main__":
+    args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if len(args) < 2:
+        print("Usage: blender --background --python script.py -- input.json output.obj")
+        sys.exit(1)
+    export_static_obj(args[0], args[1])
@@ -14,6 +14,8 @@ except ImportError:
     except ImportError:
         pass
 from mathutils import Vector
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mhr_payload
 
 def combine_and_export_glb(json_paths, export_path):
     print(f"Combining {len(json_paths)} persons into one GLB...")
@@ -28,8 +30,7 @@ def combine_and_export_glb(json_paths, export_path):
 
     for i, path in enumerate(json_paths):
         if not os.path.exists(path): continue
-        with open(path, 'r') as f:
-            data = json.load(f)
+        data = mhr_payload.load(path)
         
         verts = data.get("vertices", data.get("pred_vertices", []))
         faces = data.get("faces", [])
@@ -41,7 +42,7 @@ def combine_and_export_glb(json_paths, export_path):
         bpy.context.collection.objects.link(mesh_obj)
         
         mesh_verts = [fix_c(v) for v in verts]
-        mesh_data.from_pydata(mesh_verts, [], faces)
+        mesh_data.from_pydata(mesh_verts, [], [list(f) for f in faces])
         mesh_data.update()
 
     # Export as GLB
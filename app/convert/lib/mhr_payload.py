@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import struct
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# -----------------------------------------------------------------------------
+# Worker -> Blender interchange
+# -----------------------------------------------------------------------------
+# Raw little-endian arrays behind a small JSON header, so the Blender scripts can map
+# the vertices/faces/joints with numpy instead of parsing tens of MB of JSON text.
+#
+#   b"MHRB" | uint32 version | uint32 header length | JSON header | padding | array data
+#   header: {"arrays": {name: {"dtype": "<f4", "shape": [...], "offset": bytes from the data start}}}
+#   the array data starts at the first 16-byte boundary after the header
+#   optional "refs": {name: path of a shared .npy} (e.g. faces from the topology cache)
+#
+# Files that do not start with the magic (tjson_*.json) are read as JSON.
+
+MAGIC = b"MHRB"
+VERSION = 1
+ALIGN = 16
+EXT = ".mhrb"
+
+def _aligned(n):
+    return n + (-n % ALIGN)
+
+def save(path, arrays, refs=None):
+    """
+    Writes {name: array} as an MHRB payload (float arrays as <f4, integer arrays as <i4).
+    refs maps further names to shared .npy files that are referenced instead of copied.
+    """
+    specs, blobs, offset = {}, [], 0
+    for name, a in arrays.items():
+        a = np.asarray(a)
+        a = a.astype('<i4') if np.issubdtype(a.dtype, np.integer) else a.astype('<f4')
+        data = np.ascontiguousarray(a).tobytes()
+        specs[name] = {"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}
+        blobs.append(data)
+        offset = _aligned(offset + len(data))
+    header = json.dumps({"arrays": specs, "refs": refs or {}}).encode('utf-8')
+
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+        base = _aligned(f.tell())
+        for spec, data in zip(specs.values(), blobs):
+            f.write(b'\x00' * (base + spec["offset"] - f.tell()))
+            f.write(data)
+    os.replace(tmp, path)
+    return path
+
+def _read_header(f):
+    magic = f.read(4)
+    if magic != MAGIC: return None
+    version, hlen = struct.unpack('<II', f.read(8))
+    if version > VERSION:
+        raise ValueError(f"unsupported payload version: {version}")
+    header = json.loads(f.read(hlen).decode('utf-8'))
+    base = _aligned(12 + hlen)
+    for spec in header["arrays"].values(): spec["offset"] += base
+    return header
+
+def load(path, mmap=True):
+    """
+    Reads a payload written by save() (or a legacy JSON file) into a dict.
+    With numpy the arrays are memory-mapped (read-only); without it they become nested lists.
+    "refs" lists the names that were read from shared .npy files.
+    """
+    with open(path, 'rb') as f:
+        header = _read_header(f)
+    if header is None:
+        with open(path, 'r') as f: return json.load(f)
+
+    out = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        if np is not None:
+            count = int(np.prod(shape)) if shape else 1
+            if mmap and count:
+                out[name] = np.memmap(path, dtype=spec["dtype"], mode='r', offset=spec["offset"], shape=shape)
+            else:
+                with open(path, 'rb') as f:
+                    f.seek(spec["offset"])
+                    out[name] = np.frombuffer(f.read(count * np.dtype(spec["dtype"]).itemsize), dtype=spec["dtype"]).reshape(shape)
+        else:
+            out[name] = _load_list(path, spec)
+    for name, ref in header.get("refs", {}).items():
+        out[name] = np.load(ref, mmap_mode='r' if mmap else None) if np is not None else _load_npy_list(ref)
+    # names read from shared files (faces from the topology cache are already validated for this vertex count)
+    out["refs"] = sorted(header.get("refs", {}))
+    return out
+
+def _load_npy_list(path):
+    # minimal .npy reader for Blender builds without numpy (little-endian <i4/<f4, C order)
+    import ast
+    with open(path, 'rb') as f:
+        f.seek(6); major = f.read(2)[0]
+        hlen = struct.unpack('<H' if major == 1 else '<I', f.read(2 if major == 1 else 4))[0]
+        h = ast.literal_eval(f.read(hlen).decode('latin1'))
+        offset = f.tell()
+    return _load_list(path, {"dtype": h["descr"], "shape": list(h["shape"]), "offset": offset})
+
+def _load_list(path, spec):
+    import array
+    code = 'i' if spec["dtype"].endswith('i4') else 'f'
+    shape = spec["shape"]
+    count = 1
+    for s in shape: count *= s
+    flat = array.array(code)
+    with open(path, 'rb') as f:
+        f.seek(spec["offset"])
+        flat.frombytes(f.read(count * 4))
+    if sys.byteorder != 'little': flat.byteswap()
+    flat = flat.tolist()
+    for s in reversed(shape[1:]):
+        flat = [flat[i:i + s] for i in range(0, len(flat), s)]
+    return flat
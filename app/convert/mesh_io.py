@@ -0,0 +1,98 @@
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# AXIS CONVERSION
+# -----------------------------------------------------------------------------
+# MHR output is in camera space (x right, y down, z forward).
+# Blender scenes use (x, z, -y), and Blender's OBJ/glTF exporters then write Y-up files,
+# i.e. (x, -y, -z) in MHR terms. The writers below produce that Y-up layout directly.
+
+def mhr_to_blender(points):
+    """MHR (x, y, z) -> Blender (x, z, -y)"""
+    p = np.asarray(points, dtype=np.float64)
+    return np.stack([p[..., 0], p[..., 2], -p[..., 1]], axis=-1)
+
+def mhr_to_y_up(points):
+    """MHR (x, y, z) -> Y-up file space (x, -y, -z), as written by Blender's OBJ/glTF exporters"""
+    p = np.asarray(points, dtype=np.float64)
+    return np.stack([p[..., 0], -p[..., 1], -p[..., 2]], axis=-1)
+
+# -----------------------------------------------------------------------------
+# TOPOLOGY HELPERS
+# -----------------------------------------------------------------------------
+def valid_faces(faces, num_verts):
+    """Drops faces that reference vertices outside [0, num_verts)."""
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    keep = (faces.min(axis=1) >= 0) & (faces.max(axis=1) < num_verts)
+    return faces[keep]
+
+def vertex_normals(vertices, faces):
+    """Area-weighted per-vertex normals (unit length, zero for isolated vertices)."""
+    v = np.asarray(vertices, dtype=np.float64)
+    f = np.asarray(faces, dtype=np.int64)
+    fn = np.cross(v[f[:, 1]] - v[f[:, 0]], v[f[:, 2]] - v[f[:, 0]])
+    vn = np.zeros_like(v)
+    for k in range(3):
+        np.add.at(vn, f[:, k], fn)
+    norm = np.linalg.norm(vn, axis=1, keepdims=True)
+    return np.divide(vn, norm, out=np.zeros_like(vn), where=norm > 1e-12)
+
+def resolve_faces(faces, num_verts):
+    """faces may be a face array or a cached convert.topology.Topology (already validated)."""
+    if hasattr(faces, "vertex_normals"):
+        return faces.faces, faces.vertex_normals
+    f = valid_faces(faces, num_verts)
+    return f, lambda v: vertex_normals(v, f)
+
+# -----------------------------------------------------------------------------
+# WRITERS
+# -----------------------------------------------------------------------------
+def write_obj(filename, vertices, faces, normals=True, mhr_space=True):
+    """ Save a triangle mesh as Wavefront OBJ.
+
+    Args:
+        filename (str): Output path.
+        vertices (np.ndarray)(vnum, 3): Vertex positions.
+        faces (np.ndarray)(fnum, 3): Triangle indices (0-based), or a topology.Topology.
+        normals (bool): Also write per-vertex normals (vn).
+        mhr_space (bool): Vertices are MHR camera space and are converted to Y-up.
+    """
+    v = mhr_to_y_up(vertices) if mhr_space else np.asarray(vertices, dtype=np.float64)
+    f, normals_fn = resolve_faces(faces, len(v))
+    f = f + 1
+
+    parts = ["# SAM 3D Pose Analyzer\n", "o Mesh\n"]
+    parts.append(("v %.6f %.6f %.6f\n" * len(v)) % tuple(v.ravel()))
+    if normals:
+        vn = normals_fn(v)
+        parts.append(("vn %.4f %.4f %.4f\n" * len(vn)) % tuple(vn.ravel()))
+        ff = np.repeat(f, 2, axis=1)
+        parts.append(("f %d//%d %d//%d %d//%d\n" * len(f)) % tuple(ff.ravel()))
+    else:
+        parts.append(("f %d %d %d\n" * len(f)) % tuple(f.ravel()))
+
+    with open(filename, 'w') as fp:
+        fp.write("".join(parts))
+
+def write_ply(filename, vertices, faces, mhr_space=True):
+    """ Save a triangle mesh as binary little-endian PLY (float32 positions, int32 indices). """
+    v = (mhr_to_y_up(vertices) if mhr_space else np.asarray(vertices)).astype('<f4')
+    f, _ = resolve_faces(faces, len(v))
+
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {len(v)}\n"
+        "property float x\nproperty float y\nproperty float z\n"
+        f"element face {len(f)}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
+    face_rec = np.empty(len(f), dtype=[('n', 'u1'), ('idx', '<i4', (3,))])
+    face_rec['n'] = 3
+    face_rec['idx'] = f
+
+    with open(filename, 'wb') as fp:
+        fp.write(header.encode('ascii'))
+        fp.write(np.ascontiguousarray(v).tobytes())
+        fp.write(face_rec.tobytes())
@@ -0,0 +1,266 @@
+import numpy as np
+
+from convert import bvh
+from convert import rotations
+from convert.generate_generic_model import HIERARCHY
+
+# -----------------------------------------------------------------------------
+# Blender-free MHR -> BVH (Clip Studio Paint compatible)
+# -----------------------------------------------------------------------------
+# The skeleton follows the Unity humanoid HIERARCHY. Joint positions are taken from
+# pred_keypoints_3d (MHR70) with the same rules as lib/blender_humanoid_builder_v2.py,
+# so the result matches the former FBX -> BVH path through Blender:
+#   "std"      : Blender rig rotated Euler X=-90      -> Y-up, (x, -y, -z) of MHR
+#   "inverted" : Blender rig rotated quat (1,1,0,0)   -> raw MHR axes (x, y, z)
+
+JOINT_NAMES = list(HIERARCHY)
+PARENTS = np.array([JOINT_NAMES.index(HIERARCHY[n]) if HIERARCHY[n] else -1 for n in JOINT_NAMES], dtype=int)
+CHILDREN = [[c for c in range(len(JOINT_NAMES)) if PARENTS[c] == j] for j in range(len(JOINT_NAMES))]
+
+VARIANTS = {
+    "std": np.diag([1.0, -1.0, -1.0]),
+    "inverted": np.eye(3),
+}
+
+# MHR70 keypoint indices (same as the FBX builder)
+_FINGERS = {
+    "Left": (62, {"Thumb": [45, 44, 43, 42], "Index": [49, 48, 47, 46], "Middle": [53, 52, 51, 50], "Ring": [57, 56, 55, 54], "Little": [61, 60, 59, 58]}),
+    "Right": (41, {"Thumb": [24, 23, 22, 21], "Index": [28, 27, 26, 25], "Middle": [32, 31, 30, 29], "Ring": [36, 35, 34, 33], "Little": [40, 39, 38, 37]}),
+}
+HEAD_TOP_VERTEX = 2811
+
+def unity_joint_positions(keypoints_3d, vertices=None, head_top=None):
+    """Computes Unity humanoid joint heads from MHR70 keypoints.
+
+    Args:
+        keypoints_3d (np.ndarray)(fnum, 70, 3) or (70, 3): pred_keypoints_3d in MHR camera space.
+        vertices (np.ndarray)(fnum, vnum, 3) or (vnum, 3): pred_vertices, used for the head top (optional).
+        head_top (np.ndarray)(fnum, 3) or (3,): The head top vertex itself, if the full mesh is not kept (optional).
+
+    Returns:
+        tuple: heads (np.ndarray)(fnum, jnum, 3) and end vectors (np.ndarray)(fnum, jnum, 3)
+            (tail - head of the leaf bones, zero elsewhere), both in MHR space.
+    """
+    kp = np.asarray(keypoints_3d, dtype=np.float64)
+    if kp.ndim == 2: kp = kp[None]
+    kp = np.nan_to_num(kp)
+    J = lambda i: kp[:, i]
+    mid = lambda a, b: (kp[:, a] + kp[:, b]) / 2
+    unit = rotations.normalize
+
+    hips = mid(9, 10)
+    neck = J(69)
+    head_base = mid(3, 4)
+    spine0 = hips + (neck - hips) * 0.35
+    spine1 = hips + (neck - hips) * 0.65
+    body_dir = unit(neck - spine1)
+
+    # Head orientation: crown vertex, flipped if it points against the body
+    if head_top is not None:
+        head_top = np.asarray(head_top, dtype=np.float64).reshape(-1, 3)
+    elif vertices is not None:
+        verts = np.asarray(vertices, dtype=np.float64)
+        if verts.ndim == 2: verts = verts[None]
+        head_top = verts[:, HEAD_TOP_VERTEX]
+    else:
+        head_top = head_base + body_dir * 0.15
+    up = unit(head_top - head_base)
+    flip = np.sum(up * body_dir, axis=-1, keepdims=True) < 0
+    up = np.where(flip, -up, up)
+    head_top = np.where(flip, head_base + up * 0.15, head_top)
+
+    hips_tail = hips + unit(spine0 - hips) * 0.1
+
+    l_toe_t, r_toe_t = mid(15, 16), mid(18, 19)
+    l_f_end = J(13) + (l_toe_t - J(13)) * 0.5
+    r_f_end = J(14) + (r_toe_t - J(14)) * 0.5
+
+    heads = {
+        "Hips": hips, "Spine": hips_tail, "Chest": spine0, "UpperChest": spine1,
+        "Neck": neck, "Head": head_base, "Head_end": head_top,
+        "LeftShoulder": (neck + J(5)) / 2, "LeftUpperArm": J(5), "LeftLowerArm": J(7), "LeftHand": J(62),
+        "RightShoulder": (neck + J(6)) / 2, "RightUpperArm": J(6), "RightLowerArm": J(8), "RightHand": J(41),
+        "LeftUpperLeg": J(9), "LeftLowerLeg": J(11), "LeftFoot": J(13), "LeftToes": l_f_end, "LeftToes_end": l_toe_t,
+        "RightUpperLeg": J(10), "RightLowerLeg": J(12), "RightFoot": J(14), "RightToes": r_f_end, "RightToes_end": r_toe_t,
+    }
+    for side, (_, fingers) in _FINGERS.items():
+        for finger, idx in fingers.items():
+            for part, i in zip(["Proximal", "Intermediate", "Distal", "Distal_end"], idx):
+                heads[f"{side}{finger}{part}"] = J(i)
+
+    ends = {"Head_end": up * 0.05}
+    for side, toe_t, f_end in [("Left", l_toe_t, l_f_end), ("Right", r_toe_t, r_f_end)]:
+        d = toe_t - f_end
+        fallback = np.array([0.0, 0.0, 0.02]) # Blender (0, 0.02, 0)
+        ends[f"{side}Toes_end"] = np.where(np.linalg.norm(d, axis=-1, keepdims=True) > 1e-6, unit(d) * 0.02, fallback)
+
+    H = np.stack([heads[n] for n in JOINT_NAMES], axis=1)
+    E = np.zeros_like(H)
+    for n, v in ends.items():
+        E[:, JOINT_NAMES.index(n)] = v
+    return H, E
+
+def global_rotations(positions, rest):
+    """Per-frame global joint rotations that move the rest skeleton onto positions.
+
+    Joints with several children are fitted to all child directions (Kabsch),
+    joints with one child get the minimal swing on top of their parent's rotation,
+    leaves inherit their parent's rotation.
+
+    Args:
+        positions (np.ndarray)(fnum, jnum, 3): Joint heads.
+        rest (np.ndarray)(jnum, 3): Joint heads of the rest pose.
+
+    Returns:
+        np.ndarray (fnum, jnum, 3, 3)
+    """
+    F = positions.shape[0]
+    G = np.zeros((F, len(JOINT_NAMES), 3, 3))
+    eye = np.broadcast_to(np.eye(3), (F, 3, 3))
+    for j in range(len(JOINT_NAMES)):
+        Gp = G[:, PARENTS[j]] if PARENTS[j] >= 0 else eye
+        ch = CHILDREN[j]
+        if len(ch) >= 2:
+            src = np.broadcast_to(rest[ch] - rest[j], (F, len(ch), 3))
+            dst = positions[:, ch] - positions[:, j, None]
+            G[:, j] = rotations.kabsch(src, dst)
+        elif len(ch) == 1:
+            a = (Gp @ (rest[ch[0]] - rest[j]))
+            b = positions[:, ch[0]] - positions[:, j]
+            G[:, j] = rotations.between(a, b) @ Gp
+        else:
+            G[:, j] = Gp
+    return G
+
+def interpolate_keyframes(local_rots, root, frames, until=None):
+    """Densifies keyframed local rotations (SLERP) and root positions (linear).
+
+    Args:
+        local_rots (np.ndarray)(knum, jnum, 3, 3): Local rotations at the keyframes.
+        root (np.ndarray)(knum, 3): Root positions at the keyframes.
+        frames (array-like)(knum,): Increasing frame numbers of the keyframes.
+        until (int): Last frame of the output (the last keyframe is held after it).
+
+    Returns:
+        tuple: local rotations (fnum, jnum, 3, 3) and root positions (fnum, 3) for frames[0]..until.
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    last = frames[-1] if until is None else max(until, frames[-1])
+    full = np.arange(frames[0], last + 1)
+    if len(frames) == 1:
+        return np.repeat(local_rots, len(full), axis=0), np.repeat(root, len(full), axis=0)
+
+    q = rotations.matrix_to_quat(local_rots)
+    # keep consecutive keyframes on the same hemisphere so SLERP takes the short way
+    for k in range(1, len(q)):
+        q[k] = np.where(np.sum(q[k] * q[k - 1], axis=-1, keepdims=True) < 0, -q[k], q[k])
+
+    seg = np.clip(np.searchsorted(frames, full, side='right') - 1, 0, len(frames) - 2)
+    t = np.clip((full - frames[seg]) / (frames[seg + 1] - frames[seg]), 0.0, 1.0)
+    q_full = rotations.slerp(q[seg], q[seg + 1], t[:, None])
+    root_full = root[seg] + (root[seg + 1] - root[seg]) * t[:, None]
+    return rotations.quat_to_matrix(q_full), root_full
+
+def build_bvh_data(heads, ends, variant="std", frametime=1.0 / 30, order="zxy", rest_frame=0, frames=None, until=None):
+    """Builds the dict expected by bvh.save().
+
+    The rest pose (OFFSETs) is the pose of rest_frame, so a single frame is written with
+    zero rotations exactly like the former Blender export; later frames are expressed as
+    local rotations relative to it.
+
+    Args:
+        heads, ends (np.ndarray)(fnum, jnum, 3): Output of unity_joint_positions().
+        variant (str): "std" or "inverted".
+        frametime (float): Seconds per frame.
+        order (str): Rotation channel order.
+        rest_frame (int): Frame used as the rest pose.
+        frames (array-like): Frame numbers of heads if they are sparse keyframes; the output is
+            then densified with interpolate_keyframes() (optional).
+        until (int): Last output frame when frames is given (optional).
+
+    Returns:
+        dict: rotations, positions, offsets, parents, names, order, frametime, end_offsets
+    """
+    M = VARIANTS[variant]
+    P = heads @ M.T
+    E = ends @ M.T
+    rest = P[rest_frame]
+
+    offsets = rest.copy()
+    offsets[1:] = rest[1:] - rest[PARENTS[1:]]
+
+    G = global_rotations(P, rest)
+    L = G.copy()
+    has_parent = PARENTS >= 0
+    L[:, has_parent] = np.swapaxes(G[:, PARENTS[has_parent]], -1, -2) @ G[:, has_parent]
+
+    root = P[:, 0]
+    if frames is not None:
+        L, root = interpolate_keyframes(L, root, frames, until)
+
+    positions = np.repeat(offsets[None], len(L), axis=0)
+    positions[:, 0] = root
+
+    return {
+        'rotations': rotations.matrix_to_euler(L, order),
+        'positions': positions,
+        'offsets': offsets,
+        'parents': PARENTS,
+        'names': JOINT_NAMES,
+        'order': order,
+        'frametime': frametime,
+        'end_offsets': E[rest_frame],
+    }
+
+def forward_kinematics(data):
+    """Global joint heads (fnum, jnum, 3) of a bvh data dict, in the variant's axes."""
+    L = rotations.euler_to_matrix(data['rotations'], data['order'])
+    F, J = L.shape[:2]
+    G = np.zeros_like(L); X = np.zeros((F, J, 3))
+    for j, p in enumerate(data['parents']):
+        if p < 0:
+            G[:, j] = L[:, j]; X[:, j] = data['positions'][:, j]
+        else:
+            G[:, j] = G[:, p] @ L[:, j]
+            X[:, j] = X[:, p] + G[:, p] @ data['offsets'][j]
+    return X
+
+def keyframe_error(keypoints_3d, frames, ref_keypoints_3d, ref_frames, head_top=None, ref_head_top=None):
+    """Mean joint position error (per reference frame) of the keyframe-interpolated skeleton.
+
+    Args:
+        keypoints_3d, frames: Keyframes as passed to save_variants().
+        ref_keypoints_3d (np.ndarray)(rnum, 70, 3): Fully inferred keypoints at ref_frames.
+        ref_frames (array-like)(rnum,): Frame numbers of the references (within the keyframe range).
+
+    Returns:
+        np.ndarray (rnum,): Mean joint distance, same unit as the keypoints.
+    """
+    heads, ends = unity_joint_positions(keypoints_3d, head_top=head_top)
+    data = build_bvh_data(heads, ends, "inverted", frames=frames, until=max(ref_frames))
+    X = forward_kinematics(data)[np.asarray(ref_frames) - int(frames[0])]
+    ref, _ = unity_joint_positions(ref_keypoints_3d, head_top=ref_head_top)
+    return np.linalg.norm(X - ref, axis=-1).mean(axis=-1)
+
+def save_variants(keypoints_3d, std_path=None, inverted_path=None, vertices=None, frametime=1.0 / 30, order="zxy", head_top=None, frames=None, until=None):
+    """Writes the standard and inverted BVH from one joint computation.
+
+    Args:
+        keypoints_3d (np.ndarray)(fnum, 70, 3) or (70, 3): pred_keypoints_3d (MHR space).
+        std_path (str): Output of the standard (Euler X=-90) variant, skipped if None.
+        inverted_path (str): Output of the inverted (quat_x90) variant, skipped if None.
+        vertices (np.ndarray): pred_vertices for the head top (optional).
+        frametime (float): Seconds per frame.
+        head_top (np.ndarray)(fnum, 3): Head top vertex per frame, instead of vertices (optional).
+        frames, until: Keyframe numbers and last frame, see build_bvh_data() (optional).
+
+    Returns:
+        list: Written paths.
+    """
+    heads, ends = unity_joint_positions(keypoints_3d, vertices, head_top)
+    written = []
+    for path, variant in [(std_path, "std"), (inverted_path, "inverted")]:
+        if not path: continue
+        bvh.save(path, build_bvh_data(heads, ends, variant, frametime, order, frames=frames, until=until))
+        written.append(path)
+    return written
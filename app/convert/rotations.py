@@ -0,0 +1,124 @@
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# Rotation helpers (numpy, batched over leading dimensions)
+# Matrices are (..., 3, 3) and act on column vectors.
+# -----------------------------------------------------------------------------
+
+_AXIS = {'x': 0, 'y': 1, 'z': 2}
+
+def normalize(v, eps=1e-12):
+    n = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, n, out=np.zeros_like(v), where=n > eps)
+
+def axis_angle_to_matrix(axis, angle):
+    """Rodrigues formula. axis (..., 3) unit vectors, angle (...) in radians."""
+    axis = np.asarray(axis, dtype=np.float64)
+    angle = np.asarray(angle, dtype=np.float64)[..., None, None]
+    x, y, z = axis[..., 0], axis[..., 1], axis[..., 2]
+    zeros = np.zeros_like(x)
+    K = np.stack([
+        np.stack([zeros, -z, y], axis=-1),
+        np.stack([z, zeros, -x], axis=-1),
+        np.stack([-y, x, zeros], axis=-1),
+    ], axis=-2)
+    eye = np.broadcast_to(np.eye(3), K.shape)
+    return eye + np.sin(angle) * K + (1 - np.cos(angle)) * (K @ K)
+
+def between(a, b):
+    """Minimal rotation matrices taking directions a to b (..., 3)."""
+    a = normalize(np.asarray(a, dtype=np.float64))
+    b = normalize(np.asarray(b, dtype=np.float64))
+    axis = np.cross(a, b)
+    sin = np.linalg.norm(axis, axis=-1)
+    cos = np.clip(np.sum(a * b, axis=-1), -1.0, 1.0)
+    angle = np.arctan2(sin, cos)
+    axis = normalize(axis)
+
+    # Opposite directions: rotate 180 degrees around any axis perpendicular to a
+    opposite = (sin < 1e-9) & (cos < 0)
+    if np.any(opposite):
+        ref = np.where(np.abs(a[..., :1]) < 0.9, np.array([1.0, 0.0, 0.0]), np.array([0.0, 1.0, 0.0]))
+        axis = np.where(opposite[..., None], normalize(np.cross(a, ref)), axis)
+    return axis_angle_to_matrix(axis, angle)
+
+def kabsch(src, dst, weights=None):
+    """Best-fit rotation R with R @ src_i ~ dst_i. src, dst (..., n, 3)."""
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    if weights is not None:
+        src = src * np.asarray(weights)[..., None]
+    H = np.swapaxes(src, -1, -2) @ dst
+    U, _, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(np.swapaxes(Vt, -1, -2) @ np.swapaxes(U, -1, -2)))
+    D = np.zeros(H.shape)
+    D[..., 0, 0] = 1.0
+    D[..., 1, 1] = 1.0
+    D[..., 2, 2] = np.where(d == 0, 1.0, d)
+    return np.swapaxes(Vt, -1, -2) @ D @ np.swapaxes(U, -1, -2)
+
+def euler_to_matrix(angles, order='zxy', degrees=True):
+    """R = R_order[0](a0) @ R_order[1](a1) @ R_order[2](a2), i.e. BVH channel order."""
+    angles = np.asarray(angles, dtype=np.float64)
+    if degrees: angles = np.deg2rad(angles)
+    R = None
+    for k, ax in enumerate(order):
+        axis = np.zeros(angles.shape[:-1] + (3,))
+        axis[..., _AXIS[ax]] = 1.0
+        Rk = axis_angle_to_matrix(axis, angles[..., k])
+        R = Rk if R is None else R @ Rk
+    return R
+
+def matrix_to_euler(R, order='zxy', degrees=True):
+    """Inverse of euler_to_matrix for Tait-Bryan orders."""
+    R = np.asarray(R, dtype=np.float64)
+    i, j, k = (_AXIS[a] for a in order)
+    # cyclic orders (xyz, yzx, zxy) and their reverses differ only in signs
+    s = 1.0 if (j - i) % 3 == 1 else -1.0
+    a1 = np.arcsin(np.clip(s * R[..., i, k], -1.0, 1.0))
+    a0 = np.arctan2(-s * R[..., j, k], R[..., k, k])
+    a2 = np.arctan2(-s * R[..., i, j], R[..., i, i])
+    out = np.stack([a0, a1, a2], axis=-1)
+    return np.rad2deg(out) if degrees else out
+
+def matrix_to_quat(R):
+    """Rotation matrices (..., 3, 3) -> unit quaternions (..., 4) as (w, x, y, z)."""
+    R = np.asarray(R, dtype=np.float64)
+    m00, m11, m22 = R[..., 0, 0], R[..., 1, 1], R[..., 2, 2]
+    q = np.stack([
+        1 + m00 + m11 + m22,
+        1 + m00 - m11 - m22,
+        1 - m00 + m11 - m22,
+        1 - m00 - m11 + m22,
+    ], axis=-1)
+    # pick the numerically largest component as the pivot
+    k = np.argmax(q, axis=-1)
+    s = np.sqrt(np.maximum(np.take_along_axis(q, k[..., None], axis=-1)[..., 0], 1e-12)) * 2
+    w = np.choose(k, [s / 4, (R[..., 2, 1] - R[..., 1, 2]) / s, (R[..., 0, 2] - R[..., 2, 0]) / s, (R[..., 1, 0] - R[..., 0, 1]) / s])
+    x = np.choose(k, [(R[..., 2, 1] - R[..., 1, 2]) / s, s / 4, (R[..., 0, 1] + R[..., 1, 0]) / s, (R[..., 0, 2] + R[..., 2, 0]) / s])
+    y = np.choose(k, [(R[..., 0, 2] - R[..., 2, 0]) / s, (R[..., 0, 1] + R[..., 1, 0]) / s, s / 4, (R[..., 1, 2] + R[..., 2, 1]) / s])
+    z = np.choose(k, [(R[..., 1, 0] - R[..., 0, 1]) / s, (R[..., 0, 2] + R[..., 2, 0]) / s, (R[..., 1, 2] + R[..., 2, 1]) / s, s / 4])
+    return normalize(np.stack([w, x, y, z], axis=-1))
+
+def quat_to_matrix(q):
+    """Unit quaternions (..., 4) as (w, x, y, z) -> rotation matrices (..., 3, 3)."""
+    w, x, y, z = np.moveaxis(normalize(np.asarray(q, dtype=np.float64)), -1, 0)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+def slerp(q0, q1, t):
+    """Spherical linear interpolation of unit quaternions (..., 4); t broadcasts against (...)."""
+    q0 = np.asarray(q0, dtype=np.float64); q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1); dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin = np.sin(theta)
+    near = sin < 1e-6
+    safe = np.where(near, 1.0, sin)
+    w0 = np.where(near, 1 - t, np.sin((1 - t) * theta) / safe)
+    w1 = np.where(near, t, np.sin(t * theta) / safe)
+    return normalize(w0 * q0 + w1 * q1)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# Shared MHR topology cache
+# -----------------------------------------------------------------------------
+# est.faces is the same for every person and every run. It is validated and expanded
+# (edges, vertex adjacency, vertex -> face incidence) once, stored as .npy files under
+# CACHE_DIR/v<VERSION>_<hash>/ and memory-mapped by every exporter afterwards.
+
+VERSION = 1
+CACHE_DIR = os.environ.get("SAM3D_TOPOLOGY_CACHE", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "topology"))
+_FIELDS = ["faces", "edges", "adj_indptr", "adj_indices", "vf_indptr", "vf_indices"]
+
+_memo = {}
+_lock = threading.Lock()
+
+def topology_key(faces):
+    """Hash of the face array (int32, C order); identifies the MHR model topology."""
+    f = np.ascontiguousarray(np.asarray(faces, dtype=np.int32).reshape(-1, 3))
+    return hashlib.sha1(f.tobytes()).hexdigest()[:16]
+
+class Topology:
+    """Read-only topology arrays of one mesh. All index arrays are int32."""
+
+    def __init__(self, key, num_verts, arrays, path=None):
+        self.key, self.num_verts, self.path = key, num_verts, path
+        for name in _FIELDS: setattr(self, name, arrays[name])
+
+    @property
+    def faces_path(self):
+        return os.path.join(self.path, "faces.npy") if self.path else None
+
+    def neighbors(self, v):
+        return self.adj_indices[self.adj_indptr[v]:self.adj_indptr[v + 1]]
+
+    def vertex_faces(self, v):
+        return self.vf_indices[self.vf_indptr[v]:self.vf_indptr[v + 1]]
+
+    def face_normals(self, vertices):
+        v = np.asarray(vertices, dtype=np.float64)
+        f = self.faces
+        return np.cross(v[f[:, 1]] - v[f[:, 0]], v[f[:, 2]] - v[f[:, 0]])
+
+    def vertex_normals(self, vertices):
+        """Area-weighted unit vertex normals (same result as mesh_io.vertex_normals)."""
+        fn = np.repeat(self.face_normals(vertices), 3, axis=0)
+        corners = self.faces.ravel()
+        vn = np.stack([np.bincount(corners, weights=fn[:, k], minlength=self.num_verts) for k in range(3)], axis=1)
+        norm = np.linalg.norm(vn, axis=1, keepdims=True)
+        return np.divide(vn, norm, out=np.zeros_like(vn), where=norm > 1e-12)
+
+def _csr(rows, cols, n):
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+def build(faces, num_verts=None):
+    """Computes the topology arrays (no caching)."""
+    f = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if num_verts is None: num_verts = int(f.max()) + 1 if len(f) else 0
+    f = f[(f.min(axis=1) >= 0) & (f.max(axis=1) < num_verts)]
+
+    e = np.sort(np.concatenate([f[:, [0, 1]], f[:, [1, 2]], f[:, [2, 0]]]), axis=1)
+    edges = np.unique(e, axis=0)
+    adj_indptr, adj_indices = _csr(np.concatenate([edges[:, 0], edges[:, 1]]), np.concatenate([edges[:, 1], edges[:, 0]]), num_verts)
+    vf_indptr, vf_indices = _csr(f.ravel(), np.repeat(np.arange(len(f)), 3), num_verts)
+
+    return num_verts, {
+        "faces": f.astype(np.int32), "edges": edges.astype(np.int32),
+        "adj_indptr": adj_indptr, "adj_indices": adj_indices,
+        "vf_indptr": vf_indptr, "vf_indices": vf_indices,
+    }
+
+def _load(path, key):
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in _FIELDS}
+    return Topology(key, len(arrays["adj_indptr"]) - 1, arrays, path)
+
+def get(faces, num_verts=None, cache_dir=CACHE_DIR):
+    """
+    Returns the Topology for faces, computing and storing it on first use.
+    Later calls (and later processes) memory-map the stored arrays.
+
+    Args:
+        faces: (F, 3) vertex indices.
+        num_verts: Number of mesh vertices (len(pred_vertices)). Defaults to faces.max() + 1,
+            which is too short when trailing vertices are not referenced by any face.
+    """
+    if num_verts is None:
+        f = np.asarray(faces).reshape(-1, 3)
+        num_verts = int(f.max()) + 1 if len(f) else 0
+    # The vertex count is part of the key: the same faces with extra unreferenced
+    # trailing vertices need longer adjacency / normal arrays.
+    key = f"{topology_key(faces)}_{int(num_verts)}"
+    with _lock:
+        if key in _memo: return _memo[key]
+        path = os.path.join(cache_dir, f"v{VERSION}_{key}")
+        topo = None
+        if os.path.isdir(path):
+            try:
+                topo = _load(path, key)
+            except Exception:
+                shutil.rmtree(path, ignore_errors=True)
+        if topo is None:
+            n, arrays = build(faces, num_verts)
+            try:
+                tmp = f"{path}.tmp{os.getpid()}"
+                os.makedirs(tmp, exist_ok=True)
+                for name, a in arrays.items(): np.save(os.path.join(tmp, f"{name}.npy"), a)
+                os.replace(tmp, path)
+                topo = _load(path, key)
+            except OSError:
+                # read-only / raced with another process: keep the in-memory arrays
+                shutil.rmtree(tmp, ignore_errors=True)
+                topo = _load(path, key) if os.path.isdir(path) else Topology(key, n, arrays)
+        _memo[key] = topo
+        return topo
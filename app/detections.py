@@ -0,0 +1,209 @@
+import os
+import json
+import glob
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import cv2
+import PIL.Image
+import PIL.ImageOps
+
+from masks import CropMask
+
+# ==========================================
+# 🔍 生の検出結果の保存と再フィルタリング
+# ==========================================
+# conf_threshold / box_scale / min_area は検出器の順伝播の後に掛けるだけなので、
+# しきい値を掛ける前の出力 (全 box・score・マスク) を outputs/raw_detections.npz に残しておけば、
+# UI 側でスライダーを動かしたときにモデルを使わずに ID プレビューを作り直せる。
+# vitdet は HumanDetector の中でしきい値と NMS を適用してから box だけを返すため score を持たない。
+# そのため vitdet では conf_threshold / nms_thr の変更は再検出になる (box_scale の拡大も sam3 のみ)。
+
+MAX_INPUT_SIDE = 2048 # OOM回避のための入力画像の長辺の上限 (検出結果の座標はこの縮小後の画像が基準)
+RAW_SCORE_FLOOR = 0.1 # UI の conf_threshold スライダーの最小値。これ未満の検出は保存しない
+RAW_FILE = "raw_detections.npz"
+PREVIEW_MAX_SIDE = int(os.environ.get("SAM3D_PREVIEW_MAX_SIDE", "1024")) # ギャラリー表示用の長辺 (0 で原寸)
+
+def load_input_image(image_path):
+    """
+    画像読み込み (EXIF回転対応 & 自動リサイズ)。
+    ワーカーと UI の再フィルタリングで同じ画像 (同じ解像度) を得るため、torch を使わないこのモジュールに置く。
+    """
+    pil_img = PIL.Image.open(image_path)
+    pil_img = PIL.ImageOps.exif_transpose(pil_img)
+    # OOM回避: 最大2048pxに縮小
+    if max(pil_img.size) > MAX_INPUT_SIDE:
+        print(f"📏 Resizing image from {pil_img.size} to max {MAX_INPUT_SIDE}px...")
+        pil_img.thumbnail((MAX_INPUT_SIDE, MAX_INPUT_SIDE), PIL.Image.LANCZOS)
+
+    # --- ROBUST TRANSPARENCY HANDLING (Force White Background) ---
+    rgba = pil_img.convert("RGBA")
+    canvas = PIL.Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+    # 透過があれば白背景の上に合成、不透明ならそのまま上書きされる
+    pil_img = PIL.Image.alpha_composite(canvas, rgba).convert("RGB")
+    # -------------------------------------------------------------
+
+    return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+
+def score_floor(conf_threshold):
+    return min(RAW_SCORE_FLOOR, float(conf_threshold))
+
+def raw_params(detector_name, text_prompt, conf_threshold, nms_thr):
+    """生の検出結果を左右するパラメータ (これが変わったら再検出が必要)"""
+    if detector_name == "sam3":
+        return {"detector_name": detector_name, "text_prompt": text_prompt, "score_floor": score_floor(conf_threshold)}
+    return {"detector_name": detector_name, "text_prompt": text_prompt, "conf_threshold": float(conf_threshold), "nms_thr": float(nms_thr)}
+
+def file_digest(path):
+    """入力ファイルの内容ハッシュ (UI に残っている画像と生の検出結果の対応確認用)"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def save_raw(path, raw, params, source=None):
+    """raw: {"boxes", "scores" (None 可), "masks" (None 可), "img_shape"}。マスクはビット単位に詰めて保存する"""
+    entry = {"boxes": np.asarray(raw["boxes"], dtype=np.float64).reshape(-1, 4)}
+    if raw.get("scores") is not None: entry["scores"] = np.asarray(raw["scores"], dtype=np.float32)
+    if raw.get("masks") is not None:
+        entry["masks_shape"] = np.array(raw["masks"].shape); entry["masks_packed"] = np.packbits(raw["masks"].astype(bool), axis=-1)
+    meta = {"params": params, "img_shape": [int(x) for x in raw["img_shape"][:2]], "source": source}
+    entry["meta"] = np.array(json.dumps(meta))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f: np.savez(f, **entry)
+    os.replace(tmp, path)
+
+def unpack_raw(data):
+    """save_raw / 検出キャッシュの配列 dict -> raw"""
+    masks = None
+    if "masks_packed" in data:
+        shape = tuple(data["masks_shape"])
+        masks = np.unpackbits(data["masks_packed"], axis=-1, count=shape[-1]).astype(bool).reshape(shape)
+    raw = {"boxes": data["boxes"], "scores": data.get("scores"), "masks": masks}
+    if "meta" in data:
+        meta = json.loads(str(data["meta"]))
+        raw.update(img_shape=tuple(meta["img_shape"]), params=meta["params"], source=meta.get("source"))
+    return raw
+
+def load_raw(path):
+    if not os.path.exists(path): return None
+    try:
+        with np.load(path, allow_pickle=False) as z:
+            return unpack_raw({k: z[k] for k in z.files})
+    except Exception:
+        return None
+
+def enlarge_boxes(boxes, scale, img_shape):
+    """HumanDetector.sam3_run が行う bbox の拡大処理を再現 (中心固定で scale 倍、画像内にクリップ)"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    c = (boxes[:, :2] + boxes[:, 2:]) / 2; half = (boxes[:, 2:] - boxes[:, :2]) * scale / 2
+    lo = np.maximum(c - half, 0); hi = np.minimum(c + half, [img_shape[1], img_shape[0]])
+    return np.concatenate([lo, hi], axis=1)
+
+def refilter(raw, detector_name, conf_threshold, box_scale):
+    """生の検出結果に conf_threshold と box_scale を適用して (boxes, masks) を返す"""
+    boxes, scores, masks = raw["boxes"], raw.get("scores"), raw.get("masks")
+    if scores is not None:
+        keep = scores > conf_threshold
+        boxes = boxes[keep]; masks = masks[keep] if masks is not None else None
+    if detector_name == "sam3":
+        boxes = enlarge_boxes(boxes, box_scale, raw["img_shape"])
+    return boxes, masks
+
+def build_valid_masks(boxes, raw_masks, img_shape, min_area):
+    """min_area を超える bbox を人物として返す。segmentation は CropMask (bbox の範囲だけを保持)"""
+    valid_masks = []
+    for i, box in enumerate(boxes):
+        x1, y1, x2, y2 = map(int, box)
+        area = int((x2 - x1) * (y2 - y1))
+        if area <= min_area: continue # ログ過多によるスタック防止のため、除外ログを抑制
+
+        # マスク生成: SAM3の場合は精密なマスクを使用、それ以外は矩形
+        if raw_masks is not None and i < len(raw_masks):
+            mask = CropMask.from_full(raw_masks[i], img_shape)
+        else:
+            mask = CropMask.from_box(box, img_shape)
+
+        valid_masks.append({
+            'id': int(i),
+            'segmentation': mask,
+            'area': area,
+            'score': 1.0,
+            'bbox': [float(x) for x in box]
+        })
+    return valid_masks
+
+def render_preview(base, dimmed, m, scale):
+    """1人分のプレビュー (縮小済みの画像 base / 減光済み dimmed の上にマスクと ID バーを描く)"""
+    dbg = dimmed.copy()
+    h, w = dbg.shape[:2]
+
+    # 1. 人物の強調 (マスク内だけ元の明るさに戻し、鮮やかなオレンジで縁取る)
+    mask = m['segmentation']
+    ch, cw = mask.crop.shape
+    x0, y0 = int(mask.x0 * scale), int(mask.y0 * scale)
+    sw, sh = min(max(int(round(cw * scale)), 1), w - x0), min(max(int(round(ch * scale)), 1), h - y0)
+    if ch and cw and sw > 0 and sh > 0:
+        crop = mask.crop if scale == 1.0 else cv2.resize(mask.crop.astype(np.uint8), (sw, sh), interpolation=cv2.INTER_NEAREST).astype(bool)
+        crop = crop[:sh, :sw]
+        sl = (slice(y0, y0 + sh), slice(x0, x0 + sw))
+        dbg[sl][crop] = base[sl][crop]
+        # 切り出した範囲の端で輪郭が切れないよう 1px 余白を付けてから輪郭を取り、元画像座標に戻す
+        crop_u8 = cv2.copyMakeBorder(crop.astype(np.uint8) * 255, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        ctrs, _ = cv2.findContours(crop_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0 - 1, y0 - 1))
+        cv2.drawContours(dbg, ctrs, -1, (0, 128, 255), max(int(8 * scale), 2)) # 縁取り
+
+    # 2. 下部に「外枠」として巨大なIDバーを付け足す (センタリング)
+    bar_h = int(h * 0.18)
+    if bar_h < 80: bar_h = 80
+
+    # キャンバスを拡張 (元の画像 + 黒帯)
+    canvas = np.zeros((h + bar_h, w, 3), dtype=np.uint8)
+    canvas[0:h, 0:w] = dbg # 上部に元の画像(加工済み)を配置
+
+    text = f"ID: {m['id']}"
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = h / 350.0
+    if font_scale < 1.8: font_scale = 1.8
+    thickness = int(font_scale * 2.5)
+
+    (t_w, t_h), _ = cv2.getTextSize(text, font, font_scale, thickness)
+    tx = max((w - t_w) // 2, 0)
+    # 拡張した部分の中央に配置
+    ty = h + (bar_h + t_h) // 2
+    cv2.putText(canvas, text, (tx, ty), font, font_scale, (255, 255, 255), thickness, cv2.LINE_AA)
+    return canvas
+
+def save_detection_previews(img_bgr, valid_masks, debug_dir, max_side=PREVIEW_MAX_SIDE, workers=4, on_ready=None):
+    """
+    ID 付きプレビューをギャラリー表示用の解像度 (長辺 max_side) でスレッド並列に書き出す。
+    書き終わった順に on_ready(path) を呼ぶ (ワーカーはログに出し、UI はそれを見て順次表示する)。
+    書きかけのファイルが一覧に出ないよう、ドットファイルに書いてから置き換える。
+    """
+    os.makedirs(debug_dir, exist_ok=True)
+    # 再フィルタリングで人数が減ったときに前回のプレビューが残らないよう消しておく
+    for p in glob.glob(os.path.join(debug_dir, "detected_person_*.jpg")): os.remove(p)
+    if not valid_masks: return []
+    h, w = img_bgr.shape[:2]
+    scale = min(1.0, max_side / max(h, w)) if max_side else 1.0
+    base = img_bgr if scale == 1.0 else cv2.resize(img_bgr, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+    # 背景減光 (マスク外を 1/6 に) は全員共通なので1度だけ計算する
+    dimmed = base // 6
+
+    def work(i, m):
+        path = os.path.join(debug_dir, f"detected_person_{i}.jpg"); tmp = os.path.join(debug_dir, f".detected_person_{i}.jpg")
+        cv2.imwrite(tmp, render_preview(base, dimmed, m, scale), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        os.replace(tmp, path)
+        return path
+
+    paths = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for fut in as_completed([pool.submit(work, i, m) for i, m in enumerate(valid_masks)]):
+            paths.append(fut.result())
+            if on_ready: on_ready(paths[-1])
+    return sorted(paths)
+
+def write_detection_result(output_dir, valid_masks):
+    with open(os.path.join(output_dir, "detection_result.json"), "w") as f:
+        json.dump([{'id': m['id'], 'area': m['area'], 'score': m['score'], 'bbox': m['bbox']} for m in valid_masks], f)
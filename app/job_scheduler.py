@@ -0,0 +1,188 @@
+"""
+ジョブスケジューラー (複数ユーザーでの同時利用)
+
+Gradio の各セッション (ブラウザのタブ) から投入されたジョブにセッションごとの ID と専用の出力フォルダ
+(outputs/jobs/<セッション>/<種類>_<ジョブID>/) を割り当て、同時に実行するジョブ数を上限以下に保ちます。
+上限を超えたジョブは投入順に待ち、待ち順位を UI に表示します。中断はそのセッションのジョブだけに効きます。
+
+同時実行数の上限は main.py の --max_jobs (0 で自動) で指定します。自動の場合は空きメモリ / SAM3D_JOB_RAM_MB と
+ワーカーが使う GPU (1枚) の空き VRAM / SAM3D_JOB_VRAM_MB の小さい方 (1ジョブ = モデル一式をロードした predict_worker.py 1プロセス) です。
+"""
+import os
+import time
+import hashlib
+import shutil
+import threading
+import itertools
+import subprocess
+import collections
+
+from convert.blender_export import available_memory_mb
+
+JOB_RAM_MB = int(os.environ.get("SAM3D_JOB_RAM_MB", "8000")) # 1ジョブあたりの RAM 見積もり
+JOB_VRAM_MB = int(os.environ.get("SAM3D_JOB_VRAM_MB", "7000")) # 1ジョブあたりの VRAM 見積もり
+SESSION_TTL = float(os.environ.get("SAM3D_SESSION_TTL_H", "24")) * 3600 # これより古いセッションの出力は消す
+
+def worker_gpu():
+    """ワーカーが使う GPU ("cuda" = CUDA_VISIBLE_DEVICES の先頭、未指定なら 0 番) の nvidia-smi 上の ID"""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",")[0].strip()
+    return visible or "0"
+
+def available_vram_mb():
+    """
+    ワーカーが使う GPU 1枚の空き VRAM (nvidia-smi が無ければ None)。UI プロセスでは torch を import しないため nvidia-smi に聞く。
+    ジョブは全て同じ "cuda" デバイスで動くので、複数 GPU の空きを合計してはいけない。
+    """
+    try:
+        out = subprocess.run(["nvidia-smi", f"--id={worker_gpu()}", "--query-gpu=memory.free", "--format=csv,noheader,nounits"], capture_output=True, text=True, timeout=5)
+        if out.returncode != 0: return None
+        return int(out.stdout.split()[0])
+    except (OSError, ValueError, IndexError, subprocess.SubprocessError):
+        return None
+
+def auto_limit():
+    """空き RAM / VRAM から同時実行できるジョブ数を見積もる (最低 1)"""
+    n = []
+    ram, vram = available_memory_mb(), available_vram_mb()
+    if ram is not None: n.append(ram // JOB_RAM_MB)
+    if vram is not None: n.append(vram // JOB_VRAM_MB)
+    return max(1, min(n)) if n else 1
+
+def safe_session(session):
+    """クライアント由来のセッション ID をフォルダ名に使える固定長の16進文字列にする (../ 等でのパス操作を防ぐ)"""
+    return hashlib.sha1(str(session).encode("utf-8")).hexdigest()[:16]
+
+def _inside(path, root):
+    """path が root の配下 (root 自身は含まない) にあるか"""
+    root, path = os.path.normcase(os.path.realpath(root)), os.path.normcase(os.path.realpath(path))
+    try:
+        return os.path.commonpath([root, path]) == root and path != root
+    except ValueError: # Windows で別ドライブ
+        return False
+
+class Job:
+    def __init__(self, job_id, session, kind, output_dir):
+        self.id = job_id
+        self.session = session
+        self.kind = kind
+        self.output_dir = output_dir
+        self.debug_dir = os.path.join(output_dir, "debug_masks")
+        self.state = "queued" # queued -> running -> done / cancelled
+        self.process = None
+        self.created = time.time()
+
+class JobScheduler:
+    def __init__(self, root, limit=1):
+        self.root = root
+        self.limit = max(1, int(limit))
+        self.cond = threading.Condition()
+        self.ids = itertools.count(1)
+        self.queue = collections.deque() # 待機中のジョブ (投入順)
+        self.running = set()
+        self.latest = {} # (session, kind) -> 最後に投入したジョブ
+
+    def session_dir(self, session):
+        path = os.path.join(self.root, session)
+        # ジョブの出力は消去されるので、必ず root の配下に収まることを確かめる
+        if not _inside(path, self.root): raise ValueError(f"invalid session directory: {session!r}")
+        return path
+
+    def submit(self, session, kind):
+        """ジョブを登録して待ち行列に積む。同じセッション・同じ種類の古い出力はここで片付ける"""
+        with self.cond:
+            job_id = next(self.ids)
+            job = Job(job_id, session, kind, os.path.join(self.session_dir(session), f"{kind}_{job_id}"))
+            if not _inside(job.output_dir, self.root): raise ValueError(f"invalid job directory: {job.output_dir}")
+            os.makedirs(job.output_dir, exist_ok=True)
+            self._prune(job)
+            self.queue.append(job)
+            self.latest[(session, kind)] = job
+        return job
+
+    def latest_dir(self, session, kind):
+        """そのセッションで最後に投入した kind のジョブの出力フォルダ (まだ終わっていなければ None)"""
+        job = self.latest.get((session, kind))
+        return job.output_dir if job and job.state == "done" else None
+
+    def position(self, job):
+        """待ち順位 (1 始まり)。待機中でなければ 0"""
+        with self.cond:
+            return self.queue.index(job) + 1 if job in self.queue else 0
+
+    def wait_turn(self, job, poll=1.0):
+        """
+        実行枠が空くまで待つジェネレータ。待っている間は順位が変わるたびに yield する。
+        終了時に job.state が "running" なら実行してよい ("cancelled" なら中断された)。
+        """
+        last = None
+        while True:
+            with self.cond:
+                if job.state != "queued": return
+                if self.queue[0] is job and len(self.running) < self.limit:
+                    self.queue.popleft(); self.running.add(job); job.state = "running"
+                    return
+                pos = self.queue.index(job) + 1
+            if pos != last:
+                last = pos; yield pos
+            with self.cond: self.cond.wait(poll)
+
+    def attach(self, job, process):
+        """実行中のジョブにプロセス (subprocess.Popen / worker_client.RemoteJob) を結び付ける"""
+        with self.cond:
+            job.process = process
+            cancelled = job.state == "cancelled"
+        # 起動と中断がすれ違った場合はここで止める
+        if cancelled: _terminate(process)
+
+    def finish(self, job):
+        """実行枠を返す。UI 側が途中で止めた (ジェネレータが閉じられた) 場合は残ったプロセスも止める"""
+        with self.cond:
+            if job in self.queue: self.queue.remove(job)
+            self.running.discard(job)
+            if job.state != "cancelled": job.state = "done"
+            process, job.process = job.process, None
+            self.cond.notify_all()
+        if process is not None: _terminate(process)
+
+    def cancel_session(self, session):
+        """そのセッションの待機中・実行中のジョブだけを中断し、中断した数を返す"""
+        with self.cond:
+            jobs = [j for j in list(self.queue) + list(self.running) if j.session == session]
+            for j in jobs:
+                j.state = "cancelled"
+                if j in self.queue: self.queue.remove(j)
+            procs = [j.process for j in jobs if j.process is not None]
+            self.cond.notify_all()
+        for p in procs: _terminate(p)
+        return len(jobs)
+
+    def status(self):
+        with self.cond:
+            return {"limit": self.limit, "running": len(self.running), "queued": len(self.queue)}
+
+    def _prune(self, job):
+        """同じセッション・種類の古いジョブの出力と、放置されたセッションの出力を消す (実行中のものは残す)"""
+        active = {j.output_dir for j in list(self.queue) + list(self.running)}
+        sdir = self.session_dir(job.session)
+        for name in os.listdir(sdir):
+            p = os.path.join(sdir, name)
+            if p != job.output_dir and name.startswith(job.kind + "_") and p not in active:
+                shutil.rmtree(p, ignore_errors=True)
+        now = time.time()
+        active_sessions = {j.session for j in list(self.queue) + list(self.running)} | {job.session}
+        for name in os.listdir(self.root):
+            p = os.path.join(self.root, name)
+            try:
+                if name not in active_sessions and os.path.isdir(p) and now - os.path.getmtime(p) > SESSION_TTL:
+                    shutil.rmtree(p, ignore_errors=True)
+            except OSError: pass
+
+def _terminate(p):
+    try:
+        if p.poll() is None:
+            p.terminate()
+            p.wait(timeout=1)
+            print(f"Process {p.pid} terminated.")
+    except Exception:
+        try: p.kill()
+        except Exception: pass
@@ -8,42 +8,45 @@ import json
 from datetime import datetime
 import gradio as gr
 from PIL import Image
+import worker_client
+import detections
+import job_scheduler
+from convert import blender_export
 
 # パス設定
 base_dir = os.path.dirname(os.path.abspath(__file__))
 outputs_dir = os.path.join(base_dir, "outputs")
 uploads_dir = os.path.join(base_dir, "uploads")
-debug_dir = os.path.join(outputs_dir, "debug_masks")
 settings_path = os.path.join(base_dir, "settings.json")
 worker_script = os.path.join(base_dir, "predict_worker.py")
+daemon_script = os.path.join(base_dir, "worker_daemon.py")
 LOADING_IMG = os.path.join(base_dir, "assets", "processing.png")
 os.makedirs(outputs_dir, exist_ok=True)
 os.makedirs(uploads_dir, exist_ok=True)
 
-# 🚀 実行中プロセスの管理
-running_processes = []
+# 🚀 ジョブの管理 (セッションごとのジョブ ID・出力フォルダ outputs/jobs/<セッション>/ と同時実行数の上限)
+jobs_dir = os.path.join(outputs_dir, "jobs")
+scheduler = job_scheduler.JobScheduler(jobs_dir) # 上限は起動時に --max_jobs から設定する
+UPLOAD_TTL = 3600 # 他のセッションが待機中・処理中の入力を消さないよう、これより新しい一時ファイルは残す
 
-def kill_running_processes():
-    global running_processes
-    for p in running_processes:
-        try:
-            if p.poll() is None:
-                p.terminate()
-                p.wait(timeout=1)
-                print(f"Process {p.pid} terminated.")
-        except:
-            try: p.kill()
-            except: pass
-    running_processes = []
-    return "⏹️ 処理を中断しました。"
+def session_key(request):
+    """Gradio のセッション (ブラウザのタブ) ごとのキー。session_hash はクライアントが送る値なので、ハッシュ化してフォルダ名に使う"""
+    return job_scheduler.safe_session(getattr(request, "session_hash", None) or "local")
+
+def kill_running_processes(request: gr.Request):
+    # 中断するのはこのセッションのジョブだけ (他のユーザーのジョブはそのまま)
+    n = scheduler.cancel_session(session_key(request))
+    return "⏹️ 処理を中断しました。" if n else "⏹️ 実行中の処理はありません。"
 
 def cleanup_uploads():
     """uploads フォルダの古い一時ファイルを削除する"""
     if os.path.exists(uploads_dir):
+        now = datetime.now().timestamp()
         for f in os.listdir(uploads_dir):
             if "_mppa_cv_" in f:
                 try:
-                    os.remove(os.path.join(uploads_dir, f))
+                    p = os.path.join(uploads_dir, f)
+                    if now - os.path.getmtime(p) > UPLOAD_TTL: os.remove(p)
                 except: pass
 
 def load_settings():
@@ -90,25 +93,46 @@ def save_settings_fn(mode, detector, text_prompt, conf_threshold, min_area, infe
         err = f"❌ 保存失敗: {e}"
         return err, err
 
-def run_worker_cmd_yield(cmd, desc):
-    global running_processes
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
-    running_processes.append(process)
-    
-    full_log = f"--- [START] {desc} ---\n"
-    yield full_log
-    
-    for line in iter(process.stdout.readline, ""):
-        full_log += line
-        print(line, end="")
+def run_worker_cmd_yield(cmd, desc, job):
+    # 同時実行数の上限に達していれば順番が来るまで待つ (待機中は順位の行だけを返す)
+    try:
+        for pos in scheduler.wait_turn(job):
+            st = scheduler.status()
+            yield f"⏳ 待機中: {pos} 番目 (実行中 {st['running']}/{st['limit']} ジョブ)\n"
+        if job.state != "running":
+            yield "⏹️ 処理を中断しました。\n"
+            return
+        cmd = cmd + ["--output_dir", job.output_dir]
+        # 常駐デーモンが起動していればジョブを転送し、モデルの再ロードを省く
+        if worker_client.daemon_available():
+            process = worker_client.RemoteJob(cmd[2:])
+            line_iter = process.lines()
+            desc += " (常駐デーモン)"
+        else:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+            line_iter = iter(process.stdout.readline, "")
+        scheduler.attach(job, process)
+        
+        full_log = f"--- [START] {desc} (job {job.id}) ---\n"
         yield full_log
-    
-    process.wait()
-    if process in running_processes: running_processes.remove(process)
-    if process.returncode != 0:
-        yield full_log + f"\n❌ ERROR: 終了コード {process.returncode}\n"
-    else:
-        yield full_log + f"\n✅ SUCCESS: 完了\n"
+        
+        for line in line_iter:
+            full_log += line
+            print(line, end="")
+            yield full_log
+        
+        process.wait()
+        if process.returncode != 0:
+            yield full_log + f"\n❌ ERROR: 終了コード {process.returncode}\n"
+        else:
+            yield full_log + f"\n✅ SUCCESS: 完了\n"
+    finally:
+        # 正常終了・失敗・UI からの中断 (ジェネレータの close) のいずれでも実行枠を返す
+        scheduler.finish(job)
+
+def job_status(log_c):
+    """待機中は待ち順位をそのまま状態表示にする"""
+    return log_c.strip() if log_c.startswith("⏳") else "🚀 実行中..."
 
 def ensure_jpg(image_path):
     """どんな画像でも強制的に『白背景の画像』に焼き込む。RGBA-JPEGエラー回避のためPNGで保存する。"""
@@ -422,7 +446,7 @@ This tool integrates the following research works:
                                 log_output = gr.Textbox(label="", lines=12, max_lines=20, interactive=False)
 
         # --- Logic ---
-        def on_detect(image, detector, text, conf, area, b_scale, nms, is_lightning, progress=gr.Progress()):
+        def on_detect(image, detector, text, conf, area, b_scale, nms, is_lightning, request: gr.Request, progress=gr.Progress()):
             # ステップ開始時の表示をクリア
             yield image, [], {}, "", gr.update(choices=[], value=[]), "🔍 人物をスキャン中...", "", ""
             
@@ -436,23 +460,30 @@ This tool integrates the following research works:
             cmd = [sys.executable, worker_script, image, "--detector_name", real_detector, "--text_prompt", text, "--conf_threshold", str(conf), "--min_area", str(int(area)), "--box_scale", str(b_scale), "--nms_thr", str(nms), "--sam3_only"]
             log_c = ""
             success = False
+            # このセッション専用の出力フォルダで実行する (他のユーザーのジョブと消し合わない)
+            job = scheduler.submit(session_key(request), "detect")
             progress(0, desc="🔍 人物スキャンを開始中...")
             yield image, [], {}, "", gr.update(), "🚀 実行中...", log_c, log_c
-            for log_c in run_worker_cmd_yield(cmd, "人物検出"):
+            live_previews = []; n_ready = 0
+            for log_c in run_worker_cmd_yield(cmd, "人物検出", job):
                 if "Loading" in log_c: progress(0.2, desc="🧠 モデルを読み込み中...")
                 elif "Running" in log_c: progress(0.5, desc="⚡ 人物を検出中...")
                 elif "Cleaning up" in log_c: progress(0.9, desc="🧹 後処理中...")
-                yield image, [], {}, "", gr.update(), "🚀 実行中...", log_c + f"\n📸 Input optimized: {os.path.basename(image)}", log_c
+                # プレビューは書き終わった順にワーカーがログへ出すので、その都度ギャラリーを更新する
+                if log_c.count("Preview ready") != n_ready:
+                    n_ready = log_c.count("Preview ready")
+                    live_previews = sorted(glob.glob(os.path.join(job.debug_dir, "*.jpg")))
+                yield image, live_previews, {}, "", gr.update(), job_status(log_c), log_c + f"\n📸 Input optimized: {os.path.basename(image)}", log_c
                 if "✅ SUCCESS" in log_c: success = True
             
             if not success:
                 yield image, [], {}, "", gr.update(choices=[], value=[]), "❌ 失敗", log_c, log_c
                 return
 
-            previews = sorted(glob.glob(os.path.join(debug_dir, "*.jpg")))
+            previews = sorted(glob.glob(os.path.join(job.debug_dir, "*.jpg")))
             det_data = []
-            if os.path.exists(os.path.join(outputs_dir, "detection_result.json")):
-                with open(os.path.join(outputs_dir, "detection_result.json"), "r") as f:
+            if os.path.exists(os.path.join(job.output_dir, "detection_result.json")):
+                with open(os.path.join(job.output_dir, "detection_result.json"), "r") as f:
                     det_data = json.load(f)
             choices = [str(d['id']) for d in det_data]
             progress(1.0, desc="✅ スキャンが完了しました！")
@@ -461,20 +492,47 @@ This tool integrates the following research works:
         det_job = det_btn.click(on_detect, [input_img, detector_sel, text_prompt, conf_threshold, min_area, box_scale, nms_thr, gr.State(False)], [input_img, det_preview, det_results_json, session_id, target_id_checks, det_status_msg, log_output, det_log])
         cancel_det_btn.click(kill_running_processes, None, [det_log], cancels=[det_job])
 
+        def on_refilter(image, detector, text, conf, area, b_scale, nms, request: gr.Request):
+            """検出済みの生の結果 (raw_detections.npz) にスライダーの値を掛け直し、モデルを使わずに ID プレビューを作り直す"""
+            keep = (gr.update(), gr.update(), gr.update(), gr.update())
+            # このセッションで最後に検出したジョブの出力を使う
+            det_dir = scheduler.latest_dir(session_key(request), "detect")
+            if det_dir is None: return keep
+            raw = detections.load_raw(os.path.join(det_dir, detections.RAW_FILE))
+            if raw is None or not image or not os.path.exists(image): return keep
+            # 別の画像の検出結果なら何もしない
+            if raw.get("source") != detections.file_digest(image): return keep
+            if raw.get("params") != detections.raw_params(detector, text, conf, nms):
+                return keep[:3] + ("⚠️ 検出モデル・検索ターゲット等が変わったため、もう一度『人物を検出』を実行してください。",)
+            # ワーカーと同じ読み込み (EXIF 回転・長辺 2048px への縮小) をしないと座標が合わない
+            try: img_bgr = detections.load_input_image(image)
+            except Exception: return keep
+            if tuple(img_bgr.shape[:2]) != tuple(raw["img_shape"]):
+                gr.Warning("検出時と画像サイズが一致しないため再フィルタリングできません。もう一度『人物を検出』を実行してください。")
+                return keep
+            boxes, masks = detections.refilter(raw, detector, conf, b_scale)
+            valid_masks = detections.build_valid_masks(boxes, masks, img_bgr.shape, int(area))
+            detections.save_detection_previews(img_bgr, valid_masks, os.path.join(det_dir, "debug_masks"))
+            detections.write_detection_result(det_dir, valid_masks)
+            det_data = [{'id': m['id'], 'area': m['area'], 'score': m['score'], 'bbox': m['bbox']} for m in valid_masks]
+            choices = [str(d['id']) for d in det_data]
+            previews = sorted(glob.glob(os.path.join(det_dir, "debug_masks", "*.jpg")))
+            return previews, det_data, gr.update(choices=choices, value=choices), f"✅ 再フィルタリング完了: {len(det_data)} 人 (モデルの再実行なし)"
+
+        # しきい値系のスライダーは離した時点で生の検出結果から即座に再計算する
+        for sl in [conf_threshold, min_area, box_scale, nms_thr]:
+            sl.release(on_refilter, [input_img, detector_sel, text_prompt, conf_threshold, min_area, box_scale, nms_thr], [det_preview, det_results_json, target_id_checks, det_status_msg])
+
         select_all_btn.click(lambda x: [str(d['id']) for d in x] if x else [], [det_results_json], [target_id_checks])
         deselect_all_btn.click(lambda: [], None, [target_id_checks])
 
-        def on_3d_recovery(image, detector, text, conf, area, b_scale, nms, targets, inf_mode, moge_active, clear, fov, zip_active, is_lightning, progress=gr.Progress()):
+        def on_3d_recovery(image, detector, text, conf, area, b_scale, nms, targets, inf_mode, moge_active, clear, fov, zip_active, is_lightning, request: gr.Request, progress=gr.Progress()):
             cleanup_uploads() # 新しい処理の前に古いアップロードを掃除
             image = ensure_jpg(image)
             if not image: yield None, None, None, [], [], [], None, "画像なし", ""
             # targetsが空（未選択）の場合は「全員（None）」として扱う
             target_str = ",".join(targets) if targets else ""
-            
-            # 古いプレビューGLBファイルを掃除
-            for f in glob.glob(os.path.join(outputs_dir, "output_preview_combined_*.glb")):
-                try: os.remove(f)
-                except: pass
+
             
             # ⚡ 超速モード (クイック) 時の個別調整
             # 既に on_quick_recovery から選択された設定が渡されているため、それを尊重する
@@ -489,10 +547,13 @@ This tool integrates the following research works:
             else: print("💡 No IDs selected. Auto-Recovery mode: processing all detected persons.")
             log_c = ""
             success = False
+            # 出力はジョブ専用のフォルダに書き出す (古いプレビューGLB等は前回のジョブのフォルダごと片付けられる)
+            job = scheduler.submit(session_key(request), "recover")
+            out_dir = job.output_dir
             
             # プログレスバーの管理
             progress(0, desc="🚀 処理を開始中...")
-            for log_c in run_worker_cmd_yield(cmd, "3D復元処理"):
+            for log_c in run_worker_cmd_yield(cmd, "3D復元処理", job):
                 # === プログレスバーの更新ロジック (堅牢なパース) ===
                 p_val = None
                 p_desc = None
@@ -535,21 +596,21 @@ This tool integrates the following research works:
                     p_val = max(0.0, min(0.99, p_val))
                     progress(p_val, desc=p_desc)
 
-                yield image, None, None, gr.update(value=None), [], [], [], None, "🚀 実行中...", log_c + f"\n📸 Input optimized: {os.path.basename(image)}"
+                yield image, None, None, gr.update(value=None), [], [], [], None, job_status(log_c), log_c + f"\n📸 Input optimized: {os.path.basename(image)}"
                 if "✅ SUCCESS" in log_c: success = True
             
             if not success:
                 yield image, None, None, None, [], [], [], None, "❌ 失敗", log_c
                 return
 
-            v_skel = os.path.join(outputs_dir, "output_vis_skeleton.jpg")
-            v_moge = os.path.join(outputs_dir, "output_depth.jpg")
-            bvh = sorted(glob.glob(os.path.join(outputs_dir, "output_*.bvh")))
-            fbx = sorted(glob.glob(os.path.join(outputs_dir, "output_*.fbx")))
-            obj = sorted(glob.glob(os.path.join(outputs_dir, "output_*.obj")))
+            v_skel = os.path.join(out_dir, "output_vis_skeleton.jpg")
+            v_moge = os.path.join(out_dir, "output_depth.jpg")
+            bvh = sorted(glob.glob(os.path.join(out_dir, "output_*.bvh")))
+            fbx = sorted(glob.glob(os.path.join(out_dir, "output_*.fbx")))
+            obj = sorted(glob.glob(os.path.join(out_dir, "output_*.obj")))
             
             # プレビュー用の統合GLB (タイムスタンプ付き) を探す
-            glbs = sorted(glob.glob(os.path.join(outputs_dir, "output_preview_combined_*.glb")))
+            glbs = sorted(glob.glob(os.path.join(out_dir, "output_preview_combined_*.glb")))
             preview_glb = glbs[-1] if glbs else None
             
             # プレビュー用の統合GLBを表示
@@ -562,7 +623,7 @@ This tool integrates the following research works:
                 if zip_active:
                     progress(0.98, desc="📁 成果物を圧縮中...")
                     import shutil
-                    # ⚠️ 重要: outputs_dir 自体を zip すると自分自身を含んで無限ループになるため、
+                    # ⚠️ 重要: out_dir 自体を zip すると自分自身を含んで無限ループになるため、
                     # 一時フォルダに必要なファイルだけを集めてから zip します。
                     with tempfile.TemporaryDirectory() as tmpzip:
                         zip_src = os.path.join(tmpzip, "results")
@@ -577,8 +638,8 @@ This tool integrates the following research works:
                         if os.path.exists(v_skel): shutil.copy(v_skel, zip_src)
                         if os.path.exists(v_moge): shutil.copy(v_moge, zip_src)
                         
-                        # ZIP作成 (outputs_dir の外、または固有の名前で作成)
-                        zip_base = os.path.join(outputs_dir, "mppa_results")
+                        # ZIP作成 (out_dir の外、または固有の名前で作成)
+                        zip_base = os.path.join(out_dir, "mppa_results")
                         if os.path.exists(zip_base + ".zip"): os.remove(zip_base + ".zip")
                         shutil.make_archive(zip_base, 'zip', zip_src)
                         final_zip = zip_base + ".zip"
@@ -587,7 +648,7 @@ This tool integrates the following research works:
                 yield image, v_skel if os.path.exists(v_skel) else None, v_moge if os.path.exists(v_moge) else None, target_glb, bvh, fbx, obj, final_zip, "✅ 完了", log_c
 
         # --- One-Click Events ---
-        def on_quick_recovery(image, det_name, conf, area, inf_mode, fov, progress=gr.Progress()):
+        def on_quick_recovery(image, det_name, conf, area, inf_mode, fov, request: gr.Request, progress=gr.Progress()):
             # [quick_input_img, quick_3d_view, quick_fbx, quick_bvh, quick_zip, quick_obj, quick_status, quick_log]
             yield image, gr.update(value=None, label="⌛ 3D形状を生成中..."), None, None, None, None, "🚀 準備中...", ""
             
@@ -606,6 +667,7 @@ This tool integrates the following research works:
                 fov,
                 defaults["quick"]["auto_zip"],
                 True, # is_lightning=True
+                request,
                 progress=progress
             )
             
@@ -671,8 +733,27 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--share", action="store_true", help="Enable Gradio public link")
+    parser.add_argument("--daemon", action="store_true", help="Start the resident inference daemon (keeps models loaded between jobs)")
+    parser.add_argument("--max_jobs", type=int, default=0, help="Max concurrent jobs across all users (0 = auto from free RAM/VRAM; 1 with --daemon, which runs jobs one at a time)")
     args = parser.parse_args()
 
+    # 同時実行数の上限 (超えたジョブは待ち行列に入り、UI に待ち順位を表示する)
+    scheduler.limit = args.max_jobs if args.max_jobs > 0 else (1 if args.daemon else job_scheduler.auto_limit())
+    print(f"🧮 Job scheduler: up to {scheduler.limit} concurrent job(s).")
+
+    # 常駐推論デーモンの起動 (モデルをロードしたまま保持し、2回目以降のジョブを高速化)
+    if args.daemon and not worker_client.daemon_available():
+        import atexit
+        daemon_proc = subprocess.Popen([sys.executable, daemon_script], cwd=base_dir)
+        atexit.register(daemon_proc.terminate)
+        print(f"🧠 Resident inference daemon started (PID {daemon_proc.pid}).")
+    # Blender も常駐させ、書き出しのたびの起動コストを無くす
+    if args.daemon and not blender_export.server_available():
+        import atexit
+        blender_proc = blender_export.start_server()
+        atexit.register(blender_proc.terminate)
+        print(f"🧠 Blender export server started (PID {blender_proc.pid}).")
+
     # Hugging Face Spaces や Docker 環境用の設定
     server_port = int(os.environ.get("PORT", 7860))
     
@@ -682,7 +763,8 @@ if __name__ == "__main__":
     print("※ 'local URL' は Colab では接続できません。")
     print("="*60 + "\n")
 
-    create_app().launch(
+    # イベントごとの同時実行数は Gradio ではなくジョブスケジューラーで制限する (待ち順位を表示するため)
+    create_app().queue(default_concurrency_limit=None).launch(
         server_name="0.0.0.0", 
         server_port=server_port, 
         share=args.share,
@@ -0,0 +1,82 @@
+import numpy as np
+import cv2
+
+# ==========================================
+# 🩻 bbox で切り出したコンパクトな人物マスク
+# ==========================================
+# 全画面 (H, W) の bool マスクを人物ごとに持つと、2048px の集合写真では1人あたり数MBになり、
+# ~mask のような全画面演算も人数分繰り返すことになる。CropMask はマスクが True の範囲 (bbox) だけを保持し、
+# 全画面への展開 (to_full) は SAM 3D Body へのマスクプロンプトなど本当に必要な場所でだけ行う。
+
+class CropMask:
+    def __init__(self, crop, x0, y0, shape):
+        self.crop = np.ascontiguousarray(crop, dtype=bool) # (h, w)
+        self.x0, self.y0 = int(x0), int(y0)
+        self.shape = (int(shape[0]), int(shape[1])) # 元画像の (H, W)
+
+    @classmethod
+    def from_full(cls, mask, shape=None):
+        """全画面マスクから作る。shape が違う場合 (SAM3 の出力解像度など) は先にリサイズする"""
+        mask = np.asarray(mask)
+        if mask.ndim > 2:
+            mask = np.squeeze(mask)
+            if mask.ndim > 2: mask = mask[0]
+        if shape is not None and mask.shape != tuple(shape[:2]):
+            mask = cv2.resize(mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        mask = mask.astype(bool)
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0: return cls(np.zeros((0, 0), dtype=bool), 0, 0, mask.shape)
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        return cls(mask[y0:y1, x0:x1], x0, y0, mask.shape)
+
+    @classmethod
+    def from_box(cls, box, shape):
+        """矩形マスク (cv2.rectangle(..., -1) で塗りつぶした場合と同じ画素)。全画面の配列は作らない"""
+        h, w = shape[:2]
+        x1, y1, x2, y2 = map(int, box)
+        x0, y0, xe, ye = max(min(x1, x2), 0), max(min(y1, y2), 0), min(max(x1, x2) + 1, w), min(max(y1, y2) + 1, h)
+        return cls(np.ones((max(ye - y0, 0), max(xe - x0, 0)), dtype=bool), x0, y0, (h, w))
+
+    @property
+    def area(self):
+        return int(self.crop.sum())
+
+    @property
+    def nbytes(self):
+        return self.crop.nbytes
+
+    def to_full(self):
+        full = np.zeros(self.shape, dtype=bool)
+        h, w = self.crop.shape
+        full[self.y0:self.y0 + h, self.x0:self.x0 + w] = self.crop
+        return full
+
+    def region(self, x0, y0, x1, y1):
+        """元画像座標の矩形 [x0, x1) x [y0, y1) に対応するマスク"""
+        out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=bool)
+        h, w = self.crop.shape
+        ix0, iy0 = max(x0, self.x0), max(y0, self.y0)
+        ix1, iy1 = min(x1, self.x0 + w), min(y1, self.y0 + h)
+        if ix1 > ix0 and iy1 > iy0:
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.crop[iy0 - self.y0:iy1 - self.y0, ix0 - self.x0:ix1 - self.x0]
+        return out
+
+    def sample(self, arr):
+        """全画面の配列 arr (深度マップなど) のうちマスク内の値"""
+        h, w = self.crop.shape
+        return arr[self.y0:self.y0 + h, self.x0:self.x0 + w][self.crop]
+
+    def shift(self, dx, dy):
+        """(dx, dy) だけ平行移動したマスク (最近傍の画素に丸め、はみ出した部分は捨てる)"""
+        dx, dy = int(round(float(dx))), int(round(float(dy)))
+        h, w = self.crop.shape
+        x0, y0 = self.x0 + dx, self.y0 + dy
+        cx0, cy0 = max(-x0, 0), max(-y0, 0)
+        cx1, cy1 = min(w, self.shape[1] - x0), min(h, self.shape[0] - y0)
+        if cx1 <= cx0 or cy1 <= cy0: return CropMask(np.zeros((0, 0), dtype=bool), 0, 0, self.shape)
+        return CropMask(self.crop[cy0:cy1, cx0:cx1], x0 + cx0, y0 + cy0, self.shape)
+
+    def key(self):
+        """キャッシュキー用の配列 (オフセット・元画像サイズ + ビット単位に詰めたマスク)"""
+        head = np.array([self.x0, self.y0, *self.crop.shape, *self.shape], dtype=np.int64)
+        return np.concatenate([head.view(np.uint8), np.packbits(self.crop)])
@@ -1,5 +1,13 @@
 import sys
 import os
+
+# 常駐デーモン (worker_daemon.py) が起動していれば、このCLIは薄いクライアントとしてジョブを転送する
+# (torch の import より前に判定し、クライアント側のコールドスタートを避ける)
+if __name__ == "__main__" and "--local" not in sys.argv[1:]:
+    import worker_client
+    if worker_client.daemon_available():
+        sys.exit(worker_client.run_remote(sys.argv[1:]))
+
 import torch
 import torch.serialization
 import torch.hub
@@ -51,13 +59,15 @@ import numpy as np
 import cv2
 import json
 import matplotlib.pyplot as plt
-import subprocess
 import time
 import argparse
 import gc
 import shutil
+import threading
+import collections
+import queue
 import PIL.Image
-import PIL.ImageOps
+from detections import load_input_image, RAW_FILE, score_floor, raw_params, file_digest, save_raw, unpack_raw, refilter, build_valid_masks, save_detection_previews, write_detection_result
 
 # ==========================================
 # 🌍 パス解決 (ポータブル構成)
@@ -89,26 +99,53 @@ for p in [DETECTRON2_REPO, DETECTRON2_STUB, MOGE_ROOT, SAM3_ROOT, SAM3D_ROOT]:
 
 # (旧式のカスタムローダーは HumanDetector への移行に伴い削除)
 
-def cleanup_outputs():
-    if os.path.exists(OUTPUT_DIR):
-        for f in os.listdir(OUTPUT_DIR):
-            p = os.path.join(OUTPUT_DIR, f)
+def cleanup_outputs(output_dir=OUTPUT_DIR):
+    if os.path.exists(output_dir):
+        for f in os.listdir(output_dir):
+            p = os.path.join(output_dir, f)
             if os.path.isfile(p): os.remove(p)
             elif os.path.isdir(p): shutil.rmtree(p)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    os.makedirs(DEBUG_DIR, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(os.path.join(output_dir, "debug_masks"), exist_ok=True)
+
+def job_output_dir(path):
+    """--output_dir を検証して絶対パスを返す。中身は実行のたびに消去されるため outputs/ の配下に限る"""
+    if not path: return OUTPUT_DIR
+    root, p = os.path.realpath(OUTPUT_DIR), os.path.realpath(path)
+    try:
+        inside = os.path.normcase(os.path.commonpath([root, p])) == os.path.normcase(root)
+    except ValueError: # Windows で別ドライブ
+        inside = False
+    if not inside: raise ValueError(f"--output_dir must be inside {OUTPUT_DIR}: {path}")
+    return p
 
 def clear_memory():
     gc.collect()
     if torch.cuda.is_available(): torch.cuda.empty_cache()
 
-if __name__ == "__main__":
+# ==========================================
+# ⏹️ ジョブの中断 (常駐デーモンから利用)
+# ==========================================
+CANCEL_EVENT = threading.Event()
+
+class JobCancelled(Exception):
+    pass
+
+def check_cancel():
+    """ステップの区切りで呼び出し、中断要求があれば JobCancelled を送出する"""
+    if CANCEL_EVENT.is_set():
+        raise JobCancelled()
+
+def build_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("image_path")
     parser.add_argument("--min_area", type=int, default=1000)
-    parser.add_argument("--text_prompt", type=str, default="person")
+    parser.add_argument("--text_prompt", type=str, default="person", help="SAM3 のテキストプロンプト (| 区切りで複数: \"person | mannequin\")")
     parser.add_argument("--conf_threshold", type=float, default=0.5)
     parser.add_argument("--sam3_only", action="store_true")
+    parser.add_argument("--depth_max_side", type=int, default=1024, help="MoGe に渡す画像 (または ROI) の長辺の上限 px (0 で原寸)")
+    parser.add_argument("--depth_roi", action="store_true", help="MoGe を対象人物の bbox の和の範囲だけで実行する (画角は --fov から換算)")
+    parser.add_argument("--no_previews", action="store_true", help="ID 付きプレビュー画像 (debug_masks/) を作らない (API・バッチ処理向け)")
     parser.add_argument("--target_ids", type=str, default="")
     parser.add_argument("--use_moge", action="store_true")
     parser.add_argument("--clear_mem", action="store_true")
@@ -117,412 +154,1147 @@ if __name__ == "__main__":
     parser.add_argument("--fov", type=float, default=70.0)
     parser.add_argument("--box_scale", type=float, default=1.2)
     parser.add_argument("--nms_thr", type=float, default=0.3)
-    args = parser.parse_args()
+    parser.add_argument("--batch_size", type=int, default=1, help="Step 3 で1回の順伝播にまとめる最大人数 (既定 1: 1人ずつマスク済み ROI を渡す従来の方式。2 以上は全画面 + マスクプロンプトで渡すため速いが、推論結果は従来と一致しない)")
+    parser.add_argument("--export_ply", action="store_true", help="OBJ に加えてバイナリ PLY も書き出す")
+    parser.add_argument("--payload_format", type=str, default="binary", choices=["binary", "json"], help="Blender へ渡す中間データの形式 (json は従来の tjson_*.json)")
+    parser.add_argument("--export_queue", type=int, default=2, help="復元済みで書き出し待ちにできる最大人数 (Step 3 と Step 4 の並行処理のキュー長)")
+    parser.add_argument("--export_workers", type=int, default=1, help="Blender 書き出しを並列に実行するプロセス数 (1: 常駐サーバー or 単発 Blender 1つ / 0: CPU コア数と空きメモリから自動)")
+    parser.add_argument("--bvh_backend", type=str, default="native", choices=["native", "blender"], help="BVH の書き出し方法 (native: numpy で直接 / blender: FBX 経由の従来方式)")
+    # 動画入力 (image_path が動画ファイルの場合)
+    parser.add_argument("--frame_stride", type=int, default=1, help="動画: 何フレームごとに処理するか")
+    parser.add_argument("--max_frames", type=int, default=0, help="動画: 処理する最大フレーム数 (0 で全フレーム)")
+    parser.add_argument("--min_track_frames", type=int, default=5, help="動画: これより短いトラックは BVH を書き出さない")
+    parser.add_argument("--track_iou", type=float, default=0.3, help="動画: フレーム間で同一人物とみなす bbox IoU")
+    parser.add_argument("--detect_every", type=int, default=1, help="動画: 検出器を回す間隔 (処理フレーム数)。間はオプティカルフローで bbox を追跡")
+    parser.add_argument("--track_min_conf", type=float, default=0.5, help="動画: フロー追跡の信頼度がこれを下回ったら次のフレームで再検出")
+    parser.add_argument("--keyframe_motion", type=float, default=0.0, help="動画: 前回の復元から bbox がこの割合 (bbox の高さ比) 以上動いた人物だけ 3D 復元し、間は回転を SLERP 補間 (0 で全フレーム復元)")
+    parser.add_argument("--keyframe_max_gap", type=int, default=10, help="動画: 動きが小さくてもこのフレーム数ごとに復元する")
+    parser.add_argument("--keyframe_check", type=int, default=0, help="動画: スキップしたフレームの K 枚に1枚を参照用に推論し、補間誤差を報告する (0 で無効)")
+    parser.add_argument("--video_fbx", action="store_true", help="動画: アニメーション BVH から FBX も書き出す (Blender)")
+    parser.add_argument("--no_cache", action="store_true", help="検出結果などのディスクキャッシュを使わない (読み出しも書き込みもせず、常に再計算)")
+    parser.add_argument("--near_dup_tolerance", type=int, default=-1, help="再保存・再圧縮しただけの同じ画像とみなす dHash のハミング距離 (64bit 中、4 程度。既定 -1 で無効)。縮小画像の画素差でも確認してから再利用する")
+    parser.add_argument("--output_dir", type=str, default="", help="出力先フォルダ (outputs/ の配下に限る。既定: outputs/。中身は実行のたびに消去される)")
+    parser.add_argument("--local", action="store_true", help="常駐デーモンが起動していても、このプロセス内で実行する")
+    return parser
 
-    time_start = time.time()
-    cleanup_outputs(); device = "cuda" if torch.cuda.is_available() else "cpu"
-    
-    # 画像読み込み (EXIF回転対応 & 自動リサイズ)
-    try:
-        pil_img = PIL.Image.open(args.image_path)
-        pil_img = PIL.ImageOps.exif_transpose(pil_img)
-        # OOM回避: 最大2048pxに縮小
-        if max(pil_img.size) > 2048:
-            print(f"📏 Resizing image from {pil_img.size} to max 2048px...")
-            pil_img.thumbnail((2048, 2048), PIL.Image.LANCZOS)
-        
-        # --- ROBUST TRANSPARENCY HANDLING (Force White Background) ---
-        rgba = pil_img.convert("RGBA")
-        canvas = PIL.Image.new("RGBA", rgba.size, (255, 255, 255, 255))
-        # 透過があれば白背景の上に合成、不透明ならそのまま上書きされる
-        pil_img = PIL.Image.alpha_composite(canvas, rgba).convert("RGB")
-        # -------------------------------------------------------------
-            
-        img_bgr = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-    except Exception as e:
-        print(f"❌ ERROR: Failed to load image {args.image_path}: {e}")
-        sys.exit(1)
+# ==========================================
+# 🧠 モデル管理
+# ==========================================
+class ModelRegistry:
+    """
+    検出器 / MoGe / SAM 3D Body の生成と保持を一元管理する。
+    resident=False (CLI単発実行) では各ステップ終了時に解放し、従来どおり VRAM を空ける。
+    resident=True (常駐デーモン) ではジョブを跨いで保持し、再ロードのコストを無くす。
+    """
+    def __init__(self, device, resident=False, sam3_cache_mb=None):
+        self.device = device
+        self.resident = resident
+        self.detectors = {}
+        self.moge = None
+        self.estimator = None
+        # SAM3 の set_image (バックボーン) の結果を画像ごとに保持し、プロンプト変更時はプロンプト側だけ再計算する。
+        # VRAM を推論モデル・MoGe と取り合うため既定は小さく (実質、直前の1枚分)、0 で無効 (毎回新しい画像のバッチ処理など)
+        self.sam3_states = collections.OrderedDict() # image_key -> (state, nbytes)
+        if sam3_cache_mb is None: sam3_cache_mb = int(os.environ.get("SAM3D_SAM3_STATE_MB", "256"))
+        self.sam3_state_limit = sam3_cache_mb * 1024 * 1024
 
-    # [Step 1] Detection
-    print(f"--- [Step 1] Detection using '{args.detector_name}' (prompt: '{args.text_prompt}') ---")
-    from tools.build_detector import HumanDetector
-    
-    try:
+    def get_sam3_state(self, detector, img_bgr):
+        if self.sam3_state_limit <= 0:
+            return detector.processor.set_image(PIL.Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)))
+        from cache_store import content_key
+        key = content_key("sam3_state", img_bgr)
+        if key in self.sam3_states:
+            self.sam3_states.move_to_end(key)
+            print(f"  -> Reusing cached SAM3 image embedding (key {key[:8]})")
+            return self.sam3_states[key][0]
+        state = detector.processor.set_image(PIL.Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)))
+        nbytes = tensor_nbytes(state)
+        self.sam3_states[key] = (state, nbytes)
+        # メモリ上限を超えた分は古い画像から捨てる (最新の1枚は必ず残す)
+        while len(self.sam3_states) > 1 and sum(n for _, n in self.sam3_states.values()) > self.sam3_state_limit:
+            self.sam3_states.popitem(last=False)
+        return state
+
+    def get_detector(self, name):
+        if name not in self.detectors:
+            self.detectors[name] = self._build_detector(name)
+        else:
+            print(f"  -> Using resident detector '{name}'")
+        return self.detectors[name]
+
+    def _build_detector(self, name):
+        from tools.build_detector import HumanDetector
         # ラッパーとしての設計: 
         # 原則的に sam-3d-body 公式の HumanDetector を使用しますが、
         # 公式コードが HF (ネット) 固定である SAM3 についてのみ、
         # ユーザーがローカルに sam3.pt を置いている場合に限り、読み込みを差し替えてオフライン動作を支援します。
-        
-        det_path = ""
-        if args.detector_name == "vitdet":
-            det_path = WEIGHTS_ROOT
-
-        raw_sam3_output = None # SAM3の生出力を保持してマスクを取り出す
-        if args.detector_name == "sam3":
+        if name == "sam3":
             local_sam3 = os.path.join(WEIGHTS_ROOT, "sam3.pt")
             if os.path.exists(local_sam3):
                 print(f"📦 Local SAM3 checkpoint found. Loading...")
                 from sam3.model_builder import build_sam3_image_model
                 from sam3.model.sam3_image_processor import Sam3Processor
-                m_s3 = build_sam3_image_model(checkpoint_path=local_sam3, load_from_HF=False, device=device)
-                
+                m_s3 = build_sam3_image_model(checkpoint_path=local_sam3, load_from_HF=False, device=self.device)
+
                 # HumanDetectorを介さず直接構成（他モデルの二重読み込みを完全に防止）
                 class SimpleDetector: pass
                 detector = SimpleDetector()
-                detector.device = device
+                detector.device = self.device
                 detector.detector = m_s3
-                detector.processor = Sam3Processor(m_s3, device=device)
+                detector.processor = Sam3Processor(m_s3, device=self.device)
+                return detector
+            print(f"  -> Initializing SAM3 (Online mode)...")
+            return HumanDetector(name="sam3", device=self.device)
+
+        det_path = WEIGHTS_ROOT if name == "vitdet" else ""
+        return HumanDetector(name=name, device=self.device, path=det_path)
+
+    def get_moge(self):
+        if self.moge is None:
+            import moge.model
+            self.moge = moge.model.import_model_class_by_version(MOGE_VERSION).from_pretrained(MOGE_MODEL_ID).to(self.device).eval()
+        return self.moge
+
+    def get_estimator(self):
+        if self.estimator is None:
+            from sam_3d_body import load_sam_3d_body, SAM3DBodyEstimator
+            print("--- Loading SAM 3D Body model... ---")
+            model_3d, cfg_3d = load_sam_3d_body(SAM3DB_CKPT, self.device, MHR_MODEL_PT)
+            self.estimator = SAM3DBodyEstimator(model_3d, cfg_3d)
+        else:
+            print("--- Using resident SAM 3D Body model ---")
+        return self.estimator
+
+    def release_detectors(self):
+        if not self.resident:
+            self.sam3_states.clear()
+            for detector in self.detectors.values():
+                if hasattr(detector, 'detector'): del detector.detector
+                if hasattr(detector, 'processor'): del detector.processor
+            self.detectors = {}
+        clear_memory()
+
+    def release_moge(self):
+        if not self.resident:
+            self.moge = None
+        clear_memory()
+
+    def release_all(self):
+        self.resident = False
+        self.release_detectors()
+        self.release_moge()
+        self.estimator = None
+        clear_memory()
+
+# ==========================================
+# [Step 1] Detection
+# ==========================================
+def tensor_nbytes(obj):
+    """dict / list に含まれる tensor の合計バイト数 (SAM3 の inference_state のサイズ見積もり用)"""
+    if torch.is_tensor(obj): return obj.element_size() * obj.nelement()
+    if isinstance(obj, dict): return sum(tensor_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)): return sum(tensor_nbytes(v) for v in obj)
+    return 0
+
+def split_prompts(text_prompt):
+    """"person | mannequin" のように | 区切りで複数のテキストプロンプトを指定できる"""
+    prompts = [p.strip() for p in str(text_prompt).split("|") if p.strip()]
+    return prompts or ["person"]
+
+def run_sam3_prompts(detector, state, prompts, conf_threshold):
+    """
+    1つの画像埋め込みに対して複数のプロンプトを順に当て、(boxes, scores, masks) をまとめて返す。
+    プロンプト間で重複した検出 (IoU > 0.7) はスコアの高い方だけを残す。
+    """
+    all_boxes, all_scores, all_masks = [], [], []
+    for prompt in prompts:
+        # set_text_prompt は state["backbone_out"] にテキスト特徴を書き足すため、キャッシュ側を汚さないよう浅いコピーを渡す
+        st = dict(state)
+        if isinstance(st.get("backbone_out"), dict): st["backbone_out"] = dict(st["backbone_out"])
+        out = detector.processor.set_text_prompt(state=st, prompt=prompt)
+        scores = out["scores"].cpu().numpy(); keep = scores > conf_threshold
+        all_boxes.append(out["boxes"].cpu().numpy()[keep]); all_scores.append(scores[keep]); all_masks.append(out["masks"][keep].cpu().numpy())
+        if len(prompts) > 1: print(f"    prompt '{prompt}': {int(keep.sum())} detections")
+        del out, st
+    boxes = np.concatenate(all_boxes).reshape(-1, 4); scores = np.concatenate(all_scores); masks = np.concatenate(all_masks)
+    if len(prompts) > 1 and len(boxes) > 1:
+        from tracker import iou_matrix
+        order = np.argsort(-scores); iou = iou_matrix(boxes[order], boxes[order]); kept = []
+        for i in range(len(order)):
+            if all(iou[i, j] <= 0.7 for j in kept): kept.append(i)
+        sel = order[kept]
+        boxes, scores, masks = boxes[sel], scores[sel], masks[sel]
+    return boxes, scores, masks
+
+def run_detection(detector, detector_name, img_bgr, args, models=None):
+    """
+    検出を実行し、しきい値適用前の生の結果 {"boxes", "scores", "masks", "img_shape"} を返す (detections.py 参照)。
+    SAM3 は score が RAW_SCORE_FLOOR を超えた全ての検出を拡大前の box のまま返す。vitdet は score / マスクを持たない。
+    models を渡すと SAM3 の画像埋め込みを models 側にキャッシュし、同じ画像ではプロンプト部分だけを再計算する。
+    """
+    if detector_name == "sam3":
+        # 生の出力を取得
+        prompts = split_prompts(args.text_prompt)
+        print(f"  -> Running SAM3 inference (prompts: {prompts})...")
+        if models is not None:
+            inference_state = models.get_sam3_state(detector, img_bgr)
+        else:
+            inference_state = detector.processor.set_image(PIL.Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)))
+        boxes, scores, raw_sam3_masks = run_sam3_prompts(detector, inference_state, prompts, score_floor(args.conf_threshold))
+        del inference_state
+        return {"boxes": boxes, "scores": scores, "masks": raw_sam3_masks, "img_shape": img_bgr.shape}
+
+    print(f"  -> Running {detector_name} inference (prompt: {args.text_prompt})...")
+    boxes = detector.run_human_detection(img_bgr, bbox_thr=args.conf_threshold, nms_thr=args.nms_thr)
+    return {"boxes": np.asarray(boxes, dtype=np.float64).reshape(-1, 4), "scores": None, "masks": None, "img_shape": img_bgr.shape}
+
+def detection_params(args):
+    return raw_params(args.detector_name, args.text_prompt, args.conf_threshold, args.nms_thr)
+
+def detection_cache_key(image_key, args):
+    from cache_store import content_key
+    return content_key("detection", image_key, detection_params(args))
+
+def resolve_image_key(img_bgr, args):
+    """
+    キャッシュ用の画像キーを返す。過去に処理した画像と知覚ハッシュがほぼ一致し (同じ解像度)、
+    --near_dup_tolerance 以内で、縮小画像の画素差も小さければ、その画像のキーを返して検出・深度・推論の結果を再利用する。
+    """
+    from cache_store import content_key, dhash, thumbnail, thumbnail_diff, ArrayCache, PerceptualIndex, NEAR_DUP_MAX_DIFF
+    image_key = content_key("image", img_bgr)
+    if args.no_cache or args.near_dup_tolerance < 0: return image_key
+    index = PerceptualIndex(); h = dhash(img_bgr)
+    thumbs = ArrayCache("phash_thumbs", max_entries=index.max_entries); thumb = thumbnail(img_bgr)
+    try:
+        hit = index.lookup(h, img_bgr.shape, args.near_dup_tolerance)
+        known = False
+        if hit is not None:
+            e, d, same = hit
+            if not same:
+                print(f"  💡 Similar image was processed before at a different size ({e.get('source')}, {e['shape'][1]}x{e['shape'][0]}, distance {d}); not reusing")
+            elif e["key"] == image_key:
+                known = True
             else:
-                print(f"  -> Initializing SAM3 (Online mode)...")
-                detector = HumanDetector(name="sam3", device=device)
+                # dHash だけでは連写などの別の写真も一致するので、画素レベルでも確かめる
+                prev = thumbs.get(e["key"])
+                diff = thumbnail_diff(thumb, prev["thumb"]) if prev is not None else None
+                if diff is not None and diff <= NEAR_DUP_MAX_DIFF:
+                    print(f"  -> Near-duplicate of a previous input ({e.get('source')}, dHash distance {d}, pixel diff {diff:.2f}); reusing its cached results")
+                    return e["key"]
+                print(f"  💡 Similar image was processed before ({e.get('source')}, dHash distance {d}) but the pixels differ; not reusing")
+        if not known: index.add(h, image_key, img_bgr.shape, source=os.path.basename(args.image_path))
+        if thumbs.get(image_key) is None: thumbs.put(image_key, {"thumb": thumb})
+    except OSError as e:
+        print(f"  ⚠ Could not update near-duplicate index: {e}")
+    return image_key
+
+def detect_cached(models, img_bgr, args, image_key=None):
+    """
+    Advanced タブの「検出」と「3D復元」は同じ画像・同じパラメータで検出器を2回回していたため、
+    生の検出結果 (しきい値を掛ける前の boxes / scores / masks) を画像の内容ハッシュ + 検出パラメータで保存し、再利用する。
+    conf_threshold / box_scale / min_area は後段の refilter で掛けるので、sam3 ではそれらを変えてもキャッシュに当たる。
+    """
+    from cache_store import ArrayCache, content_key
+    cache = ArrayCache("detections", max_entries=32)
+    key = detection_cache_key(image_key or content_key("image", img_bgr), args)
+    if not args.no_cache:
+        hit = cache.get(key)
+        if hit is not None:
+            print(f"  -> Reusing cached detection ({len(hit['boxes'])} raw boxes, key {key[:8]})")
+            raw = unpack_raw(hit); raw["img_shape"] = img_bgr.shape
+            return raw
+
+    detector = models.get_detector(args.detector_name)
+    raw = run_detection(detector, args.detector_name, img_bgr, args, models=models)
+    entry = {"boxes": np.asarray(raw["boxes"], dtype=np.float64).reshape(-1, 4)}
+    if raw["scores"] is not None: entry["scores"] = np.asarray(raw["scores"], dtype=np.float32)
+    if raw["masks"] is not None:
+        entry["masks_shape"] = np.array(raw["masks"].shape); entry["masks_packed"] = np.packbits(raw["masks"].astype(bool), axis=-1)
+    # --no_cache は読み書きの両方を止める (共有キャッシュの他のエントリを追い出さない)
+    if args.no_cache: return raw
+    try:
+        cache.put(key, entry)
+    except OSError as e:
+        print(f"  ⚠ Could not write detection cache: {e}")
+    return raw
+
+# ==========================================
+# [Step 2] MoGe2: Depth
+# ==========================================
+MOGE_MODEL_ID = "Ruicheng/moge-2-vitl-normal"
+MOGE_VERSION = "v2"
+DEPTH_CACHE_BYTES = int(os.environ.get("SAM3D_DEPTH_CACHE_MB", "512")) * 1024 * 1024
+
+class DepthMap:
+    """
+    MoGe の深度マップ。メモリと計算量を抑えるため縮小・ROI のまま保持する。
+    深度マップの画素 (u, v) の中心は元画像座標の x = x0 + (u + 0.5) / sx, y = y0 + (v + 0.5) / sy に対応する。
+    """
+    def __init__(self, depth, img_shape, x0=0, y0=0, sx=1.0, sy=1.0):
+        self.depth = np.asarray(depth, dtype=np.float32)
+        self.img_shape = tuple(img_shape[:2])
+        self.x0, self.y0, self.sx, self.sy = int(x0), int(y0), float(sx), float(sy)
+
+    def sample(self, mask):
+        """CropMask 内の深度 (深度マップの画素中心がマスク内に入るセルだけ)。全画面の配列は作らない"""
+        h, w = mask.crop.shape
+        dh, dw = self.depth.shape
+        u0 = max(int(np.ceil((mask.x0 - self.x0) * self.sx - 0.5)), 0); u1 = min(int(np.ceil((mask.x0 + w - self.x0) * self.sx - 0.5)), dw)
+        v0 = max(int(np.ceil((mask.y0 - self.y0) * self.sy - 0.5)), 0); v1 = min(int(np.ceil((mask.y0 + h - self.y0) * self.sy - 0.5)), dh)
+        if u1 <= u0 or v1 <= v0: return np.zeros(0, dtype=np.float32)
+        xs = np.clip(np.floor(self.x0 + (np.arange(u0, u1) + 0.5) / self.sx).astype(int) - mask.x0, 0, w - 1)
+        ys = np.clip(np.floor(self.y0 + (np.arange(v0, v1) + 0.5) / self.sy).astype(int) - mask.y0, 0, h - 1)
+        return self.depth[v0:v1, u0:u1][mask.crop[np.ix_(ys, xs)]]
+
+def depth_region(img_shape, persons, args):
+    """
+    MoGe に渡す範囲 (x0, y0, x1, y1) と、その範囲を長辺 --depth_max_side に縮める倍率を返す。
+    --depth_roi では対象人物の bbox の和 (+ 余白 10%) だけを推論する。
+    """
+    h, w = img_shape[:2]
+    x0, y0, x1, y1 = 0, 0, w, h
+    if args.depth_roi and persons:
+        b = np.array([m['bbox'] for m in persons], dtype=np.float64)
+        pad = 0.1 * max(b[:, 2].max() - b[:, 0].min(), b[:, 3].max() - b[:, 1].min())
+        x0, y0 = max(int(b[:, 0].min() - pad), 0), max(int(b[:, 1].min() - pad), 0)
+        x1, y1 = min(int(np.ceil(b[:, 2].max() + pad)), w), min(int(np.ceil(b[:, 3].max() + pad)), h)
+    side = max(x1 - x0, y1 - y0)
+    scale = min(1.0, args.depth_max_side / side) if args.depth_max_side > 0 and side > 0 else 1.0
+    return (x0, y0, x1, y1), scale
+
+def estimate_depth_cached(models, img_bgr, device, output_dir, args, image_key=None, persons=None):
+    """
+    MoGe の深度マップ (DepthMap) を画像の内容ハッシュ + モデル版 + 推論範囲で保存し、同じ写真の再投入 (ID や FOV だけ変えた場合など) では
+    モデルのロードも推論も行わない。保存は float16 の深度 + 有効マスク (圧縮, 容量上限付き LRU)。
+    """
+    from cache_store import ArrayCache, content_key
+    cache = ArrayCache("depth", max_entries=256, max_bytes=DEPTH_CACHE_BYTES, compress=True)
+    region, scale = depth_region(img_bgr.shape, persons, args)
+    fov_x = args.fov if args.depth_roi else None
+    key = content_key("moge", MOGE_VERSION, MOGE_MODEL_ID, image_key or content_key("image", img_bgr), region, scale, fov_x)
+    hit = None if args.no_cache else cache.get(key)
+    if hit is not None:
+        valid = np.unpackbits(hit["valid_packed"], axis=-1, count=hit["depth"].shape[1]).astype(bool)
+        x0, y0, sx, sy = hit["placement"]
+        depth = DepthMap(np.where(valid, hit["depth"].astype(np.float32), 0.0), img_bgr.shape, x0, y0, sx, sy)
+        print(f"  -> Reusing cached depth map (key {key[:8]}, {depth.depth.shape[1]}x{depth.depth.shape[0]})")
+        save_depth_preview(depth, output_dir)
+        return depth
+
+    depth = estimate_depth(models.get_moge(), img_bgr, device, output_dir, region, scale, fov_x)
+    if args.no_cache: return depth
+    valid = depth.depth > 1e-3
+    try:
+        cache.put(key, {"depth": np.where(valid, depth.depth, 0).astype(np.float16), "valid_packed": np.packbits(valid, axis=-1),
+                        "placement": np.array([depth.x0, depth.y0, depth.sx, depth.sy])})
+    except OSError as e:
+        print(f"  ⚠ Could not write depth cache: {e}")
+    return depth
+
+def estimate_depth(m_m, img_bgr, device, output_dir, region=None, scale=1.0, fov_x=None):
+    """
+    region (x0, y0, x1, y1) を scale 倍に縮めて MoGe に通し、DepthMap を返す。
+    ROI だけを渡す場合、画角は元画像全体に対する --fov から ROI の幅ぶんに換算して fov_x で与える
+    (MoGe に ROI から画角を推定させると、配置で使う焦点距離と食い違うため)。
+    """
+    h, w = img_bgr.shape[:2]
+    x0, y0, x1, y1 = region or (0, 0, w, h)
+    roi = img_bgr[y0:y1, x0:x1]
+    if scale < 1.0:
+        roi = cv2.resize(roi, (max(int(round((x1 - x0) * scale)), 1), max(int(round((y1 - y0) * scale)), 1)), interpolation=cv2.INTER_AREA)
+    kw = {}
+    if fov_x is not None and (x1 - x0, y1 - y0) != (w, h):
+        f_pix = (max(w, h) / 2) / np.tan(np.deg2rad(fov_x) / 2)
+        kw["fov_x"] = float(np.rad2deg(2 * np.arctan((x1 - x0) / 2 / f_pix)))
+    print(f"  -> MoGe input: {roi.shape[1]}x{roi.shape[0]} (region {x1 - x0}x{y1 - y0} at ({x0}, {y0}) of {w}x{h})")
+    with torch.no_grad():
+        img_rgb_t = torch.from_numpy(cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)).permute(2,0,1).float().to(device)/255.0
+        inf_out = m_m.infer(img_rgb_t, **kw)
+        depth_map = inf_out['depth'].cpu().numpy()
+        depth_map = np.nan_to_num(depth_map, nan=0.0)
+        del img_rgb_t, inf_out
+    depth = DepthMap(depth_map, img_bgr.shape, x0, y0, roi.shape[1] / (x1 - x0), roi.shape[0] / (y1 - y0))
+    save_depth_preview(depth, output_dir)
+    return depth
+
+def save_depth_preview(depth, output_dir):
+    # 深度マップを鮮明に可視化 (0を除いた有効範囲で正規化)。縮小した解像度のまま処理する
+    depth_map = depth.depth
+    valid_mask = (depth_map > 1e-3)
+    if valid_mask.any():
+        v_min, v_max = np.percentile(depth_map[valid_mask], [2, 98])
+        d_vis = np.clip((depth_map - v_min) / (v_max - v_min + 1e-8), 0, 1)
+        # 有効領域以外（背景）は0にする
+        d_vis[~valid_mask] = 0
+    else:
+        d_vis = depth_map
+    
+    d_vis = cv2.applyColorMap((d_vis * 255).astype(np.uint8), cv2.COLORMAP_JET)
+    # ROI だけを推論した場合は、同じ縮尺の画像全体のキャンバスに貼り付ける
+    h, w = depth.img_shape
+    ch, cw = int(round(h * depth.sy)), int(round(w * depth.sx))
+    ox, oy = int(round(depth.x0 * depth.sx)), int(round(depth.y0 * depth.sy))
+    if (ch, cw) != d_vis.shape[:2]:
+        canvas = np.zeros((max(ch, oy + d_vis.shape[0]), max(cw, ox + d_vis.shape[1]), 3), dtype=np.uint8)
+        canvas[oy:oy + d_vis.shape[0], ox:ox + d_vis.shape[1]] = d_vis
+        d_vis = canvas[:ch, :cw]
+    # 奥行きを直感的にするために色彩を調整
+    cv2.imwrite(os.path.join(output_dir, "output_depth.jpg"), d_vis)
+
+# ==========================================
+# [Step 3] SAM 3DB: Recovery
+# ==========================================
+def full_frame_cam_int(img_shape, x0=0, y0=0):
+    """
+    sam-3d-body の既定カメラ (焦点距離 = 画像対角, 主点 = 画像中心) を元画像サイズで作り、
+    ROI の左上 (x0, y0) 分だけ主点をずらした内部パラメータを返す。
+    ROI だけを渡しても、出力 (pred_cam_t / pred_vertices) は元画像のカメラ座標系のままになる。
+    """
+    h, w = img_shape[:2]
+    f = (h ** 2 + w ** 2) ** 0.5
+    return torch.tensor([[[f, 0, w / 2.0 - x0], [0, f, h / 2.0 - y0], [0, 0, 1]]], dtype=torch.float32)
+
+def person_roi(img_bgr, m, mask):
+    """bbox で切り出し、マスク (CropMask) 外を黒く塗った ROI (RGB) とその左上座標を返す (全画面コピーは作らない)"""
+    h, w = img_bgr.shape[:2]
+    x1, y1, x2, y2 = m['bbox']
+    x0, y0 = max(int(np.floor(x1)), 0), max(int(np.floor(y1)), 0)
+    x1e, y1e = min(int(np.ceil(x2)), w), min(int(np.ceil(y2)), h)
+    roi = cv2.cvtColor(img_bgr[y0:y1e, x0:x1e], cv2.COLOR_BGR2RGB)
+    try:
+        roi[~mask.region(x0, y0, x1e, y1e)] = 0
+    except Exception as e:
+        print(f" ⚠ Warning: Mask shape mismatch for ID {m['id']}: {e}.")
+    return roi, x0, y0
+
+_model_fp = None
+def model_fingerprint():
+    """SAM 3D Body / MHR のチェックポイントを識別するキー (数GBを毎回ハッシュしないよう、パス・サイズ・更新時刻から作る)"""
+    global _model_fp
+    if _model_fp is None:
+        from cache_store import content_key
+        stats = []
+        for p in (SAM3DB_CKPT, MHR_MODEL_PT):
+            try: st = os.stat(p); stats.append([p, st.st_size, st.st_mtime_ns])
+            except OSError: stats.append([p, None, None])
+        _model_fp = content_key("sam3d_body", stats)
+    return _model_fp
+
+def recovery_mode(args):
+    """
+    推論への入力の与え方。結果が少し変わるため、人数やキャッシュの当たり方ではなく --batch_size だけで決める。
+      "roi"    (batch_size=1): bbox で切り出してマスク外を黒く塗った ROI を1人ずつ渡す (従来の方式)
+      "prompt" (batch_size>1): 全画面の画像に bbox + マスクプロンプトを付けて複数人をまとめて渡す (周囲の背景も見える)
+    """
+    return "prompt" if args.batch_size > 1 else "roi"
+
+def prediction_cache_key(image_key, m, mask, inference_type, mode):
+    from cache_store import content_key
+    return content_key("prediction", image_key, mask.key(), [float(x) for x in m['bbox']], inference_type, mode, model_fingerprint())
+
+def to_numpy_result(r):
+    for k in r:
+        if torch.is_tensor(r[k]): r[k] = r[k].cpu().numpy()
+        if isinstance(r[k], np.ndarray): r[k] = np.nan_to_num(r[k], nan=0.0)
+    return r
+
+def cacheable_result(r):
+    return {k: np.asarray(v) for k, v in r.items() if isinstance(v, (np.ndarray, np.generic, int, float))}
+
+def recover_single(est, img_bgr, m, mask, inference_type):
+    """1人分: マスク済み ROI をメモリ上のまま推論に渡す (一時JPEGの書き出し・再デコードなし)"""
+    roi, x0, y0 = person_roi(img_bgr, m, mask)
+    if roi.size == 0: return None
+    roi_box = np.array([[0, 0, roi.shape[1], roi.shape[0]]], dtype=np.float32)
+    r = est.process_one_image(roi, bboxes=roi_box, cam_int=full_frame_cam_int(img_bgr.shape, x0, y0), inference_type=inference_type)
+    if not r: return None
+    r = r[0] if isinstance(r, list) else r
+    # ROI 座標 -> 元画像座標
+    offset = np.array([x0, y0], dtype=np.float32)
+    if "pred_keypoints_2d" in r: r["pred_keypoints_2d"] = r["pred_keypoints_2d"] + offset
+    if "bbox" in r: r["bbox"] = r["bbox"] + np.tile(offset, 2)
+    return r
+
+def recover_batched(est, img_bgr, persons, inference_type, batch_size):
+    """
+    複数人を bbox + マスクプロンプト付きで batch_size 人ずつまとめて順伝播し、{id: r} を返す。
+    CUDA OOM の場合はチャンクを半分に割って再試行する (メモリ上限付きのバッチ化)。
+    """
+    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+    chunks = [persons[i:i + batch_size] for i in range(0, len(persons), batch_size)]
+    print(f"  -> Batched recovery: {len(persons)} persons in {len(chunks)} forward pass(es) (batch_size={batch_size})")
+    results = {}
+    while chunks:
+        check_cancel()
+        chunk = chunks.pop(0)
+        boxes = np.array([m['bbox'] for m in chunk], dtype=np.float32)
+        # マスクプロンプトは全画面の配列で渡す必要があるため、ここでだけ展開する
+        masks = np.stack([m['segmentation'].to_full() for m in chunk])
+        try:
+            outs = est.process_one_image(img_rgb, bboxes=boxes, masks=masks, inference_type=inference_type)
+        except torch.cuda.OutOfMemoryError:
+            if len(chunk) == 1: raise
+            half = len(chunk) // 2
+            print(f"  ⚠ CUDA OOM with {len(chunk)} persons per pass. Retrying with {half}...")
+            del masks; clear_memory()
+            chunks[:0] = [chunk[:half], chunk[half:]]
+            continue
+        for m, r in zip(chunk, outs or []):
+            results[m['id']] = r
+        del masks; clear_memory()
+    return results
+
+# ==========================================
+# [Step 3] SAM 3DB: Placement
+# ==========================================
+def grouped_percentile(values, labels, n, q):
+    """labels (0..n-1) ごとの np.percentile (線形補間) を1回のソートでまとめて計算する。要素の無いグループは nan"""
+    order = np.lexsort((values, labels)); v = values[order]
+    counts = np.bincount(labels, minlength=n); starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    pos = np.maximum(counts - 1, 0) * (q / 100.0); lo = np.floor(pos).astype(int); frac = pos - lo
+    hi = np.minimum(lo + 1, np.maximum(counts - 1, 0))
+    out = np.full(n, np.nan); ok = counts > 0
+    out[ok] = v[starts[ok] + lo[ok]] * (1 - frac[ok]) + v[starts[ok] + hi[ok]] * frac[ok]
+    return out
+
+def compute_placements(persons, depth, img_shape, fov_deg):
+    """
+    全員分の配置 {id: (z, xoff, yoff)} をまとめて計算する (ピンホールカメラモデル, ユーザー指定の FOV)。
+    有効な深度が取れなかった人物は None。
+    """
+    if not persons: return {}
+    h_img, w_img = img_shape[:2]
+    f_pix = (max(w_img, h_img) / 2) / np.tan(np.deg2rad(fov_deg) / 2)
+    # 人物全体の深度分布を取得 (マスクの bbox 内だけを参照)。背景(0)は除外
+    vals = [depth.sample(m['segmentation']) for m in persons]
+    vals = [v[v > 1e-3] for v in vals]
+    labels = np.repeat(np.arange(len(persons)), [len(v) for v in vals])
+    allv = np.concatenate(vals).astype(np.float64)
+    # 以前は足元(90%付近)のみを見ていたが、姿勢によって不安定なため、
+    # 全体のメディアンと足元のパーセンタイル (奥行き方向の最大(奥)に近い値) を組み合わせて安定させる。
+    # SAM3D Bodyの出力は通常、骨盤付近が原点
+    z = (grouped_percentile(allv, labels, len(persons), 50) + grouped_percentile(allv, labels, len(persons), 90)) / 2
+    # 人物の2D中心 (bboxを使用) から X, Y オフセットを計算
+    b = np.array([m['bbox'] for m in persons], dtype=np.float64)
+    xoff = ((b[:, 0] + b[:, 2]) / 2 - w_img / 2) * z / f_pix
+    yoff = ((b[:, 1] + b[:, 3]) / 2 - h_img / 2) * z / f_pix
+    return {m['id']: (None if np.isnan(z[i]) else (float(z[i]), float(xoff[i]), float(yoff[i]))) for i, m in enumerate(persons)}
+
+def apply_placement(r, m, placement, args, person_index):
+    """推論結果 r (MHR座標) に 3D 空間上の配置オフセットを加える (in-place)。placement は compute_placements の結果"""
+    pid = m['id']
+    if args.use_moge:
+        if placement is not None:
+            z_val, xoff, yoff = placement
+            print(f"    ℹ️ MoGe2 Projection: Z={z_val:.3f}, Offsets=({xoff:.3f}, {yoff:.3f}), FOV={args.fov}")
             
-            # 生の出力を取得
-            print(f"  -> Running SAM3 inference...")
-            img_rgb_pil = PIL.Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
-            inference_state = detector.processor.set_image(img_rgb_pil)
-            raw_sam3_output = detector.processor.set_text_prompt(state=inference_state, prompt=args.text_prompt)
-            boxes = raw_sam3_output["boxes"].cpu().numpy()
-            scores = raw_sam3_output["scores"].cpu().numpy()
-            # スコアでフィルタリング
-            keep = scores > args.conf_threshold
-            boxes = boxes[keep]
-            # HumanDetector.sam3_run が行う拡大処理を再現 (引数から反映)
-            scale = args.box_scale
-            enlarged_boxes = []
-            for box in boxes:
-                x1, y1, x2, y2 = box
-                cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
-                w, h = (x2 - x1) * scale, (y2 - y1) * scale
-                enlarged_boxes.append([max(cx - w / 2, 0), max(cy - h / 2, 0), min(cx + w / 2, img_bgr.shape[1]), min(cy + h / 2, img_bgr.shape[0])])
-            boxes = np.array(enlarged_boxes)
-            # マスクも保持
-            raw_sam3_masks = raw_sam3_output["masks"][keep].cpu().numpy()
+            # 3D座標の更新 (MHR形式: X, Y, Z)
+            for k in ['pred_keypoints_3d', 'pred_vertices']:
+                r[k][..., 0] += xoff
+                r[k][..., 1] += yoff
+                r[k][..., 2] += z_val
         else:
-            if 'detector' not in locals():
-                detector = HumanDetector(name=args.detector_name, device=device, path=det_path)
-                
-            print(f"  -> Running {args.detector_name} inference (prompt: {args.text_prompt})...")
-            boxes = detector.run_human_detection(img_bgr, bbox_thr=args.conf_threshold, nms_thr=args.nms_thr)
-            raw_sam3_masks = None
-            
+            print(f"    ⚠ Warning: No valid depth found in mask for ID {pid}")
+    else:
+        # MoGe オフの場合: 
+        # 複数人が重ならないよう、1.2m ずつ X 軸方向にずらして配置する
+        offset_x = (person_index - 1) * 1.2
+        if offset_x != 0:
+            print(f"    ℹ️ (MoGe Off) Applying horizontal offset: {offset_x:.2f}m")
+            for k in ['pred_keypoints_3d', 'pred_vertices']:
+                r[k][..., 0] += offset_x
+
+# ==========================================
+# [Step 4] FBX/BVH/OBJ Generation
+# ==========================================
+def write_static_meshes(r, faces, pid, output_dir, ply=False):
+    """OBJ (と任意で PLY) を numpy から直接書き出す (Blender 不要)"""
+    from convert import mesh_io
+    obj_out = os.path.join(output_dir, f'output_{pid}.obj')
+    mesh_io.write_obj(obj_out, r["pred_vertices"], faces)
+    print(f"      ✅ OBJ generated for ID {pid}")
+    if ply:
+        mesh_io.write_ply(os.path.join(output_dir, f'output_{pid}.ply'), r["pred_vertices"], faces)
+        print(f"      ✅ PLY generated for ID {pid}")
+
+def write_native_bvh(r, pid, output_dir):
+    """Standard / Inverted Pose の BVH をキーポイントから直接書き出す (Blender 不要)"""
+    from convert import mhr_bvh
+    mhr_bvh.save_variants(r["pred_keypoints_3d"], os.path.join(output_dir, f"output_{pid}.bvh"), os.path.join(output_dir, f"output_{pid}_inverted.bvh"), vertices=r["pred_vertices"])
+    print(f"      ✅ Standard / Inverted Pose BVH generated for ID {pid}")
+
+def write_payload(r, faces, pid, output_dir, fmt="binary"):
+    """Blender に渡す1人分の中間データを書き出す (binary: mhr_payload / json: 従来の tjson)
+    faces がトポロジーキャッシュの場合、binary では面データを複製せずキャッシュの .npy を参照する"""
+    faces_path = getattr(faces, "faces_path", None)
+    if hasattr(faces, "faces"): faces = faces.faces
+    data = {"vertices": r["pred_vertices"], "faces": faces, "joints_mhr70": r["pred_keypoints_3d"]}
+    if fmt == "json":
+        tjp = os.path.join(output_dir, f"tjson_{pid}.json")
+        with open(tjp, 'w') as f: json.dump({k: np.asarray(v).tolist() for k, v in data.items()}, f)
+        return tjp
+    from convert.lib import mhr_payload
+    if faces_path: del data["faces"]
+    return mhr_payload.save(os.path.join(output_dir, f"payload_{pid}{mhr_payload.EXT}"), data, refs={"faces": faces_path} if faces_path else None)
+
+def build_person_tasks(r, faces, pid, output_dir, bvh=True, fmt="binary"):
+    """1人分の中間データを書き出し、Blender 書き出しタスク (FBX [-> BVH x2]) と中間ファイルのパスを返す"""
+    fbp = os.path.join(output_dir, f"output_{pid}.fbx"); tjp = write_payload(r, faces, pid, output_dir, fmt)
+    tasks = [
+        {"id": f"fbx_{pid}", "op": "fbx", "pid": pid, "input": tjp, "output": fbp},
+        # 1. Standard BVH / 2. Inverted Pose BVH (Crysta twist fix)
+        {"id": f"bvh_{pid}_std", "op": "bvh", "pid": pid, "input": fbp, "output": os.path.join(output_dir, f"output_{pid}.bvh"), "mode": "std", "after": [f"fbx_{pid}"]},
+        {"id": f"bvh_{pid}_inv", "op": "bvh", "pid": pid, "input": fbp, "output": os.path.join(output_dir, f"output_{pid}_inverted.bvh"), "mode": "quat_x90", "after": [f"fbx_{pid}"]},
+    ]
+    return (tasks if bvh else tasks[:1]), tjp
+
+_TASK_LABELS = {
+    ("fbx", "ok"): "✅ FBX generated for ID {pid}",
+    ("fbx", "failed"): "⚠ FBX generation FAILED for ID {pid}",
+    ("bvh", "ok"): "✅ {mode} BVH generated for ID {pid}",
+}
+
+def run_export_tasks(tasks, workers=1):
+    """
+    Blender 書き出しタスクを実行し、結果を表示する。workers=1 は1つの (常駐 or 単発) Blender でまとめて、
+    それ以外 (0 = 自動) は人物ごとの依存グループ (FBX -> BVH x2) を複数の Blender に分けて並列に実行する。
+    結果の各タスクには pid を付けて返す。
+    """
+    from convert import blender_export
+    if workers == 1: mode = "resident server" if blender_export.server_available() else "one-shot"
+    else: mode = f"up to {blender_export.max_workers(workers)} parallel one-shot Blenders"
+    print(f"    -> Running {len(tasks)} Blender export task(s) ({mode})...")
+    result = blender_export.run_tasks(tasks, workers=workers)
+    by_id = {t["id"]: t for t in tasks}
+    for res in result.get("tasks", []):
+        task = by_id.get(res["id"], {}); res["pid"] = task.get("pid")
+        label = _TASK_LABELS.get((res["op"], res["status"]))
+        if label:
+            variant = "Standard" if task.get("mode") == "std" else "Inverted Pose"
+            print("      " + label.format(pid=task.get("pid"), mode=variant) + f" ({res['seconds']:.1f}s)")
+        elif res["status"] != "ok":
+            print(f"      ⚠ {res['op'].upper()} {res['status']} for {os.path.basename(str(res['output']))}: {res.get('error')}")
+    print(f"    -> Blender export: {result.get('seconds', 0.0):.1f}s with {result.get('workers', 1)} worker(s)")
+    return result
+
+class ExportPipeline:
+    """
+    Step 3 (復元) と Step 4 (書き出し) を重ねるためのキュー。復元ループが put() した人物を、このスレッドが順に
+    OBJ / BVH / 中間データとして書き出し、Blender タスクはその時点でキューに溜まっている人数分をまとめて1回で実行する。
+    キューには上限 (maxsize) があり、書き出しが追いつかないときは復元側が待つ (結果をメモリに溜め込まない)。
+    """
+    def __init__(self, output_dir, args, maxsize=2):
+        self.output_dir, self.args = output_dir, args
+        self.q = queue.Queue(maxsize=max(1, maxsize))
+        self.aborted = False; self.n_exported = 0
+        self.report = [] # タスクごとの所要時間と失敗 (export_report.json)
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def put(self, r, faces, pid):
+        self._put((r, faces, pid))
+
+    def close(self, abort=False):
+        """キューを閉じて残りの書き出しを待つ。abort=True ならまだ始まっていない分は捨てる"""
+        self.aborted = abort
+        if self.thread.is_alive(): self._put(None)
+        self.thread.join()
+
+    def _put(self, item):
+        # 書き出しスレッドが止まっていたら満杯のキューで待ち続けずにエラーにする
+        while True:
+            if not self.thread.is_alive(): raise RuntimeError("export thread stopped unexpectedly")
+            try:
+                self.q.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def _timed(self, op, pid, output, fn, *a, **kw):
+        """fn を実行して所要時間と成否を report に残す。失敗しても例外は投げず None を返す"""
+        t0 = time.time(); res = {"id": f"{op}_{pid}", "op": op, "pid": pid, "output": output, "status": "ok", "error": None, "worker": "main"}
+        try:
+            return fn(*a, **kw)
+        except Exception as e:
+            res.update(status="failed", error=str(e))
+            print(f"      ⚠ {op.upper()} FAILED for ID {pid}: {e}")
+        finally:
+            res["seconds"] = time.time() - t0; self.report.append(res)
+
+    def _export(self, r, faces, pid):
+        args, out = self.args, self.output_dir
+        # OBJ (Static Mesh) と native BVH は Blender を介さずその場で書き出す
+        self._timed("obj", pid, os.path.join(out, f"output_{pid}.obj"), write_static_meshes, r, faces, pid, out, ply=args.export_ply)
+        if args.bvh_backend == "native":
+            self._timed("bvh_native", pid, os.path.join(out, f"output_{pid}.bvh"), write_native_bvh, r, pid, out)
+        return self._timed("payload", pid, None, build_person_tasks, r, faces, pid, out, bvh=args.bvh_backend == "blender", fmt=args.payload_format) or ([], None)
+
+    def write_report(self, path):
+        """タスクごとの所要時間と失敗をまとめて書き出し、失敗があればログにも出す"""
+        failed = [t for t in self.report if t["status"] != "ok"]
+        with open(path, "w") as f:
+            json.dump({"tasks": self.report, "failed": [t["id"] for t in failed], "seconds": sum(t.get("seconds") or 0.0 for t in self.report)}, f, indent=1)
+        print(f"    📋 Export report: {len(self.report)} task(s), {len(failed)} failed ({os.path.basename(path)})")
+        for t in failed: print(f"      ⚠ {t['id']}: {t.get('error')}")
+
+    def _loop(self):
+        done = False
+        while not done:
+            items = [self.q.get()]
+            # 溜まっている分はまとめて1つの Blender に渡す (単発 Blender の起動回数を減らす)
+            while items[-1] is not None:
+                try: items.append(self.q.get_nowait())
+                except queue.Empty: break
+            if items[-1] is None: done = True; items.pop()
+            if self.aborted or not items: continue
+            # 例外でこのスレッドが止まると put() / close() が満杯のキューで永久に待つため、
+            # どこで失敗しても report に記録してキューを読み続ける
+            tasks = []; payload_paths = []
+            try:
+                for r, faces, pid in items:
+                    t, tjp = self._export(r, faces, pid)
+                    tasks.extend(t)
+                    if tjp: payload_paths.append(tjp)
+                if tasks:
+                    try:
+                        self.report.extend(run_export_tasks(tasks, workers=self.args.export_workers).get("tasks", []))
+                    except Exception as e:
+                        print(f"    ⚠ Blender export FAILED: {e}")
+                        self.report.extend({"id": t["id"], "op": t["op"], "pid": t.get("pid"), "output": t.get("output"), "status": "failed", "error": str(e), "seconds": 0.0} for t in tasks)
+            except Exception as e:
+                print(f"    ⚠ Export FAILED for ID(s) {[it[2] for it in items]}: {e}")
+                self.report.extend({"id": f"export_{it[2]}", "op": "export", "pid": it[2], "output": None, "status": "failed", "error": str(e), "seconds": 0.0} for it in items)
+            finally:
+                # 不要な中間ファイルを削除 (消せなくても処理は続ける)
+                for p in payload_paths:
+                    try: os.remove(p)
+                    except OSError: pass
+                self.n_exported += len(items)
+
+# ==========================================
+# [Step 5] Combined GLB for Preview
+# ==========================================
+def write_preview_glb(meshes, output_dir):
+    """全員分のメッシュを1つの GLB にまとめて numpy から直接書き出す (Blender 不要)"""
+    from convert import glb
+    ts = int(time.time())
+    glb_out = os.path.join(output_dir, f"output_preview_combined_{ts}.glb")
+    glb.write_glb(glb_out, meshes)
+    return glb_out
+
+# ==========================================
+# 🎬 Video: フレームごとの推論 -> 人物ごとのアニメーション BVH
+# ==========================================
+VIDEO_EXTS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v")
+
+def is_video(path):
+    return os.path.splitext(str(path))[1].lower() in VIDEO_EXTS
+
+def iter_video_frames(path, stride=1, max_frames=0):
+    """
+    動画を1フレームずつ読み出すジェネレータ ((frame_idx, img_bgr) を返す)。
+    全フレームを展開・保存しないため、メモリ使用量はフレーム1枚分で一定。
+    間引くフレームは grab() のみでデコードしない。
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened(): raise IOError(f"cannot open video: {path}")
+    try:
+        idx = 0; yielded = 0
+        while True:
+            if idx % stride:
+                if not cap.grab(): break
+                idx += 1; continue
+            ok, frame = cap.read()
+            if not ok: break
+            yield idx, frame
+            idx += 1; yielded += 1
+            if max_frames and yielded >= max_frames: break
+    finally:
+        cap.release()
+
+def video_info(path):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0; count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    cap.release()
+    return (fps if fps > 0 else 30.0), count
+
+def recover_frame(est, img_bgr, persons, args):
+    """1フレーム分の人物を推論し {id: r (numpy)} を返す"""
+    # 人数でモードが変わるとトラックの途中で推論結果の傾向が切り替わるため、recovery_mode に従う
+    if recovery_mode(args) == "prompt":
+        preds = recover_batched(est, img_bgr, persons, args.inference_type, args.batch_size)
+    else:
+        preds = {m['id']: recover_single(est, img_bgr, m, m['segmentation'], args.inference_type) for m in persons}
+    return {pid: to_numpy_result(r) for pid, r in preds.items() if r}
+
+def new_track():
+    return {"frames": [], "kp3d": [], "head_top": [], "seen": 0, "last_seen": -1, "key_box": None, "skipped": 0, "checks": []}
+
+def needs_keyframe(track, bbox, fidx, stride, args):
+    """前回 3D 復元したときの bbox からの 2D の動き (bbox の高さ比) で、このフレームを復元するかを決める"""
+    if args.keyframe_motion <= 0 or track["key_box"] is None: return True
+    if (fidx - track["frames"][-1]) // stride >= args.keyframe_max_gap: return True
+    kb = np.asarray(track["key_box"]); b = np.asarray(bbox)
+    motion = np.abs(b - kb).max() / max(kb[3] - kb[1], 1.0)
+    return motion >= args.keyframe_motion
+
+def write_track_bvh(tid, track, frametime, stride, output_dir):
+    """キーフレーム (復元したフレーム) から、最後に見えたフレームまでの連続した BVH を書き出す。
+    間のフレーム (未復元・未検出・間引き) は関節回転を SLERP、ルート位置を線形補間する"""
+    from convert import mhr_bvh
+    steps = np.asarray(track["frames"]) // stride
+    until = track["last_seen"] // stride
+    std_out = os.path.join(output_dir, f"output_track_{tid}.bvh"); inv_out = os.path.join(output_dir, f"output_track_{tid}_inverted.bvh")
+    mhr_bvh.save_variants(np.stack(track["kp3d"]), std_out, inv_out, frametime=frametime, head_top=np.stack(track["head_top"]), frames=steps, until=until)
+    return std_out, int(until - steps[0] + 1)
+
+def track_keyframe_error(track, stride):
+    """参照用に推論したフレームに対する補間結果の関節位置誤差 (平均, m)"""
+    from convert import mhr_bvh
+    checks = [c for c in track["checks"] if c[0] > track["frames"][0]]
+    if not checks: return None
+    ref_steps = np.array([c[0] for c in checks]) // stride
+    return mhr_bvh.keyframe_error(np.stack(track["kp3d"]), np.asarray(track["frames"]) // stride, np.stack([c[1] for c in checks]), ref_steps,
+                                  head_top=np.stack(track["head_top"]), ref_head_top=np.stack([c[2] for c in checks]))
+
+def track_persons(prev_gray, gray, persons, min_conf):
+    """前フレームの人物 (id = トラック ID) を bbox / マスクごとフローで移動させる。信頼度が足りなければ None"""
+    from tracker import propagate_boxes
+    boxes, shifts, conf = propagate_boxes(prev_gray, gray, [m['bbox'] for m in persons])
+    if len(conf) == 0 or conf.min() < min_conf: return None
+    moved = []
+    for m, box, (dx, dy) in zip(persons, boxes, shifts):
+        moved.append(dict(m, bbox=[float(x) for x in box], segmentation=m['segmentation'].shift(dx, dy)))
+    return moved
+
+def run_video(args, models=None, output_dir=OUTPUT_DIR):
+    """
+    動画入力: モデルは1度だけロードし、フレームをストリームしながら検出 -> 3D 復元 -> トラッキングを行い、
+    追跡できた人物ごとに Frame Time 付きのアニメーション BVH (Standard / Inverted Pose) を書き出す。
+    検出器はキーフレーム (--detect_every ごと、または追跡の信頼度が落ちたとき) だけで回し、間は bbox をフローで伝播する。
+    人物 ID はトラック ID で、--target_ids もトラック ID で指定する。
+    """
+    from tracker import IoUTracker
+    from convert.mhr_bvh import HEAD_TOP_VERTEX
+    time_start = time.time()
+    cleanup_outputs(output_dir); device = "cuda" if torch.cuda.is_available() else "cpu"
+    if models is None: models = ModelRegistry(device)
+    stride = max(1, args.frame_stride)
+
+    try:
+        fps, count = video_info(args.image_path)
+        frames = iter_video_frames(args.image_path, stride, args.max_frames)
+    except Exception as e:
+        print(f"❌ ERROR: Failed to open video {args.image_path}: {e}")
+        return 1
+    total = (count + stride - 1) // stride if count else 0
+    if args.max_frames and (not total or total > args.max_frames): total = args.max_frames
+    frametime = stride / fps
+    print(f"--- [Video] {os.path.basename(args.image_path)}: {fps:.2f} fps, {count} frames, stride {stride} (Frame Time {frametime:.6f}s) ---")
+
+    detector = models.get_detector(args.detector_name)
+    est = models.get_estimator()
+    # max_age は元動画のフレーム番号の差で比べるので、stride ではなく生フレーム数 (約1秒、最低でも1処理分) で渡す
+    tracker = IoUTracker(iou_threshold=args.track_iou, max_age=max(stride, int(round(fps))))
+    tracks = {}; last_frame = None; n_done = 0; n_detect = 0; n_recovered = 0
+    target_id_list = args.target_ids.split(",") if args.target_ids else []
+    detect_every = max(1, args.detect_every)
+    persons = []; prev_gray = None; since_detect = 0
+
+    try:
+        for fidx, img_bgr in frames:
+            check_cancel()
+            n_done += 1
+            print(f"--- [Step 3] Processing {n_done} of {total or '?'} frames (frame {fidx}) ---")
+            gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+            moved = None
+            if persons and prev_gray is not None and since_detect < detect_every:
+                moved = track_persons(prev_gray, gray, persons, args.track_min_conf)
+            if moved is not None:
+                persons = moved; since_detect += 1
+                for m in persons: tracker.observe(m['id'], m['bbox'], fidx)
+            else:
+                # キーフレーム: 検出してトラッカーで ID を対応付ける
+                boxes, raw_masks = refilter(run_detection(detector, args.detector_name, img_bgr, args), args.detector_name, args.conf_threshold, args.box_scale)
+                persons = build_valid_masks(boxes, raw_masks, img_bgr.shape, args.min_area); del raw_masks
+                for m, tid in zip(persons, tracker.update([m['bbox'] for m in persons], fidx)): m['id'] = tid
+                since_detect = 1; n_detect += 1
+            prev_gray = gray
+            to_p = [m for m in persons if not target_id_list or str(m['id']) in target_id_list]
+            # キーフレーム復元: 動きの大きい人物だけ推論する (--keyframe_check 指定時は参照用の推論も混ぜる)
+            key_p, check_p = [], []
+            for m in to_p:
+                t = tracks.setdefault(m['id'], new_track())
+                t["seen"] += 1; t["last_seen"] = fidx
+                if needs_keyframe(t, m['bbox'], fidx, stride, args): key_p.append(m)
+                else:
+                    t["skipped"] += 1
+                    if args.keyframe_check and t["skipped"] % args.keyframe_check == 0: check_p.append(m)
+            if not key_p and not check_p: continue
+            n_recovered += len(key_p)
+            preds = recover_frame(est, img_bgr, key_p + check_p, args)
+            for m in key_p + check_p:
+                tid = m['id']; r = preds.get(tid)
+                if r is None: continue
+                # pred_cam_t を足してカメラ座標上の移動 (ルートモーション) を残す
+                kp = (r["pred_keypoints_3d"] + r.get("pred_cam_t", np.zeros(3))).astype(np.float32)
+                head = (r["pred_vertices"][HEAD_TOP_VERTEX] + r.get("pred_cam_t", np.zeros(3))).astype(np.float32)
+                t = tracks[tid]
+                if any(m is c for c in check_p):
+                    t["checks"].append((fidx, kp, head)); continue
+                t["frames"].append(fidx); t["kp3d"].append(kp); t["head_top"].append(head); t["key_box"] = list(m['bbox'])
+            if key_p: last_frame = (img_bgr, key_p, {m['id']: preds[m['id']] for m in key_p if m['id'] in preds})
+            del preds; clear_memory()
+    finally:
+        frames.close()
+        models.release_detectors()
+
+    print(f"  Detector ran on {n_detect} of {n_done} frames. 3D recovery ran {n_recovered} times for {sum(t['seen'] for t in tracks.values())} person-frames.")
+    print(f"--- [Step 4] Writing animated BVH ({len(tracks)} tracks) ---")
+    written = []; fbx_tasks = []
+    for tid, t in sorted(tracks.items()):
+        if t["seen"] < args.min_track_frames or not t["frames"]:
+            print(f"    ⚠ Track {tid}: only {t['seen']} frames. Skipped.")
+            continue
+        bvh_out, n = write_track_bvh(tid, t, frametime, stride, output_dir)
+        written.append(bvh_out)
+        print(f"      ✅ Animated BVH generated for track {tid} ({n} frames from {len(t['frames'])} keyframes, frames {t['frames'][0]}-{t['last_seen']})")
+        err = track_keyframe_error(t, stride)
+        if err is not None:
+            t["keyframe_error_cm"] = {"mean": float(err.mean() * 100), "max": float(err.max() * 100), "frames": len(err)}
+            print(f"      ℹ️ Interpolation error vs full inference: mean {err.mean()*100:.2f}cm, max {err.max()*100:.2f}cm ({len(err)} reference frames)")
+        if args.video_fbx:
+            fbx_tasks.append({"id": f"fbx_track_{tid}", "op": "bvh_fbx", "pid": f"track {tid}", "input": bvh_out, "output": os.path.join(output_dir, f"output_track_{tid}.fbx")})
+    if fbx_tasks:
+        run_export_tasks(fbx_tasks, workers=args.export_workers)
+
+    with open(os.path.join(output_dir, "video_tracks.json"), "w") as f:
+        json.dump({"fps": fps, "stride": stride, "frame_time": frametime, "tracks": {str(tid): {"first": t["frames"][0] if t["frames"] else None, "last": t["last_seen"], "frames": t["seen"], "keyframes": len(t["frames"]), "keyframe_error_cm": t.get("keyframe_error_cm")} for tid, t in tracks.items()}}, f)
+
+    if last_frame is not None:
+        from sam_3d_body.visualization.skeleton_visualizer import SkeletonVisualizer
+        from sam_3d_body.metadata.mhr70 import pose_info
+        viz = SkeletonVisualizer(radius=4, line_width=2); viz.set_pose_meta(pose_info)
+        img_bgr, persons, preds = last_frame; v_img = img_bgr.copy()
+        for r in preds.values():
+            v_img = viz.draw_skeleton(v_img, np.hstack([r["pred_keypoints_2d"], np.ones((70,1))]))
+        if output_dir == OUTPUT_DIR: cv2.imwrite(VIS_OUTPUT, v_img)
+        cv2.imwrite(os.path.join(output_dir, "output_vis_skeleton.jpg"), v_img)
+
+    if not written:
+        print("⚠ No track was long enough for an animated BVH.")
+    print(f"✅ SUCCESS. {n_done} frames in {time.time()-time_start:.2f}s")
+    return 0
+
+# ==========================================
+# 🚀 パイプライン本体
+# ==========================================
+def run(args, models=None, output_dir=OUTPUT_DIR):
+    """
+    1ジョブ分のパイプライン (Step 1〜5) を実行し、終了コードを返す。
+    models を渡すとそのモデルを使い回す (常駐デーモン)。None の場合はこの呼び出しの中でロード・解放する。
+    """
+    if is_video(args.image_path): return run_video(args, models, output_dir)
+    time_start = time.time()
+    debug_dir = os.path.join(output_dir, "debug_masks")
+    cleanup_outputs(output_dir); device = "cuda" if torch.cuda.is_available() else "cpu"
+    if models is None: models = ModelRegistry(device)
+    
+    try:
+        img_bgr = load_input_image(args.image_path)
+    except Exception as e:
+        print(f"❌ ERROR: Failed to load image {args.image_path}: {e}")
+        return 1
+
+    # [Step 1] Detection
+    print(f"--- [Step 1] Detection using '{args.detector_name}' (prompt: '{args.text_prompt}') ---")
+    image_key = resolve_image_key(img_bgr, args)
+    try:
+        raw = detect_cached(models, img_bgr, args, image_key)
+        # UI がスライダー変更時にモデル無しで再フィルタリングできるよう、生の検出結果を出力に残す
+        save_raw(os.path.join(output_dir, RAW_FILE), raw, detection_params(args), source=file_digest(args.image_path))
+        boxes, raw_sam3_masks = refilter(raw, args.detector_name, args.conf_threshold, args.box_scale); del raw
     except Exception as e:
         print(f"❌ ERROR in Detection Initialization/Execution: {e}")
         boxes = np.array([[0, 0, img_bgr.shape[1], img_bgr.shape[0]]])
         raw_sam3_masks = None
 
-    valid_masks = []
     print(f"  Total detected boxes: {len(boxes)}")
-
-    for i, box in enumerate(boxes):
-        x1, y1, x2, y2 = map(int, box)
-        area = int((x2 - x1) * (y2 - y1))
-        
-        # マスク生成: SAM3の場合は精密なマスクを使用、それ以外は矩形
-        if raw_sam3_masks is not None and i < len(raw_sam3_masks):
-            # 保存前に確実に 2次元 boolean に整形
-            mask = raw_sam3_masks[i]
-            if mask.ndim > 2:
-                mask = np.squeeze(mask)
-                if mask.ndim > 2: mask = mask[0]
-            mask = mask.astype(bool)
-        else:
-            mask_uint8 = np.zeros(img_bgr.shape[:2], dtype=np.uint8)
-            cv2.rectangle(mask_uint8, (x1, y1), (x2, y2), 1, -1)
-            mask = mask_uint8.astype(bool)
-
-        if area > args.min_area:
-            valid_masks.append({
-                'id': int(i), 
-                'segmentation': mask, 
-                'area': area, 
-                'score': 1.0, 
-                'bbox': [float(x) for x in box] 
-            })
-        # ログ過多によるスタック防止のため、除外ログを抑制
-
+    valid_masks = build_valid_masks(boxes, raw_sam3_masks, img_bgr.shape, args.min_area)
     print(f"  Detected {len(valid_masks)} persons (after filtering).")
     
-    for i, m in enumerate(valid_masks):
-        dbg = img_bgr.copy()
-        h, w = dbg.shape[:2]
-        
-        # 1. 人物の強調 (鮮やかなオレンジの縁取り + 非選択エリアの減光)
-        # OpenCVのエラーとIndexErrorを避けるため、マスクを確実に 2次元・(H, W)・uint8 に変換
-        mask_raw = m['segmentation']
-        if mask_raw.ndim > 2:
-            # (1, H, W) -> (H, W) 等、1の次元をすべて取り除く
-            mask_raw = np.squeeze(mask_raw)
-            if mask_raw.ndim > 2: # それでも多次元なら最初のチャンネルを選択
-                mask_raw = mask_raw[0]
-
-        mask_u8 = (mask_raw.astype(np.uint8)) * 255
-        mask_bool = mask_raw.astype(bool)
-
-        ctrs, _ = cv2.findContours(mask_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cv2.drawContours(dbg, ctrs, -1, (0, 128, 255), 8) # 縁取り
-        
-        # 背景減光 (マスク外を 1/6 に)
-        dbg[~mask_bool] = (dbg[~mask_bool] // 6).astype(np.uint8)
-        
-        # 2. 下部に「外枠」として巨大なIDバーを付け足す (センタリング)
-        bar_h = int(h * 0.18)
-        if bar_h < 80: bar_h = 80
-        
-        # キャンバスを拡張 (元の画像 + 黒帯)
-        canvas = np.zeros((h + bar_h, w, 3), dtype=np.uint8)
-        canvas[0:h, 0:w] = dbg # 上部に元の画像(加工済み)を配置
-        
-        text = f"ID: {m['id']}"
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = h / 350.0 
-        if font_scale < 1.8: font_scale = 1.8
-        thickness = int(font_scale * 2.5)
-        
-        (t_w, t_h), _ = cv2.getTextSize(text, font, font_scale, thickness)
-        tx = max((w - t_w) // 2, 0)
-        # 拡張した部分の中央に配置
-        ty = h + (bar_h + t_h) // 2
-        cv2.putText(canvas, text, (tx, ty), font, font_scale, (255, 255, 255), thickness, cv2.LINE_AA)
-        
-        cv2.imwrite(os.path.join(DEBUG_DIR, f"detected_person_{i}.jpg"), canvas)
-
-    with open(os.path.join(OUTPUT_DIR, "detection_result.json"), "w") as f:
-        json.dump([{'id': m['id'], 'area': m['area'], 'score': m['score'], 'bbox': m['bbox']} for m in valid_masks], f)
+    if not args.no_previews:
+        # 書き終わった順にログへ出し、UI はそれを見てギャラリーを順次更新する
+        save_detection_previews(img_bgr, valid_masks, debug_dir, on_ready=lambda p: print(f"  -> Preview ready: {os.path.basename(p)}", flush=True))
+    write_detection_result(output_dir, valid_masks)
     
     # [Step 1 完了] メモリを徹底的に解放
     print("--- Cleaning up Step 1 memory ---")
-    if 'detector' in locals():
-        if hasattr(detector, 'detector'): del detector.detector
-        if hasattr(detector, 'processor'): del detector.processor
-        del detector
-    if 'raw_sam3_output' in locals(): del raw_sam3_output
-    if 'inference_state' in locals(): del inference_state
-    if 'm_s3' in locals(): del m_s3
-    if 'raw_sam3_masks' in locals(): del raw_sam3_masks
-    clear_memory()
+    del raw_sam3_masks
+    models.release_detectors()
     print("--- Step 1 memory cleaned ---")
 
     if args.sam3_only:
         print(f"✅ SUCCESS. Detection complete in {time.time()-time_start:.2f}s.")
-        sys.exit(0)
+        return 0
+    check_cancel()
+
+    target_id_list = args.target_ids.split(",") if args.target_ids else []
+    if target_id_list:
+        to_p = [m for m in valid_masks if str(m['id']) in target_id_list]
+    else:
+        # オートモード（クイック復元等）: 検出された全員を処理対象にする
+        to_p = valid_masks
 
     # [Step 2] MoGe2: Depth
-    depth_map = np.zeros(img_bgr.shape[:2], dtype=np.float32)
+    depth = None
     if args.use_moge:
         print(f"--- [Step 2] MoGe2: Depth Estimation ---")
-        import moge.model
-        m_m = moge.model.import_model_class_by_version("v2").from_pretrained("Ruicheng/moge-2-vitl-normal").to(device).eval()
-        with torch.no_grad():
-            img_rgb_t = torch.from_numpy(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)).permute(2,0,1).float().to(device)/255.0
-            inf_out = m_m.infer(img_rgb_t)
-            depth_map = inf_out['depth'].cpu().numpy()
-            depth_map = np.nan_to_num(depth_map, nan=0.0)
-            
-            # 深度マップを鮮明に可視化 (0を除いた有効範囲で正規化)
-            valid_mask = (depth_map > 1e-3)
-            if valid_mask.any():
-                v_min = np.percentile(depth_map[valid_mask], 2)
-                v_max = np.percentile(depth_map[valid_mask], 98)
-                d_vis = np.clip((depth_map - v_min) / (v_max - v_min + 1e-8), 0, 1)
-                # 有効領域以外（背景）は0にする
-                d_vis[~valid_mask] = 0
-            else:
-                d_vis = depth_map
-            
-            d_vis = (d_vis * 255).astype(np.uint8)
-            # 奥行きを直感的にするために色彩を調整
-            cv2.imwrite(os.path.join(OUTPUT_DIR, "output_depth.jpg"), cv2.applyColorMap(d_vis, cv2.COLORMAP_JET))
-            
+        depth = estimate_depth_cached(models, img_bgr, device, output_dir, args, image_key, persons=to_p)
         print("--- Cleaning up Step 2 memory ---")
-        del m_m, img_rgb_t; clear_memory()
+        models.release_moge()
         print("--- Step 2 memory cleaned ---")
+    check_cancel()
 
     # [Step 3] SAM 3DB: Estimation
     print(f"--- [Step 3] SAM 3DB: 3D Recovery (Mode: {args.inference_type}) ---")
     clear_memory()
     
-    target_id_list = args.target_ids.split(",") if args.target_ids else []
-    if target_id_list:
-        to_p = [m for m in valid_masks if str(m['id']) in target_id_list]
-    else:
-        # オートモード（クイック復元等）: 検出された全員を処理対象にする
-        to_p = valid_masks
-    
     print(f"--- Targets to process: {[m['id'] for m in to_p]} (Total: {len(to_p)}) ---")
     
     if not to_p:
         print("⚠ No persons found or selected for 3D recovery.")
-        sys.exit(0)
+        return 0
 
-    from sam_3d_body import load_sam_3d_body, SAM3DBodyEstimator
     from sam_3d_body.visualization.skeleton_visualizer import SkeletonVisualizer
     from sam_3d_body.metadata.mhr70 import pose_info
     
-    print("--- Loading SAM 3D Body model... ---")
-    model_3d, cfg_3d = load_sam_3d_body(SAM3DB_CKPT, device, MHR_MODEL_PT)
-    est = SAM3DBodyEstimator(model_3d, cfg_3d)
+    # 推論結果のキャッシュ (配置オフセット適用前の r)。FOV や MoGe 配置だけを変えた再実行では推論しない
+    from cache_store import ArrayCache, content_key
+    pred_cache = ArrayCache("predictions", max_entries=512, max_bytes=int(os.environ.get("SAM3D_PRED_CACHE_MB", "1024")) * 1024 * 1024)
+    meta_cache = ArrayCache("model_meta", max_entries=8)
+    masks = {m['id']: m['segmentation'] for m in to_p}
+    mode = recovery_mode(args)
+    pkeys = {m['id']: prediction_cache_key(image_key, m, masks[m['id']], args.inference_type, mode) for m in to_p}
+    cached = {}
+    if not args.no_cache:
+        for pid, key in pkeys.items():
+            hit = pred_cache.get(key)
+            if hit is not None: cached[pid] = hit
+    meta = meta_cache.get(model_fingerprint())
+    missing = [m for m in to_p if m['id'] not in cached]
+    if cached: print(f"  -> Reusing cached predictions for IDs {sorted(cached)} ({len(cached)}/{len(to_p)})")
+
+    est = None
+    if missing or meta is None:
+        est = models.get_estimator()
+        faces = est.faces
+        if not args.no_cache: meta_cache.put(model_fingerprint(), {"faces": np.asarray(faces, dtype=np.int32)})
+    else:
+        faces = meta["faces"]
+    # 全員・全実行で共通の MHR トポロジーは一度だけ検証してキャッシュ (メモリマップ) から参照する。
+    # 頂点数は faces から推測せず実際の pred_vertices から渡す (面に使われない末尾の頂点があると法線の長さがずれるため)
+    from convert import topology
     viz = SkeletonVisualizer(radius=4, line_width=2); viz.set_pose_meta(pose_info); v_img = img_bgr.copy()
 
-    all_json_paths = []
+    # --batch_size 2 以上を指定した場合だけ、複数人を batch_size 人ずつまとめて順伝播する (既定の 1 は従来どおり1人ずつ)。
+    # 入力の与え方 (recovery_mode) を揃えるため、未推論が1人だけでも batch_size>1 ならバッチ側で推論する。
+    # チャンクは順番が来たときに推論するので、前のチャンクの書き出しと次のチャンクの推論が重なる
+    batched = mode == "prompt"
+    preds = {}; attempted = set()
+
+    # MoGe 配置 (Z と X/Y オフセット) は全員分を1回で計算しておく
+    placements = compute_placements(to_p, depth, img_bgr.shape, args.fov) if depth is not None else {}
+
+    # 書き出し (Step 4) は別スレッドで、復元が終わった人物から順に進める
+    pipeline = ExportPipeline(output_dir, args, maxsize=args.export_queue)
+    preview_meshes = []; n_queued = 0
     person_count_total = 0 # 複数人時のオフセット用
-    for m in to_p:
-        pid = m['id']; mask = m['segmentation']; tmp = os.path.join(OUTPUT_DIR, f"temp_{pid}.jpg")
-        print(f"  -> Processing target ID {pid} (Processing {person_count_total + 1} of {len(to_p)})...")
-        person_count_total += 1
-        
-        # マスクの形状補正ロジック (略)
-        if mask.shape[:2] != img_bgr.shape[:2]:
-            if mask.ndim > 2: mask = np.squeeze(mask)
-            if mask.ndim != 2 or mask.shape != img_bgr.shape[:2]:
-                mask = cv2.resize(mask.astype(np.uint8), (img_bgr.shape[1], img_bgr.shape[0]), interpolation=cv2.INTER_NEAREST).astype(bool)
-
-        crp = img_bgr.copy()
-        try:
-            crp[~mask] = 0 
-            cv2.imwrite(tmp, crp); del crp
-        except Exception as e:
-            print(f" ⚠ Warning: Mask shape mismatch for ID {pid}: {e}.")
-            x1, y1, x2, y2 = map(int, m['bbox'])
-            crp = crp[y1:y2, x1:x2]; cv2.imwrite(tmp, crp); del crp
+    try:
+        for m in to_p:
+            check_cancel()
+            pid = m['id']
+            print(f"  -> Processing target ID {pid} (Processing {person_count_total + 1} of {len(to_p)})...")
+            person_count_total += 1
+            mask = masks[pid]
 
-        try:
-            r = est.process_one_image(tmp, inference_type=args.inference_type)
-            if not r:
-                print(f"    ⚠ Warning: No prediction returned for ID {pid}")
-                continue
-            r = r[0] if isinstance(r, list) else r
-            print(f"    ✅ Prediction success for ID {pid}")
-            for k in r:
-                if torch.is_tensor(r[k]): r[k] = r[k].cpu().numpy()
-                if isinstance(r[k], np.ndarray): r[k] = np.nan_to_num(r[k], nan=0.0)
-            
-            if args.use_moge:
-                # 3D空間上の位置を計算 (ピンホールカメラモデル)
-                # ユーザー指定のFOVを使用
-                fov_deg = args.fov
-                h_img, w_img = img_bgr.shape[:2]
-                f_pix = (max(w_img, h_img) / 2) / np.tan(np.deg2rad(fov_deg) / 2)
-                cx_img, cy_img = w_img / 2, h_img / 2
-                
-                # 人物の2D中心 (bboxを使用)
-                x1, y1, x2, y2 = m['bbox']
-                px, py = (x1 + x2) / 2, (y1 + y2) / 2
-                
-                # 深度 (Z) の取得
-                yc, _ = np.where(mask)
-                if len(yc) > 0:
-                    # 人物全体の深度分布を取得
-                    person_depths = depth_map[mask]
-                    # 背景(0)を除外
-                    valid_depths = person_depths[person_depths > 1e-3]
-                    
-                    if len(valid_depths) > 0:
-                        # 以前は足元(90%付近)のみを見ていたが、姿勢によって不安定なため、
-                        # 全体のメディアンと足元のパーセンタイルを組み合わせて安定させる
-                        z_median = np.median(valid_depths)
-                        z_feet = np.percentile(valid_depths, 90) # 奥行き方向の最大(奥)に近い値
-                        # 形状モデルの原点(Center)から足元までの距離を考慮しつつ配置
-                        # SAM3D Bodyの出力は通常、骨盤付近が原点
-                        z_val = float((z_median + z_feet) / 2)
-                        
-                        # X, Y オフセットの計算
-                        xoff = (px - cx_img) * z_val / f_pix
-                        yoff = (py - cy_img) * z_val / f_pix
-                        
-                        print(f"    ℹ️ MoGe2 Projection: Z={z_val:.3f}, Offsets=({xoff:.3f}, {yoff:.3f}), FOV={fov_deg}")
-                        
-                        # 3D座標の更新 (MHR形式: X, Y, Z)
-                        for k in ['pred_keypoints_3d', 'pred_vertices']:
-                            r[k][..., 0] += xoff
-                            r[k][..., 1] += yoff
-                            r[k][..., 2] += z_val
-                    else:
-                        print(f"    ⚠ Warning: No valid depth found in mask for ID {pid}")
-            else:
-                # MoGe オフの場合: 
-                # 複数人が重ならないよう、1.2m ずつ X 軸方向にずらして配置する
-                offset_x = (person_count_total - 1) * 1.2
-                if offset_x != 0:
-                    print(f"    ℹ️ (MoGe Off) Applying horizontal offset: {offset_x:.2f}m")
-                    for k in ['pred_keypoints_3d', 'pred_vertices']:
-                        r[k][..., 0] += offset_x
-            
-            v_img = viz.draw_skeleton(v_img, np.hstack([r["pred_keypoints_2d"], np.ones((70,1))]))
-            r['faces'] = est.faces; np.save(os.path.join(OUTPUT_DIR, f"output_{pid}.npy"), r)
+            try:
+                if pid in cached:
+                    r = cached[pid]
+                    print(f"    ✅ Prediction loaded from cache for ID {pid}")
+                else:
+                    if batched and pid not in attempted:
+                        chunk = [x for x in missing if x['id'] not in attempted][:args.batch_size]
+                        attempted.update(x['id'] for x in chunk)
+                        try:
+                            preds.update(recover_batched(est, img_bgr, chunk, args.inference_type, args.batch_size))
+                        except JobCancelled:
+                            raise
+                        except Exception as e:
+                            print(f"  ⚠ Batched recovery failed ({e}). Falling back to per-person recovery.")
+                            batched = False; clear_memory()
+                    used = "prompt" if pid in preds else "roi"
+                    if pid in preds: r = preds.pop(pid)
+                    elif batched: r = None
+                    else: r = recover_single(est, img_bgr, m, mask, args.inference_type)
+                    if not r:
+                        print(f"    ⚠ Warning: No prediction returned for ID {pid}")
+                        continue
+                    print(f"    ✅ Prediction success for ID {pid}")
+                    r = to_numpy_result(r)
+                    # バッチ推論の失敗で1人ずつに切り替えた場合は、実際の入力方式のキーで保存する
+                    key = pkeys[pid] if used == mode else prediction_cache_key(image_key, m, mask, args.inference_type, used)
+                    if not args.no_cache:
+                        try: pred_cache.put(key, cacheable_result(r))
+                        except OSError as e: print(f"    ⚠ Could not write prediction cache: {e}")
             
-            # [Step 4] Blender: FBX/BVH/OBJ Generation
-            print(f"    --- [Step 4] Blender: FBX/BVH/OBJ Generation for ID {pid} ---")
-            fbp = os.path.join(OUTPUT_DIR, f"output_{pid}.fbx"); tjp = os.path.join(OUTPUT_DIR, f"tjson_{pid}.json")
-            all_json_paths.append(tjp)
-            with open(tjp, 'w') as f: json.dump({"vertices": r["pred_vertices"].tolist(), "faces": est.faces.tolist(), "joints_mhr70": r["pred_keypoints_3d"].tolist()}, f)
+                apply_placement(r, m, placements.get(pid), args, person_count_total)
             
-            # FBX & BVH
-            subprocess.run(["blender", "--background", "--python", os.path.join(BASE_DIR, "convert", "lib", "blender_humanoid_builder_v2.py"), "--", tjp, fbp], capture_output=False)
-            if os.path.exists(fbp): 
-                print(f"      ✅ FBX generated for ID {pid}")
-                # 1. Standard BVH
-                bvh_std = os.path.join(OUTPUT_DIR, f"output_{pid}.bvh")
-                subprocess.run(["blender", "--background", "--python", os.path.join(BASE_DIR, "convert", "lib", "blender_bvh_crysta.py"), "--", fbp, bvh_std, "std"], capture_output=False)
-                if os.path.exists(bvh_std): print(f"      ✅ Standard BVH generated")
-                
-                # 2. Inverted Pose BVH (Crysta twist fix)
-                bvh_inv = os.path.join(OUTPUT_DIR, f"output_{pid}_inverted.bvh")
-                subprocess.run(["blender", "--background", "--python", os.path.join(BASE_DIR, "convert", "lib", "blender_bvh_crysta.py"), "--", fbp, bvh_inv, "quat_x90"], capture_output=False)
-                if os.path.exists(bvh_inv): print(f"      ✅ Inverted Pose BVH generated")
-            else:
-                print(f"      ⚠ FBX generation FAILED for ID {pid}")
+                v_img = viz.draw_skeleton(v_img, np.hstack([r["pred_keypoints_2d"], np.ones((70,1))]))
+                r['faces'] = faces; np.save(os.path.join(output_dir, f"output_{pid}.npy"), r)
             
-            # OBJ (Static Mesh) - 以前の NameError: v を修正
-            # f-string 内で backslash を使えない制約を回避するため事前にパスを加工
-            obj_out = os.path.join(OUTPUT_DIR, f'output_{pid}.obj')
-            obj_out_fixed = obj_out.replace('\\', '/')
-            tjp_fixed = tjp.replace('\\', '/')
-            # Blender 3.0.x (Colab) と 3.2+ (最新) の両対応
-            blender_script_obj = f"""
-import bpy,os,json,sys
-try:
-    import numpy as np
-except ImportError:
-    for p in ["/usr/local/lib/python3.10/dist-packages", "/usr/local/lib/python3.11/dist-packages", "/usr/local/lib/python3.12/dist-packages", "/usr/lib/python3/dist-packages"]:
-        if os.path.exists(p) and p not in sys.path: sys.path.append(p)
-bpy.ops.wm.read_factory_settings(use_empty=True)
-d=json.load(open('{tjp_fixed}'))
-m=bpy.data.meshes.new('Mesh')
-o=bpy.data.objects.new('Mesh',m)
-bpy.context.collection.objects.link(o)
-m.from_pydata([(v[0],v[2],-v[1]) for v in d['vertices']],[],d['faces'])
-bpy.context.view_layer.objects.active=o
-o.select_set(True)
-try:
-    bpy.ops.wm.obj_export(filepath='{obj_out_fixed}', export_selected_objects=True)
-except (AttributeError, RuntimeError):
-    bpy.ops.export_scene.obj(filepath='{obj_out_fixed}', use_selection=True)
-"""
-            subprocess.run(["blender", "--background", "--python-expr", blender_script_obj], capture_output=False)
-            if os.path.exists(obj_out):
-                print(f"      ✅ OBJ generated for ID {pid}")
-
-        except Exception as e: print(f" Error {pid}: {e}")
-        finally:
-            if os.path.exists(tmp): os.remove(tmp)
-            # 人物ごとの処理が終わるたびにメモリを解放 (Colabでの蓄積を防止)
-            clear_memory()
+                # OBJ / BVH / FBX の書き出しはキューに渡し、次の人物の推論と並行して進める
+                topo = topology.get(faces, num_verts=len(r["pred_vertices"]))
+                pipeline.put(r, topo, pid); n_queued += 1
+                preview_meshes.append((f"Person_{len(preview_meshes)}", r["pred_vertices"], topo))
+
+            except JobCancelled: raise
+            except Exception as e: print(f" Error {pid}: {e}")
+            finally:
+                # 人物ごとの処理が終わるたびにメモリを解放 (Colabでの蓄積を防止)
+                clear_memory()
+    except BaseException:
+        pipeline.close(abort=True)
+        raise
+
+    # [Step 4] 復元と並行して進めていた書き出しの残りを待つ
+    if n_queued:
+        print(f"--- [Step 4] Blender: FBX/BVH Generation ({n_queued} persons, {pipeline.n_exported} already exported during recovery) ---")
+    t0 = time.time(); pipeline.close()
+    if n_queued:
+        print(f"    ✅ Exports finished {time.time()-t0:.2f}s after recovery")
+        pipeline.write_report(os.path.join(output_dir, "export_report.json"))
 
-    # [Step 5] Combined GLB for Preview
-    if all_json_paths:
+    # [Step 5] プレビュー用の統合GLBはメモリ上の結果から直接書き出す
+    if preview_meshes:
         print("--- [Step 5] Generating combined GLB for preview ---")
-        comb_script = os.path.join(BASE_DIR, "convert", "lib", "blender_scene_combiner.py")
-        ts = int(time.time())
-        glb_out = os.path.join(OUTPUT_DIR, f"output_preview_combined_{ts}.glb")
-        subprocess.run(["blender", "--background", "--python", comb_script, "--", glb_out] + all_json_paths, capture_output=False)
-        if os.path.exists(glb_out):
-            print("    ✅ Combined GLB generated.")
-        else:
-            print("    ⚠ Combined GLB generation FAILED.")
-        # 不要な一時JSONを削除
-        for p in all_json_paths: 
-            if os.path.exists(p): os.remove(p)
+        try:
+            t0 = time.time(); write_preview_glb(preview_meshes, output_dir)
+            print(f"    ✅ Combined GLB generated. ({time.time()-t0:.2f}s)")
+        except Exception as e:
+            print(f"    ⚠ Combined GLB generation FAILED: {e}")
 
-    cv2.imwrite(VIS_OUTPUT, v_img)
-    cv2.imwrite(os.path.join(OUTPUT_DIR, "output_vis_skeleton.jpg"), v_img)
+    # last_inference_vis.jpg は UI 用の共有ファイルなので、既定の outputs/ に書き出すジョブだけが更新する
+    if output_dir == OUTPUT_DIR: cv2.imwrite(VIS_OUTPUT, v_img)
+    cv2.imwrite(os.path.join(output_dir, "output_vis_skeleton.jpg"), v_img)
     print(f"✅ SUCCESS. Total time: {time.time()-time_start:.2f}s")
+    return 0
+
+if __name__ == "__main__":
+    _args = build_arg_parser().parse_args()
+    try:
+        _output_dir = job_output_dir(_args.output_dir)
+    except ValueError as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(2)
+    sys.exit(run(_args, output_dir=_output_dir))
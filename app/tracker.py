@@ -0,0 +1,101 @@
+import numpy as np
+import cv2
+
+# ==========================================
+# 🎯 動画用のシンプルな IoU トラッカー
+# ==========================================
+# フレーム間で bbox の IoU が最大のものを貪欲に対応付け、人物ごとに永続的な ID を振る。
+# 見失っても max_age フレーム (元動画のフレーム番号の差。--frame_stride で間引いても生フレーム数で数える) までは
+# ID を保持し、再び重なれば同じ ID を引き継ぐ。
+# キーフレーム間は propagate_boxes() (疎なオプティカルフロー) で bbox を移動させ、検出器を回さない。
+
+def iou_matrix(a, b):
+    """a (N,4), b (M,4) [x1,y1,x2,y2] -> (N,M) IoU"""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4); b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0]); y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2]); y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]); area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+class IoUTracker:
+    def __init__(self, iou_threshold=0.3, max_age=10):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.tracks = {} # tid -> {"bbox", "last_frame", "hits"}
+        self.next_id = 0
+
+    def update(self, boxes, frame_idx):
+        """検出 bbox 群に対応するトラック ID のリストを返す (新規はここで採番)"""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        # 古くなったトラックを破棄
+        for tid in [t for t, tr in self.tracks.items() if frame_idx - tr["last_frame"] > self.max_age]:
+            del self.tracks[tid]
+
+        tids = list(self.tracks)
+        ids = [None] * len(boxes)
+        if tids and len(boxes):
+            iou = iou_matrix(boxes, [self.tracks[t]["bbox"] for t in tids])
+            # IoU の大きい組から貪欲に確定させる
+            for flat in np.argsort(-iou, axis=None):
+                d, t = np.unravel_index(flat, iou.shape)
+                if iou[d, t] < self.iou_threshold: break
+                if ids[d] is not None or tids[t] is None: continue
+                ids[d] = tids[t]; tids[t] = None
+
+        for d, box in enumerate(boxes):
+            if ids[d] is None:
+                ids[d] = self.next_id; self.next_id += 1
+                self.tracks[ids[d]] = {"hits": 0}
+            tr = self.tracks[ids[d]]
+            tr.update(bbox=box, last_frame=frame_idx, hits=tr["hits"] + 1)
+        return ids
+
+    def observe(self, tid, box, frame_idx):
+        """検出を介さずに (フロー追跡で) 得た bbox で既存トラックを更新する"""
+        tr = self.tracks.setdefault(tid, {"hits": 0})
+        tr.update(bbox=np.asarray(box, dtype=np.float64), last_frame=frame_idx, hits=tr["hits"] + 1)
+
+# ==========================================
+# 🌊 キーフレーム間の bbox 伝播 (Lucas-Kanade)
+# ==========================================
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+def propagate_boxes(prev_gray, gray, boxes, max_corners=40, fb_thresh=1.0):
+    """
+    前フレームの bbox 内の特徴点を追跡し、新しい bbox・平行移動量・信頼度 (0〜1) を返す。
+    信頼度は前後方向の追跡誤差が fb_thresh 以内だった点の割合 (点が取れなければ 0)。
+    """
+    h, w = gray.shape[:2]
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    new_boxes = boxes.copy(); shifts = np.zeros((len(boxes), 2)); conf = np.zeros(len(boxes))
+    for i, (x1, y1, x2, y2) in enumerate(boxes):
+        x0, y0 = max(int(x1), 0), max(int(y1), 0); xe, ye = min(int(np.ceil(x2)), w), min(int(np.ceil(y2)), h)
+        if xe - x0 < 8 or ye - y0 < 8: continue
+        roi_mask = np.zeros((h, w), dtype=np.uint8); roi_mask[y0:ye, x0:xe] = 255
+        pts = cv2.goodFeaturesToTrack(prev_gray, maxCorners=max_corners, qualityLevel=0.01, minDistance=5, mask=roi_mask)
+        if pts is None or len(pts) < 3: continue
+        nxt, st, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, pts, None, **LK_PARAMS)
+        back, st2, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, nxt, None, **LK_PARAMS)
+        fb = np.linalg.norm((back - pts).reshape(-1, 2), axis=1)
+        good = (st.ravel() == 1) & (st2.ravel() == 1) & (fb < fb_thresh)
+        conf[i] = good.mean()
+        if good.sum() < 3: conf[i] = 0.0; continue
+        d = np.median((nxt - pts).reshape(-1, 2)[good], axis=0)
+        shifts[i] = d
+        new_boxes[i] = [np.clip(x1 + d[0], 0, w), np.clip(y1 + d[1], 0, h), np.clip(x2 + d[0], 0, w), np.clip(y2 + d[1], 0, h)]
+    return new_boxes, shifts, conf
+
+if __name__ == "__main__":
+    # 回帰チェック: python app/tracker.py
+    # 静止した bbox は stride (間引き) に関わらず同じ ID を保つこと (30fps, max_age = 1秒分の生フレーム)
+    fps = 30
+    for stride in (1, 6, 10, 45):
+        tr = IoUTracker(max_age=max(stride, int(round(fps))))
+        ids = [tr.update([[10, 10, 50, 90]], f)[0] for f in range(0, stride * 8, stride)]
+        assert ids == [0] * 8, (stride, ids)
+    # max_age を超えて見失ったトラックは新しい ID になる
+    tr = IoUTracker(max_age=30)
+    assert tr.update([[10, 10, 50, 90]], 0) == [0] and tr.update([[10, 10, 50, 90]], 31) == [1]
+    print("tracker: OK")
@@ -0,0 +1,137 @@
+import os
+import sys
+import secrets
+import threading
+from multiprocessing.connection import Client
+
+# ==========================================
+# 🔌 常駐デーモン (worker_daemon.py) への接続設定
+# ==========================================
+# torch 等の重いライブラリはここでは import しない (クライアント側の起動を軽く保つため)
+DAEMON_HOST = os.environ.get("SAM3D_DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.environ.get("SAM3D_DAEMON_PORT", "7861"))
+# 認証鍵: 環境変数が無ければインストールごとの乱数鍵をファイル (所有者のみ読み書き可) に保存して共有する。
+# 接続は pickle でやり取りするため、固定の鍵にすると同じマシンの任意のプロセスがジョブを投げられてしまう
+AUTHKEY_FILE = os.environ.get("SAM3D_DAEMON_AUTHKEY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".daemon_authkey"))
+
+def load_authkey(create=False):
+    """認証鍵を返す。鍵ファイルが無い場合、create=True (デーモン側) なら作成し、そうでなければ None"""
+    env = os.environ.get("SAM3D_DAEMON_AUTHKEY")
+    if env: return env.encode("utf-8")
+    try:
+        with open(AUTHKEY_FILE, "rb") as f:
+            key = f.read().strip()
+        if key: return key
+    except FileNotFoundError:
+        pass
+    if not create: return None
+    key = secrets.token_hex(32).encode("ascii")
+    try:
+        fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # 同時に起動した別のデーモンが先に作った
+        return load_authkey()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def connect(timeout=None):
+    """デーモンに接続する。起動していなければ ConnectionRefusedError 等の OSError を送出する"""
+    import socket
+    authkey = load_authkey()
+    if authkey is None: raise ConnectionRefusedError(f"daemon auth key not found: {AUTHKEY_FILE}")
+    # Client() 自体は接続タイムアウトを持たないため、先にポートが開いているかを確認する
+    with socket.create_connection((DAEMON_HOST, DAEMON_PORT), timeout=timeout or 0.5):
+        pass
+    return Client((DAEMON_HOST, DAEMON_PORT), authkey=authkey)
+
+def daemon_available(timeout=0.5):
+    try:
+        conn = connect(timeout)
+        conn.send({"op": "ping"})
+        ok = conn.poll(timeout) and conn.recv()[0] == "pong"
+        conn.close()
+        return bool(ok)
+    except Exception:
+        return False
+
+def send_command(op, **kwargs):
+    """ping / cancel / shutdown / unload 等の単発コマンドを送り、応答を返す"""
+    conn = connect()
+    try:
+        conn.send(dict(op=op, **kwargs))
+        return conn.recv()
+    finally:
+        conn.close()
+
+class RemoteJob:
+    """
+    デーモン上のジョブを subprocess.Popen と同じ感覚で扱うためのハンドル。
+    main.py の running_processes にそのまま積めるよう poll / terminate / kill / wait を持つ。
+    """
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.pid = f"daemon:{DAEMON_PORT}"
+        self.returncode = None
+        self.job_id = None
+        self._conn = connect()
+        # 相対パス (画像・--output_dir) はデーモンではなくこのプロセスのカレントディレクトリ基準で解決させる
+        self._conn.send({"op": "run", "argv": self.argv, "cwd": os.getcwd()})
+        self._lock = threading.Lock()
+
+    def lines(self):
+        """ログ行を順に返すジェネレータ。ジョブ終了で停止し returncode が確定する"""
+        while self.returncode is None:
+            try:
+                kind, payload = self._conn.recv()
+            except (EOFError, OSError):
+                if self.returncode is None: self.returncode = -1
+                break
+            if kind == "accepted":
+                self.job_id = payload
+            elif kind == "log":
+                yield payload
+            elif kind == "exit":
+                self.returncode = payload
+        self._close()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def terminate(self):
+        # デーモン本体は止めず、このジョブだけを中断させる
+        if self.returncode is None and self.job_id is not None:
+            try: send_command("cancel", job_id=self.job_id)
+            except Exception: pass
+        self._close()
+
+    kill = terminate
+
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                try: self._conn.close()
+                except Exception: pass
+                self._conn = None
+
+def run_remote(argv):
+    """predict_worker.py と同じ引数でデーモンにジョブを投げ、ログを標準出力に流して終了コードを返す"""
+    job = RemoteJob(argv)
+    try:
+        for line in job.lines():
+            print(line, end="", flush=True)
+    except KeyboardInterrupt:
+        job.terminate()
+        return 130
+    return job.returncode
+
+if __name__ == "__main__":
+    # Usage: python worker_client.py <predict_worker.py と同じ引数>
+    #        python worker_client.py --ping | --unload | --shutdown
+    if len(sys.argv) == 2 and sys.argv[1] in ("--ping", "--unload", "--shutdown"):
+        print(send_command(sys.argv[1][2:]))
+        sys.exit(0)
+    sys.exit(run_remote(sys.argv[1:]))
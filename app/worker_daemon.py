@@ -0,0 +1,174 @@
+"""
+常駐推論デーモン
+
+検出器 (SAM3 / vitdet)・MoGe・SAM 3D Body をロードしたまま保持し、
+ローカルソケット経由で predict_worker.py と同じ引数のジョブを受け付けます。
+ボタンを押すたびに torch の import とモデルの再構築を行うコールドスタートを無くすためのものです。
+
+    python app/worker_daemon.py            # 起動 (既定: 127.0.0.1:7861)
+    python app/worker_client.py --ping     # 状態確認
+    python app/worker_client.py --unload   # 常駐モデルを解放 (VRAMを空ける)
+    python app/worker_client.py --shutdown # 停止
+
+起動中は predict_worker.py / main.py が自動的にこのデーモンへジョブを転送します。
+"""
+import os
+import sys
+import argparse
+import contextlib
+import itertools
+import threading
+import traceback
+from multiprocessing.connection import Listener
+
+import worker_client
+import predict_worker as pw
+
+class _ConnWriter:
+    """print() の出力を1行ずつクライアントへ送る stdout 代替"""
+    def __init__(self, conn, on_disconnect):
+        self.conn = conn
+        self.on_disconnect = on_disconnect
+        self.buf = ""
+        self.closed = False
+
+    def write(self, s):
+        self.buf += s
+        while "\n" in self.buf:
+            line, self.buf = self.buf.split("\n", 1)
+            self._send(line + "\n")
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.buf: self._send(self.buf); self.buf = ""
+
+    def _send(self, line):
+        if self.closed: return
+        try:
+            self.conn.send(("log", line))
+        except (OSError, EOFError, ValueError):
+            # クライアントが切断した = ジョブの中断とみなす
+            self.closed = True
+            self.on_disconnect()
+        sys.__stdout__.write(line)
+
+class WorkerDaemon:
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        device = "cuda" if pw.torch.cuda.is_available() else "cpu"
+        self.models = pw.ModelRegistry(device, resident=True)
+        # GPU を共有するため、ジョブは1つずつ直列に実行する
+        self.job_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.current_job = None
+        self.cancelled = set()
+        self.running = True
+        self.jobs_done = 0
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=self.authkey)
+        print(f"🚀 Worker daemon listening on {self.address[0]}:{self.address[1]} (device: {self.models.device})")
+        try:
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    # 疎通確認だけの接続や認証失敗は無視する
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def _handle(self, conn):
+        try:
+            msg = conn.recv()
+            op = msg.get("op")
+            if op == "ping":
+                conn.send(("pong", {
+                    "device": self.models.device,
+                    "busy": self.current_job is not None,
+                    "jobs_done": self.jobs_done,
+                    "resident": {
+                        "detectors": sorted(self.models.detectors),
+                        "moge": self.models.moge is not None,
+                        "estimator": self.models.estimator is not None,
+                        "sam3_embeddings": len(self.models.sam3_states),
+                    },
+                }))
+            elif op == "run":
+                self._run_job(conn, msg.get("argv", []), msg.get("cwd"))
+            elif op == "cancel":
+                self._cancel(msg.get("job_id"))
+                conn.send(("ok", None))
+            elif op == "unload":
+                with self.job_lock:
+                    self.models.release_all()
+                    self.models.resident = True
+                conn.send(("ok", None))
+            elif op == "shutdown":
+                conn.send(("ok", None))
+                self.running = False
+                os._exit(0)
+            else:
+                conn.send(("error", f"unknown op: {op}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            try: conn.close()
+            except Exception: pass
+
+    def _cancel(self, job_id):
+        self.cancelled.add(job_id)
+        if self.current_job == job_id:
+            pw.CANCEL_EVENT.set()
+
+    def _run_job(self, conn, argv, cwd=None):
+        job_id = next(self.job_ids)
+        conn.send(("accepted", job_id))
+        writer = _ConnWriter(conn, lambda: self._cancel(job_id))
+        code = 1
+        with self.job_lock:
+            if job_id in self.cancelled:
+                conn.send(("exit", 130))
+                return
+            self.current_job = job_id
+            pw.CANCEL_EVENT.clear()
+            try:
+                with contextlib.redirect_stdout(writer):
+                    try:
+                        args = pw.build_arg_parser().parse_args(argv)
+                        if cwd:
+                            # パス引数はクライアントのカレントディレクトリ基準で絶対パスにする
+                            args.image_path = os.path.join(cwd, args.image_path)
+                            if args.output_dir: args.output_dir = os.path.join(cwd, args.output_dir)
+                        code = pw.run(args, models=self.models, output_dir=pw.job_output_dir(args.output_dir))
+                        if args.clear_mem: pw.clear_memory()
+                    except pw.JobCancelled:
+                        print("⏹️ Job cancelled.")
+                        code = 130
+                    except SystemExit as e:
+                        # argparse のエラー等
+                        code = e.code if isinstance(e.code, int) else 1
+                    except Exception as e:
+                        print(f"❌ ERROR: {e}")
+                        traceback.print_exc(file=sys.stdout)
+                        code = 1
+                    writer.finish()
+            finally:
+                self.current_job = None
+                self.cancelled.discard(job_id)
+                pw.CANCEL_EVENT.clear()
+                self.jobs_done += 1
+        try: conn.send(("exit", code))
+        except (OSError, EOFError): pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=worker_client.DAEMON_HOST)
+    parser.add_argument("--port", type=int, default=worker_client.DAEMON_PORT)
+    args = parser.parse_args()
+    WorkerDaemon((args.host, args.port), worker_client.load_authkey(create=True)).serve_forever()